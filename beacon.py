@@ -1,24 +1,82 @@
 from log import log
+from fakemcu import FakeMCU  # simulated MCU of a disabled beacon
+from metrics import round_trip_histogram
+import protocol  # framed binary protocol with the MCU
 import serial
+import threading
+import time
 
 
 class Beacon:
-    def __init__(self, port="COM6", baudrate=115200, enable=True):
-        self.ser = serial.Serial()
-        self.ser.port = port
-        self.ser.baudrate = baudrate
-        self.ser.timeout = None
-        self.ser.write_timeout = 0
+    # send_raw only writes a command when it differs enough from the last written one (see changed),
+    # and never faster than the serial link can take (a token bucket refilled at max_rate)
+    # Note: with the beacon disabled the serial port is replaced by a simulated MCU (see fakemcu.py), with the timing of the real link
+    # With framed=True the commands are wrapped into protocol.py packets with a sequence number, the ACK of every command gives its round trip time
+    # Otherwise the round trip is from the oldest command written since the last "OK" to the next "OK"
+    # The MCU replies are read with read_packets, in bulk, and decoded into protocol.Packet for both protocols (see SerialReader)
+    def __init__(self, port="COM6", baudrate=115200, enable=True, deadband=None, hysteresis=None, max_rate=None, burst=2, framed=False,
+                 read_timeout=None, device=None):
+        """
+        :param port: serial port
+        :param baudrate: serial baudrate
+        :param enable: whether to actually open and write the port, False to talk to a simulated MCU instead, for debugging without a device
+        :param deadband: per byte of the command, a byte at rest has to change by more than this to trigger a write, None for all 0
+        :param hysteresis: per byte of the command, a byte that's moving keeps triggering writes while it changes by more than this,
+        and comes to rest (back to the deadband) once it doesn't, None for all 0
+        :param max_rate: max number of writes per second, None for what the link can carry (about baudrate/10 bytes per second)
+        :param burst: number of writes that can go out back to back, before the rate limit kicks in
+        :param framed: whether to use the framed protocol of protocol.py, the MCU has to speak it too
+        :param read_timeout: max time a read blocks in seconds, None to block until something arrives
+        Note: with a timeout, readline can return a partial line, use read_packets instead
+        :param device: the simulated MCU of a disabled beacon, None for a fakemcu.FakeMCU with the baudrate and the protocol above
+        """
         self.enable = enable
         if self.enable:
+            self.ser = serial.Serial()
+            self.ser.port = port
+            self.ser.baudrate = baudrate
+            self.ser.timeout = read_timeout
+            self.ser.write_timeout = 0
             self.ser.open()
-        log.info(f"Serial on {port}, baudrate {baudrate}, open: {self.ser.is_open}")
-        log.info(f"Serial status: {str(self.ser)}")
+            log.info(f"Serial on {port}, baudrate {baudrate}, open: {self.ser.is_open}")
+            log.info(f"Serial status: {str(self.ser)}")
+        else:
+            self.ser = device or FakeMCU(baudrate, framed=framed)
+            self.ser.timeout = read_timeout
+            log.info("Beacon disabled, using the simulated MCU")
 
         self.last_msg = None
         self.last_msg_raw = None
 
-        self.dummy_msg = "OK"
+        # change detection of send_raw
+        self.deadband = deadband
+        self.hysteresis = hysteresis
+        self.moving = []  # whether every byte of the last command is moving, see changed
+
+        # rate limit of send_raw, a token bucket
+        self.baudrate = baudrate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.token_time = time.perf_counter()
+
+        # statistics of send_raw
+        self.sent = 0  # number of commands written
+        self.bytes_sent = 0
+        self.suppressed = 0  # number of commands not written because they didn't change enough
+        self.rate_limited = 0  # number of commands not written because of the rate limit
+
+        # framed protocol
+        self.framed = framed
+        self.seq = 0  # sequence number of the next command
+        self.last_seq = None  # sequence number of the last command written, None if not framed
+        self.decoder = protocol.PacketDecoder() if framed else protocol.LineDecoder()  # incremental decoder of the MCU replies
+        self.send_times = [0.0] * 256  # perf_counter of the last command written with every sequence number
+        self.unacked_time = 0.0  # perf_counter of the oldest command written since the last "OK", not framed
+        self.round_trip = 0  # from writing a command to receiving its ACK, in seconds
+        self.max_round_trip = 0
+        self.mean_round_trip = 0  # exponential moving average
+        self.acks = 0  # number of ACKs received
 
     def send(self, signal):
         if not self.enable:
@@ -33,33 +91,258 @@ class Beacon:
             log.info(f"Duplicated message")
             return ""
 
+    def changed(self, raw):
+        """
+        Per byte deadband and hysteresis against the last written command
+        A byte at rest triggers a write if it changed by more than its deadband, then it's moving
+        A moving byte triggers a write if it changed by more than its hysteresis, otherwise it's at rest again
+
+        The state isn't updated here, send_raw keeps it once it knows whether the command goes out
+
+        :param raw: bytes of the new command
+        :return: (whether the command should be written, the moving state of every byte if it's kept)
+        """
+        last = self.last_msg_raw
+        if last is None or len(last) != len(raw):
+            return True, [False] * len(raw)
+        deadband = self.deadband or [0] * len(raw)
+        hysteresis = self.hysteresis or [0] * len(raw)
+        moving = [delta > (hysteresis[i] if self.moving[i] else deadband[i])
+                  for i, delta in enumerate(abs(a - b) for a, b in zip(raw, last))]
+        return any(moving), moving
+
+    def token_delay(self, size):
+        """
+        :param size: number of bytes to be written, for the default rate
+        :return: seconds until take_token lets a write out, 0 if it would now
+        """
+        rate = self.max_rate or self.baudrate / 10 / size
+        tokens = min(self.burst, self.tokens + (time.perf_counter() - self.token_time) * rate)
+        return max((1 - tokens) / rate, 0)
+
+    def take_token(self, size):
+        """
+        Token bucket rate limit of the writes
+
+        :param size: number of bytes to be written, for the default rate
+        :return: whether the write can go out now
+        """
+        now = time.perf_counter()
+        rate = self.max_rate or self.baudrate / 10 / size  # 8N1: 10 bits on the wire per byte
+        self.tokens = min(self.burst, self.tokens + (now - self.token_time) * rate)
+        self.token_time = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
     def send_raw(self, raw):
-        if not self.enable:
-            # log.error(f"Beacon is disabled")
-            return
-        if self.last_msg_raw is None or raw != self.last_msg_raw:
-            # log.info(f"To serial: {signal.encode()}")
-            self.ser.write(raw)
-            self.last_msg_raw = raw
-            return raw
-        else:
-            log.info(f"Duplicated message")
+        """
+        Write a command, unless it didn't change enough or the link is busy
+        Suppressed commands are fine to drop, the parser sends a newer one on the next "OK"
+
+        :param raw: bytes of the command
+        :return: raw if it's written (or would be, with the beacon disabled), "" if it's suppressed
+        """
+        changed, moving = self.changed(raw)
+        if not changed:
+            # every byte is at rest against the last written command, which stays the reference
+            self.moving = moving
+            self.suppressed += 1
+            if raw == self.last_msg_raw:
+                log.debug(f"Duplicated message")  # counted in self.suppressed, too frequent for INFO
+            return ""
+        if not self.take_token(len(raw)):
+            # dropped, the state stays the one of the last written command, so the next command is judged against it
+            self.rate_limited += 1
             return ""
+        self.write_command(raw)
+        self.moving = moving
+        self.last_msg_raw = raw
+        self.sent += 1
+        self.bytes_sent += len(raw)
+        return raw
+
+    def write_command(self, raw):
+        # write one command, in a packet if framed
+        if self.framed:
+            self.send_times[self.seq] = time.perf_counter()
+            raw = protocol.encode(protocol.COMMAND, self.seq, raw)
+            self.last_seq = self.seq
+            self.seq = (self.seq + 1) & 0xFF
+        elif not self.unacked_time:
+            self.unacked_time = time.perf_counter()
+        # log.info(f"To serial: {signal.encode()}")
+        self.ser.write(raw)
+
+    def read_packets(self):
+        """
+        Read the MCU replies, blocking until at least one byte arrives or the read timeout passes
+        Everything that's waiting is read in one go and decoded incrementally, lines or framed packets
+        ACKs update the round trip statistics here, corrupted bytes are skipped by the decoder (see self.decoder)
+
+        :return: list of protocol.Packet, possibly empty if only a part of a message arrived
+        """
+        ser = self.ser
+        data = ser.read(ser.in_waiting or 1)
+        if data and ser.in_waiting:
+            data += ser.read(ser.in_waiting)  # the rest of the burst that arrived with the first byte
+        return self.feed_packets(data)
+
+    def feed_packets(self, data):
+        """
+        Decode received bytes, for readers doing their own reads
+
+        :param data: bytes read from the serial port
+        :return: list of the complete protocol.Packet
+        """
+        packets = self.decoder.feed(data)
+        self.record_acks(packets)
+        return packets
+
+    def record_acks(self, packets):
+        for packet in packets:
+            if packet.type == protocol.ACK:
+                self.acked(packet.seq)
+
+    def acked(self, seq):
+        # record the round trip time of the command with this sequence number (None for an "OK"), once
+        if seq is None:
+            if not self.unacked_time:
+                return  # nothing written since the last "OK"
+            latency = time.perf_counter() - self.unacked_time
+            self.unacked_time = 0.0
+        elif not self.send_times[seq]:
+            return  # never sent, or already acknowledged
+        else:
+            latency = time.perf_counter() - self.send_times[seq]
+            self.send_times[seq] = 0.0
+        self.round_trip = latency
+        self.max_round_trip = max(self.max_round_trip, latency)
+        self.mean_round_trip += (latency - self.mean_round_trip) / min(self.acks + 1, 100)
+        self.acks += 1
+        round_trip_histogram.record(latency)
+
+    @property
+    def stats(self):
+        # the statistics of send_raw, as a str for the console and the log
+        total = self.sent + self.suppressed + self.rate_limited
+        stats = (f"{self.sent} sent, {self.suppressed} suppressed, {self.rate_limited} rate limited ({self.sent / max(total, 1):.1%} written)"
+                 f", round trip {self.mean_round_trip*1e3:.1f} ms (max {self.max_round_trip*1e3:.1f} ms)")
+        if self.framed:
+            stats += f", {self.decoder.crc_errors} CRC errors, {self.decoder.skipped} bytes skipped"
+        return stats
 
     def readline(self):
-        
-        if not self.enable:
-            self.dummy_msg = "OK" if self.dummy_msg == "FPS:240" else "FPS:240"
-            # log.error(f"Beacon is disabled")
-            return self.dummy_msg
         return self.ser.readline().decode()
 
     def close(self):
-        if not self.enable:
-            # log.error(f"Beacon is disabled")
-            return
         return self.ser.close()
 
     @property
     def out_waiting(self):
         return self.ser.out_waiting
+
+
+class SerialReader:
+    # Reads the MCU messages in bulk and hands every one of them to a callback, as a protocol.Packet
+    # ("OK" is ACK, "FPS:240" is FPS, other lines are TEXT, see protocol.LineDecoder, or the real packets with the framed protocol)
+    # The beacon should be created with a read_timeout, so that stop() returns within that time instead of blocking forever
+    def __init__(self, beacon, callback):
+        """
+        :param beacon: Beacon to read from
+        :param callback: function called with every protocol.Packet, in the reading thread, pass queue.put to get a queue
+        """
+        self.beacon = beacon
+        self.callback = callback
+        self.stopped = False
+        self.thread = None
+        self.reads = 0  # number of reads
+        self.messages = 0  # number of messages delivered
+
+    def run(self):
+        # read until stopped, blocking, can be used as the target of a thread
+        while not self.stopped:
+            try:
+                packets = self.beacon.read_packets()
+            except (serial.SerialException, OSError) as e:
+                if self.stopped:
+                    break  # the port was closed under us on shutdown
+                log.error(e)
+                time.sleep(self.beacon.ser.timeout or 0.1)
+                continue
+            except TypeError:
+                # pyserial reads from a None file descriptor when the port is closed during a read
+                if self.beacon.ser.is_open:
+                    raise  # a real error, not the port closed under us
+                break
+            self.reads += 1
+            self.messages += len(packets)
+            for packet in packets:
+                self.callback(packet)
+        log.info(f"Serial reader stopped after {self.reads} reads, {self.messages} messages")
+
+    def start(self, daemon=True):
+        self.thread = threading.Thread(target=self.run, daemon=daemon)
+        self.thread.start()
+        return self.thread
+
+    def stop(self, timeout=None):
+        # returns within the read timeout of the beacon
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+class ReadySignal:
+    # The "OK" handshake between the thread reading the MCU and the thread sending commands
+    # The reader calls set() when the MCU says it's ready, which wakes up the sender blocked in wait() right away
+    # The sender calls sent() after writing the command, which clears the flag and records the latency
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.ready = False
+        self.ready_time = 0  # perf_counter of the last "OK"
+        self.interrupted = False  # set on shutdown, wakes up all waiters for good
+
+        # latency statistics, in seconds
+        self.wake_latency = 0  # from "OK" to the sender waking up, of the last command
+        self.send_latency = 0  # from "OK" to the command being written, of the last command
+        self.max_send_latency = 0
+        self.mean_send_latency = 0  # exponential moving average
+        self.count = 0  # number of commands sent
+
+    def set(self):
+        with self.condition:
+            self.ready = True
+            self.ready_time = time.perf_counter()
+            self.condition.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Block until the MCU is ready
+
+        :param timeout: in seconds, None to wait forever
+        :return: whether the MCU is ready, False on timeout
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.ready or self.interrupted, timeout)
+            ready = self.ready
+        if ready:
+            self.wake_latency = time.perf_counter() - self.ready_time
+        return ready
+
+    def sent(self):
+        # should be called right after the command is written
+        with self.condition:
+            self.ready = False
+            latency = time.perf_counter() - self.ready_time
+        self.send_latency = latency
+        self.max_send_latency = max(self.max_send_latency, latency)
+        self.mean_send_latency += (latency - self.mean_send_latency) / min(self.count + 1, 100)
+        self.count += 1
+
+    def interrupt(self):
+        # wake up all waiters without setting the flag, used on shutdown
+        with self.condition:
+            self.interrupted = True
+            self.condition.notify_all()
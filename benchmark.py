@@ -0,0 +1,492 @@
+# Micro benchmarks for the hot paths of the driver
+# Run with `python benchmark.py` to run all of them, or `python benchmark.py hand_access` to pick some
+# Every benchmark prints the average wall time of one call, compare these before and after a change
+
+import sys
+import timeit
+
+import numpy as np
+
+
+def report(name, func, number=10000, repeat=5, per=1):
+    """
+    Time func and print the best average of the repeats
+
+    :param name: name to be printed
+    :param func: function without arguments to be timed
+    :param number: number of calls in one repeat
+    :param repeat: number of repeats, the fastest one is reported
+    :param per: number of items processed by one call, the time is divided by this
+    """
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number / per
+    print(f"{name:<40s}{best * 1e6:10.2f} us")
+    return best
+
+
+def load_benchmark_messages(count=100):
+    # messages of the recording in LEAP_FRAMES if set, synthetic ones otherwise
+    import os
+    from record import load_messages
+    from synthetic import make_messages
+    path = os.environ.get("LEAP_FRAMES")
+    return load_messages(path) if path else make_messages(count)
+
+
+def bench_hand_access():
+    # the component access pattern of one frame: the decoder claims, fills and publishes a frame
+    # and GestureParser.parse reads palm, wrist and every finger tip a few times from a snapshot
+    from hand import Hand
+    hand = Hand(render=False)
+    pos = np.random.rand(hand.key_pt_count, 3).astype(np.float32)
+
+    def frame():
+        hand_frame = hand.claim()
+        hand_frame.pos[:] = pos
+        hand.publish()
+        with hand.snapshot() as hand_frame:
+            for _ in range(2):
+                hand_frame.palm
+                hand_frame.wrist
+            for _ in range(2):
+                for name in hand.finger_names:
+                    hand_frame.views[name][-1]
+            hand_frame.thumb, hand_frame.index, hand_frame.middle, hand_frame.ring, hand_frame.pinky
+
+    report("hand component access (per frame)", frame)
+
+
+def bench_frame_exchange():
+    # cost of the frame exchange itself, and a check that a reader never sees a torn frame under contention
+    import threading
+    from hand import Hand
+    hand = Hand(render=False)
+
+    def publish():
+        hand.claim()
+        hand.publish(history=False)
+
+    def snapshot():
+        with hand.snapshot():
+            pass
+
+    report("claim + publish", publish)
+    report("snapshot + release", snapshot)
+
+    # the writer fills every frame with its own number, the reader checks that all values of a snapshot agree
+    stop = False
+    torn = 0
+    reads = 0
+
+    def writer():
+        i = 0
+        while not stop:
+            i += 1
+            hand_frame = hand.claim()
+            hand_frame.pos[:] = i
+            hand_frame.timestamp = i
+            hand.publish(history=False)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    end = timeit.default_timer() + 1
+    while timeit.default_timer() < end:
+        with hand.snapshot() as hand_frame:
+            first = hand_frame.pos[0, 0]
+            torn += hand_frame.pos[-1, -1] != first or hand_frame.timestamp != first or not (hand_frame.pos == first).all()
+            reads += 1
+    stop = True
+    thread.join()
+    print(f"{'torn snapshots under contention':<40s}{torn:10d} of {reads}")
+
+
+def bench_frame_decode():
+    # per frame cost of filling both hands from a parsed Leap Motion frame
+    import json
+    from hand import Hand
+    from decoder import FrameDecoder
+    from synthetic import make_frame
+    hands = [Hand(render=False), Hand(render=False)]
+    decoder = FrameDecoder(hands)
+    frame = json.loads(json.dumps(make_frame(0, 0.0)))
+    empty = {**frame, "hands": [], "pointables": []}
+
+    def store_pos():
+        hands[0].store_pos(frame, 0)
+        hands[1].store_pos(frame, 1)
+
+    report("Hand.store_pos, both hands (per frame)", store_pos)
+    report("FrameDecoder.decode, both hands", lambda: decoder.decode(frame))
+    report("FrameDecoder.decode, no hands", lambda: decoder.decode(empty))
+
+
+def bench_json_decode():
+    # per message cost of every installed websocket message decoder
+    # pass a recording (see record.py, or a file with one json frame per line) through LEAP_FRAMES to use real data
+    from decoder import json_decoders, get_json_decoder
+    messages = load_benchmark_messages()
+
+    for name, decoder in json_decoders.items():
+        if decoder is None:
+            print(f"{name:<40s}{'not installed':>13s}")
+            continue
+        for selective in [False, True]:
+            decode = get_json_decoder(name, selective)
+            report(f"{name}{' (selective)' if selective else ''}, per message", lambda: [decode(msg) for msg in messages], number=10, per=len(messages))
+
+
+def bench_hand_transforms():
+    # per frame cost of building the instance transformations of one hand (all bones and key points)
+    from hand import Hand
+    hand = Hand(render=False)
+    hand.claim().pos[:] = np.random.rand(hand.key_pt_count, 3)
+    hand.publish()
+
+    def scalar():
+        for name in hand.component_names:
+            positions = hand.views[name]
+            for i in range(len(positions)-1):
+                hand.get_bone_transform(positions[i], positions[i+1], 0.1, name)
+            for v in positions:
+                hand.get_key_point_transform(v, name)
+
+    report("scalar transforms, one hand", scalar, number=1000)
+    report("batched transforms, one hand", lambda: (hand.get_bone_transforms(0.1), hand.get_key_point_transforms()), number=1000)
+
+
+def bench_gesture_parse():
+    # per command cost of parsing both hands, the servo (0) and the wheel (1) branch
+    # the servo branch logs its angles, rate limited, so most of them are dropped by the filter of the channel
+    import json
+    from hand import Hand
+    from decoder import FrameDecoder
+    from gesture import GestureParser
+    from synthetic import make_frame
+    hands = [Hand(render=False), Hand(render=False)]
+    FrameDecoder(hands).decode(json.loads(json.dumps(make_frame(0, 0.5))))
+    parsers = [GestureParser(hands[i], i, render=False) for i in range(2)]
+
+    report("GestureParser.parse, servo (0)", parsers[0].parse)
+    report("GestureParser.parse, wheel (1)", parsers[1].parse)
+
+
+def noisy_commands(direction, filter_name=None, moving=True, seconds=10, fps=110):
+    """
+    Commands of a gesture parser for a synthetic hand with Leap Motion like jitter (0.5 mm), one per frame
+
+    :param direction: direction of the GestureParser, 0 for the servos, 1 for the wheels
+    :param filter_name: key point filter, see filters.py
+    :param moving: whether the hand moves, or stays still with just the jitter
+    :return: list of command bytes
+    """
+    from hand import Hand
+    from gesture import GestureParser
+    from filters import get_filter
+    from synthetic import make_frame
+    rng = np.random.default_rng(0)
+    hand = Hand(render=False)
+    parser = GestureParser(hand, direction, render=False, keypoint_filter=get_filter(filter_name))
+    commands = []
+    for i in range(int(fps * seconds)):
+        frame = make_frame(i, i / fps if moving else 0.0, 1)
+        hand.store_pos(frame, 0)
+        hand_frame = hand.claim()
+        hand_frame.copy_from(hand.frame)
+        hand_frame.pos += rng.normal(0, 0.5/100, hand_frame.pos.shape)  # in our space, 1/100 mm
+        hand_frame.timestamp = int(i / fps * 1e6)
+        hand.publish(history=False)
+        commands.append(parser.parse())
+    return commands
+
+
+def bench_filters():
+    # per frame cost of every filter on all key points of a hand, and how many distinct commands the parsers produce
+    # from a still and a moving synthetic hand, fewer distinct commands means fewer serial writes
+    from hand import Hand
+    from filters import filters, get_filter
+    fps = 110
+    x = np.random.rand(Hand.key_pt_count + 1, 3)
+
+    for name in filters:
+        f = get_filter(name)
+        t = iter(range(10**9))
+        report(f"{name} filter, all key points", lambda: f(x, next(t) / fps))
+
+    def count_changes(commands):
+        return sum(a != b for a, b in zip([None] + commands, commands))
+
+    for direction in [0, 1]:
+        for moving in [False, True]:
+            counts = ", ".join(f"{name or 'raw'} {count_changes(noisy_commands(direction, name, moving, fps=fps))}" for name in [None, *filters])
+            print(f"{'commands, direction %d, %s hand' % (direction, 'moving' if moving else 'still'):<40s}{counts} of {fps * 10}")
+
+
+def bench_beacon():
+    # cost of the change detection of Beacon.send_raw, and how many of the commands of a noisy moving hand it writes
+    # the commands are the wheel command followed by the servo command, like parse_and_send in main.py
+    from beacon import Beacon
+    deadband = [0, 3, 0, 3, 0, 2, 2, 0]  # BEACON_DEADBAND in main.py
+    hysteresis = [0, 1, 0, 1, 0, 1, 1, 0]  # BEACON_HYSTERESIS in main.py
+
+    raw = noisy_commands(1, seconds=2)[-1] + noisy_commands(0, seconds=2)[-1]
+    beacon = Beacon(enable=False, deadband=deadband, hysteresis=hysteresis)
+    report("Beacon.send_raw, suppressed", lambda: beacon.send_raw(raw))
+
+    for filter_name in [None, "one_euro"]:
+        commands = [wheel + servo for wheel, servo in zip(noisy_commands(1, filter_name), noisy_commands(0, filter_name))]
+        for name, kwargs in [("exact", {}), ("deadband", {"deadband": deadband, "hysteresis": hysteresis})]:
+            beacon = Beacon(enable=False, max_rate=1e9, **kwargs)  # no rate limit, the commands are replayed faster than real time
+            for command in commands:
+                beacon.send_raw(command)
+            print(f"{'writes, %s, %s' % (filter_name or 'raw', name):<40s}{beacon.sent:10d} of {len(commands)}")
+
+
+def bench_protocol():
+    # cost of framing a command and of decoding the MCU replies of the framed protocol
+    import protocol
+    command = bytes(range(8))
+    replies = (protocol.encode(protocol.ACK, 1) + protocol.encode_fps(0, 240.0)) * 50
+    report("protocol.encode, 8 byte command", lambda: protocol.encode(protocol.COMMAND, 1, command))
+    decoder = protocol.PacketDecoder()
+    report("PacketDecoder.feed, per packet", lambda: decoder.feed(replies), number=1000, per=100)
+    corrupted = bytearray(replies)
+    corrupted[::7] = b"\xa5" * len(corrupted[::7])  # fake sync bytes everywhere
+    report("PacketDecoder.feed, corrupted, per packet", lambda: decoder.feed(corrupted), number=1000, per=100)
+
+
+def bench_serial_read():
+    # cost of reading the MCU messages from a pty (POSIX only), line by line with readline, or in bulk with read_packets
+    # and how long stopping a reader takes when the MCU is silent
+    import os
+    import threading
+    import time
+    try:
+        import tty
+    except ImportError:
+        print(f"{'serial read':<40s}{'needs a pty':>13s}")
+        return
+    from beacon import Beacon, SerialReader
+    count = 200  # the pty buffer is only a few kilobytes, a bigger burst would block the write
+    burst = b"OK\r\nFPS:240.00\r\n" * (count // 2)
+
+    def make_beacon():
+        master, slave = os.openpty()
+        tty.setraw(master)
+        tty.setraw(slave)
+        return master, Beacon(port=os.ttyname(slave), read_timeout=0.1)
+
+    master, beacon = make_beacon()
+    os.write(master, burst)
+    time.sleep(0.1)
+    start = time.perf_counter()
+    for _ in range(count):
+        beacon.readline().strip()
+    print(f"{'Beacon.readline, per message':<40s}{(time.perf_counter() - start) / count * 1e6:10.2f} us")
+
+    master, beacon = make_beacon()
+    os.write(master, burst)
+    time.sleep(0.1)
+    start = time.perf_counter()
+    messages = 0
+    while messages < count:
+        messages += len(beacon.read_packets())
+    print(f"{'Beacon.read_packets, per message':<40s}{(time.perf_counter() - start) / count * 1e6:10.2f} us")
+
+    reader = SerialReader(beacon, lambda packet: None)
+    reader.start()
+    time.sleep(0.25)  # in the middle of a read
+    start = time.perf_counter()
+    reader.stop()
+    print(f"{'SerialReader.stop, silent MCU':<40s}{(time.perf_counter() - start) * 1e3:10.2f} ms")
+
+
+def bench_simulated_mcu():
+    # parser -> serial throughput and latency against the simulated MCU of a disabled beacon (see fakemcu.py),
+    # with the stop-and-wait "OK" handshake of the parser thread for both protocols and baudrates, and with a pipeline (framed only)
+    import time
+    import protocol
+    from beacon import Beacon, ReadySignal, SerialReader
+    from pipeline import CommandPipeline
+    seconds = 1
+
+    for baudrate in [9600, 115200]:
+        for framed in [False, True]:
+            for window in [1, 4] if framed else [1]:
+                beacon = Beacon(baudrate=baudrate, enable=False, max_rate=1e9, framed=framed, read_timeout=0.1)
+                ready = ReadySignal()
+                pipeline = CommandPipeline(beacon, window) if window > 1 else None
+
+                def on_message(packet):
+                    if packet.type == protocol.ACK:
+                        ready.set()
+                        if pipeline is not None:
+                            pipeline.on_ack(packet.seq)
+
+                reader = SerialReader(beacon, on_message)
+                reader.start()
+                start = time.perf_counter()
+                cpu = time.process_time()
+                i = 0
+                while time.perf_counter() - start < seconds:
+                    i += 1
+                    command = bytes([i % 256] * 8)  # every command differs, nothing is suppressed
+                    if pipeline is not None:
+                        pipeline.submit(command)
+                        time.sleep(1/500)  # a new frame from the sampler
+                    elif ready.wait(0.1):
+                        beacon.send_raw(command)
+                        ready.sent()
+                reader.stop()
+                cpu = time.process_time() - cpu
+                mcu = beacon.ser
+                name = "%d baud, %s, window %d" % (baudrate, "framed" if framed else "lines", window)
+                print(f"{name:<40s}{mcu.applied / seconds:10.0f} commands/s, latency {mcu.mean_latency*1e3:.1f} ms "
+                      f"(max {mcu.max_latency*1e3:.1f} ms), CPU {cpu / seconds:.0%}")
+
+
+def bench_ready_signal():
+    # latency from the reader thread seeing "OK" to the parser thread writing, with nothing else running
+    import threading
+    import time
+    from beacon import ReadySignal
+    signal = ReadySignal()
+    count = 2000
+    latencies = []
+
+    def sender():
+        for _ in range(count):
+            if signal.wait(1):
+                signal.sent()
+                latencies.append(signal.send_latency)
+
+    thread = threading.Thread(target=sender)
+    thread.start()
+    for _ in range(count):
+        while signal.ready:  # wait for the previous command to be sent
+            time.sleep(0)
+        time.sleep(1e-4)  # the MCU loop
+        signal.set()
+    thread.join()
+    latencies = np.array(latencies) * 1e6
+    print(f"{'OK to send latency, p50':<40s}{np.percentile(latencies, 50):10.2f} us")
+    print(f"{'OK to send latency, p99':<40s}{np.percentile(latencies, 99):10.2f} us")
+
+
+def bench_logging():
+    # cost of one log call in the hot loops: written synchronously like before, or queued for the log writer thread (see log.py)
+    # both write the coloredlogs format to os.devnull, a real terminal makes the synchronous write a lot slower
+    import logging
+    import os
+    from log import AsyncHandler, Channel, Lazy, root, writer
+    devnull = open(os.devnull, "w")
+    signal = bytes([0, 250, 1, 250, 0, 63, 72, 20])
+    console = root.handlers[0].handlers[0]  # installed by coloredlogs
+
+    def make_logger(name, asynchronous):
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(console.formatter)
+        for f in console.filters:
+            handler.addFilter(f)
+        logger = logging.getLogger(f"benchmark.{name}")
+        logger.propagate = False
+        logger.addHandler(AsyncHandler([handler], writer) if asynchronous else handler)
+        return logger
+
+    sync = make_logger("sync", False)
+    queued = make_logger("queued", True)
+    limited = Channel(make_logger("limited", True), rate=10)
+    commands = Channel(queued)  # like the channels of main, the writer creates the records
+    report("log.info, synchronous", lambda: sync.info(f"[Beacon] Send: {signal}"))
+    report("log.info, queued", lambda: queued.info("[Beacon] Send: %s", signal), number=1000)
+    report("channel, queued", lambda: commands.info("[Beacon] Send: %s", signal), number=1000)
+    report("log.info, queued, rate limited", lambda: limited.info("[Beacon] Send: %s", signal))
+    report("log.debug, disabled", lambda: queued.debug("[Beacon] Send: %s", signal))
+
+    def decode(signal):
+        return "".join([f"{v:03d}" for v in signal])
+
+    report("command log, print", lambda: print(decode(signal), file=devnull))
+    report("command log, queued", lambda: commands.info("%s", Lazy(decode, signal)), number=1000)
+    writer.stop()  # wait for the writer to catch up before the numbers below
+    print(f"{'log writer batches':<40s}{writer.batches:10d}, {writer.dropped} records dropped")
+
+
+def bench_metrics():
+    # cost of recording a stage timing, and of reading the histograms for the console and for a Prometheus scrape
+    import time
+    from metrics import Histogram, metrics
+    histogram = Histogram("benchmark_seconds", "benchmark")
+    rng = np.random.default_rng(0)
+    for value in rng.lognormal(-9, 1, 10000):
+        histogram.record(float(value))
+    start = time.perf_counter()
+    report("Histogram.record", lambda: histogram.record(time.perf_counter() - start))
+    report("Histogram.summary", histogram.summary, number=1000)
+    report("Registry.prometheus", metrics.prometheus, number=1000)
+
+
+def bench_scheduler():
+    # cost of the frame scheduler on every received frame, and for the consumers
+    import time
+    from scheduler import FrameScheduler
+    scheduler = FrameScheduler()
+    parser = scheduler.add_consumer("parser")
+    scheduler.add_consumer("renderer", 60)
+    scheduler.consumed(parser)
+
+    def offer():
+        now = time.perf_counter()
+        if scheduler.offer("frame", now, 0.001) is not None:
+            scheduler.decoded(now, now)
+
+    report("FrameScheduler.offer + decoded", offer)
+    report("FrameScheduler.consumed", lambda: scheduler.consumed(parser))
+
+
+def bench_registry():
+    # per frame cost of tracking every hand in the registry, and of the batched filter and features against a loop over the hands
+    import json
+    from hand import Hand, HandFrame
+    from registry import HandRegistry, BatchFilter
+    from filters import get_filter
+    from gesture import GestureParser, batch_features
+    from synthetic import make_frame
+    registries = {}
+    for hand_count in [2, 8]:
+        registry = registries[hand_count] = HandRegistry(8)
+        frame = json.loads(json.dumps(make_frame(0, 0.0, hand_count)))
+        report(f"HandRegistry.decode, {hand_count} hands", lambda: registry.decode(frame))
+
+    t = iter(range(10**9))
+
+    def batch_filter(registry, batch):
+        with registry.snapshot() as snapshot:
+            snapshot.time = next(t) / 110
+            return batch(snapshot)
+
+    # only the occupied slots are filtered
+    for hand_count, registry in registries.items():
+        batch = BatchFilter(get_filter("one_euro"), 8)
+        report(f"BatchFilter, {hand_count} hands", lambda: batch_filter(registry, batch))
+    filters = [get_filter("one_euro") for _ in range(8)]
+    x = np.random.rand(8, Hand.key_pt_count + 1, 3)
+    report("one_euro filter, loop over 8 hands", lambda: [f(x[i], next(t) / 110) for i, f in enumerate(filters)])
+
+    pos, palm_normal = registry.latest_frame.pos, registry.latest_frame.palm_normal
+    parser = GestureParser(Hand(render=False), 0, render=False)
+    frames = []
+    for i in range(8):
+        hand_frame = HandFrame()
+        hand_frame.pos[:] = pos[i]
+        hand_frame.palm_normal[:] = palm_normal[i]
+        frames.append(hand_frame)
+    report("batch_features, 8 hands", lambda: batch_features(pos, palm_normal))
+    report("GestureParser.features, loop over 8 hands", lambda: [parser.features(f) for f in frames])
+
+
+benchmarks = {name[len("bench_"):]: func for name, func in globals().items() if name.startswith("bench_")}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        benchmarks[name]()
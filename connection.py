@@ -0,0 +1,233 @@
+# Managed websocket connection to the Leap Motion service, used by the sampler thread and the asyncio engine
+# Use it like `msg = await connection.recv()`, it connects when needed and reconnects when the connection drops:
+#
+# - the settings (focus, background) are sent again on every connect
+# - reconnecting is immediate after a connection that worked, then backs off exponentially (with some jitter) while the service is down,
+#   capped at max_backoff, so tracking resumes within a fraction of a second after the service restarts, without hammering it
+# - a heartbeat pings the service every ping_interval, the ping -> pong time is tracked (ping_histogram), and a connection without
+#   a pong within ping_timeout is dropped and reconnected, instead of waiting forever on a dead socket
+# - every state change (CONNECTING, CONNECTED, DISCONNECTED, CLOSED) is passed to on_state, on the event loop of the connection
+# - close() is thread safe, it interrupts a blocked recv, a connect or a backoff wait, and recv raises Closed from then on
+#
+# Nothing but closing stops it, a record.ReplayFinished of a replay is passed on to the caller
+
+import asyncio
+import json
+import random
+import time
+
+import websockets
+
+from log import log
+from metrics import metrics
+
+# connection states
+CONNECTING = "connecting"
+CONNECTED = "connected"
+DISCONNECTED = "disconnected"
+CLOSED = "closed"
+
+ping_histogram = metrics.histogram("ping_seconds", "Time from a websocket ping to its pong")
+
+
+class Closed(Exception):
+    # raised by Connection.recv after close()
+    pass
+
+
+class Connection:
+    def __init__(self, connect, settings=(), on_state=None, min_backoff=0.01, max_backoff=0.1, factor=2.0, jitter=0.1,
+                 ping_interval=1.0, ping_timeout=1.0):
+        """
+        :param connect: function returning the websocket connection (an async context manager), or a record.Replay
+        :param settings: list of dicts sent to the Leap Motion service after every connect
+        :param on_state: optional function called with the new state and the error causing it (or None)
+        :param min_backoff: seconds before the second attempt to connect, the first one is immediate
+        :param max_backoff: max seconds between two attempts
+        :param factor: of the backoff growth from one failed attempt to the next
+        :param jitter: relative random variation of the backoff
+        :param ping_interval: seconds between two pings, None to disable the heartbeat
+        :param ping_timeout: seconds to wait for a pong before dropping the connection
+        """
+        self.connect = connect
+        self.settings = settings
+        self.on_state = on_state
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.factor = factor
+        self.jitter = jitter
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+
+        self.state = DISCONNECTED
+        self.closed = False
+        self.loop = None  # event loop of the connection, set on the first recv
+        self.closing = None  # asyncio.Event set by close(), wakes up the backoff wait
+        self.context = None  # the async context manager returned by connect
+        self.ws = None  # the open connection
+        self.connecting = None  # task entering the context
+        self.heartbeat_task = None
+        self.attempts = 0  # failed attempts since the last successful connect
+
+        # statistics
+        self.connects = 0  # number of successful connects
+        self.failures = 0  # number of failed attempts to connect
+        self.disconnects = 0  # number of connections dropped, not counting close()
+        self.ping_latency = 0  # last ping -> pong time, in seconds
+        self.connected_time = 0  # perf_counter of the last connect
+        self.disconnected_time = 0  # perf_counter of the last disconnect
+        self.downtime = 0  # seconds between the last disconnect and the connect after it
+
+    async def recv(self):
+        """
+        Receive the next message, connecting first if needed, and reconnecting until it works if the connection drops
+
+        :return: message str
+        """
+        while True:
+            ws = self.ws
+            if ws is None:
+                ws = await self.open()
+            try:
+                msg = await ws.recv()
+            except (OSError, websockets.ConnectionClosed) as e:
+                await self.drop(e)
+                continue
+            if self.closed:
+                await self.drop(None)
+                continue  # raises Closed
+            return msg
+
+    async def open(self):
+        # connect, backing off after every failed attempt
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self.closing = asyncio.Event()
+            if self.closed:
+                self.closing.set()
+        while True:
+            if self.closed:
+                self.set_state(CLOSED)
+                raise Closed()
+            if self.attempts:
+                delay = min(self.min_backoff * self.factor ** (self.attempts - 1), self.max_backoff)
+                delay *= 1 + random.uniform(-self.jitter, self.jitter)
+                try:
+                    await asyncio.wait_for(self.closing.wait(), delay)
+                    continue  # closed while waiting
+                except asyncio.TimeoutError:
+                    pass
+
+            self.set_state(CONNECTING)
+            context = self.connect()
+            self.connecting = asyncio.ensure_future(context.__aenter__())
+            ws = None
+            try:
+                ws = await self.connecting
+                for setting in self.settings:
+                    await ws.send(json.dumps(setting))
+            except asyncio.CancelledError:
+                if self.closed and self.connecting.cancelled():
+                    continue  # cancelled by close()
+                raise
+            except (OSError, websockets.InvalidHandshake, websockets.ConnectionClosed) as e:
+                if ws is not None:
+                    # connected, but the settings didn't make it
+                    try:
+                        await context.__aexit__(None, None, None)
+                    except Exception:
+                        pass
+                self.attempts += 1
+                self.failures += 1
+                self.set_state(DISCONNECTED, e)
+                continue
+            finally:
+                self.connecting = None
+
+            self.context, self.ws = context, ws
+            self.attempts = 0
+            self.connects += 1
+            self.connected_time = time.perf_counter()
+            if self.disconnected_time:
+                self.downtime = self.connected_time - self.disconnected_time
+            if self.ping_interval and hasattr(ws, "ping"):
+                self.heartbeat_task = asyncio.ensure_future(self.heartbeat(ws))
+            self.set_state(CONNECTED)
+            log.info(f"Focused on the leap motion controller...")
+            return ws
+
+    async def drop(self, error):
+        # forget the current connection, after it failed with error (None when closing)
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        context, self.context, self.ws = self.context, None, None
+        if context is not None:
+            try:
+                await context.__aexit__(None, None, None)
+            except Exception as e:
+                log.debug(f"Error closing the websocket: {e}")
+        if not self.closed:
+            self.disconnects += 1
+            self.disconnected_time = time.perf_counter()
+            self.set_state(DISCONNECTED, error)
+
+    async def heartbeat(self, ws):
+        # ping the service, dropping the connection if it doesn't answer
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            start = time.perf_counter()
+            try:
+                pong = await ws.ping()
+                await asyncio.wait_for(pong, self.ping_timeout)
+            except asyncio.TimeoutError:
+                log.warning(f"No pong from the Leap Motion service within {self.ping_timeout} seconds, reconnecting")
+                self.abort(ws)
+                return
+            except websockets.ConnectionClosed:
+                return  # recv will find out
+            self.ping_latency = time.perf_counter() - start
+            ping_histogram.record(self.ping_latency)
+
+    @staticmethod
+    def abort(ws):
+        # drop a connection right away, without the closing handshake, a blocked recv raises ConnectionClosed
+        transport = getattr(ws, "transport", None)
+        if transport is not None:
+            transport.abort()
+        else:
+            asyncio.ensure_future(ws.close())  # like a record.Replay
+
+    def set_state(self, state, error=None):
+        if state == self.state and error is None:
+            return
+        self.state = state
+        if self.on_state is not None:
+            self.on_state(state, error)
+
+    def close(self):
+        # thread safe, recv raises Closed from now on
+        self.closed = True
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.interrupt)
+
+    def interrupt(self):
+        # on the event loop, wake up whatever recv is waiting for
+        self.closing.set()
+        if self.connecting is not None:
+            self.connecting.cancel()
+        if self.ws is not None:
+            self.abort(self.ws)
+
+    async def aclose(self):
+        # close from the event loop, waiting for the connection to be closed
+        self.closed = True
+        if self.closing is not None:
+            self.closing.set()
+        await self.drop(None)
+        self.set_state(CLOSED)
+
+    @property
+    def stats(self):
+        return (f"{self.state}, {self.connects} connects, {self.disconnects} disconnects, {self.failures} failed attempts, "
+                f"ping {self.ping_latency*1e3:.2f} ms, last downtime {self.downtime:.3f} s")
@@ -6,28 +6,8 @@ from glumpy import app, gl, glm, gloo, __version__
 import numpy as np
 
 
-class HollowCube:
-    def __init__(self, u_view, transform: np.ndarray):
-        vertex = """
-uniform mat4   u_model;         // Model matrix
-uniform mat4   u_transform;     // Transform matrix
-uniform mat4   u_view;          // View matrix
-uniform mat4   u_projection;    // Projection matrix
-uniform vec4   u_color;         // Global color
-attribute vec4 a_color;         // Vertex color
-attribute vec3 a_position;      // Vertex position
-varying vec3   v_position;      // Interpolated vertex position (out)
-varying vec4   v_color;         // Interpolated fragment color (out)
-
-void main()
-{
-    v_color = u_color * a_color;
-    v_position = a_position;
-    gl_Position = u_projection * u_view * u_transform * u_model * vec4(a_position,1.0);
-}
-"""
-
-        fragment = """
+# the hollow cube look, shared by HollowCube and InstancedHollowCube
+fragment = """
 varying vec4 v_color;    // Interpolated fragment color (in)
 varying vec3 v_position; // Interpolated vertex position (in)
 void main()
@@ -52,22 +32,51 @@ void main()
     
 }
 """
+
+# cube geometry, 8 corners, 12 triangles for the faces and 12 lines for the outline
+cube_positions = [[1, 1, 1], [-1, 1, 1], [-1, -1, 1], [1, -1, 1],
+                  [1, -1, -1], [1, 1, -1], [-1, 1, -1], [-1, -1, -1]]
+cube_colors = [[0, 1, 1, 1], [0, 0, 1, 1], [0, 0, 0, 1], [0, 1, 0, 1],
+               [1, 1, 0, 1], [1, 1, 1, 1], [1, 0, 1, 1], [1, 0, 0, 1]]
+cube_triangles = [0, 1, 2, 0, 2, 3,  0, 3, 4, 0, 4, 5,  0, 5, 6, 0, 6, 1,
+                  1, 6, 7, 1, 7, 2,  7, 4, 3, 7, 3, 2,  4, 7, 6, 4, 6, 5]
+cube_outline = [0, 1, 1, 2, 2, 3, 3, 0, 4, 7, 7, 6,
+                6, 5, 5, 4, 0, 5, 1, 6, 2, 7, 3, 4]
+
+
+class HollowCube:
+    def __init__(self, u_view, transform: np.ndarray):
+        vertex = """
+uniform mat4   u_model;         // Model matrix
+uniform mat4   u_transform;     // Transform matrix
+uniform mat4   u_view;          // View matrix
+uniform mat4   u_projection;    // Projection matrix
+uniform vec4   u_color;         // Global color
+attribute vec4 a_color;         // Vertex color
+attribute vec3 a_position;      // Vertex position
+varying vec3   v_position;      // Interpolated vertex position (out)
+varying vec4   v_color;         // Interpolated fragment color (out)
+
+void main()
+{
+    v_color = u_color * a_color;
+    v_position = a_position;
+    gl_Position = u_projection * u_view * u_transform * u_model * vec4(a_position,1.0);
+}
+"""
+
         # structured data type
         V = np.zeros(8, [("a_position", np.float32, 3),
                          ("a_color",    np.float32, 4)])
 
-        V["a_position"] = [[1, 1, 1], [-1, 1, 1], [-1, -1, 1], [1, -1, 1],
-                           [1, -1, -1], [1, 1, -1], [-1, 1, -1], [-1, -1, -1]]
-        V["a_color"] = [[0, 1, 1, 1], [0, 0, 1, 1], [0, 0, 0, 1], [0, 1, 0, 1],
-                        [1, 1, 0, 1], [1, 1, 1, 1], [1, 0, 1, 1], [1, 0, 0, 1]]
+        V["a_position"] = cube_positions
+        V["a_color"] = cube_colors
         V = V.view(gloo.VertexBuffer)
 
-        I = np.array([0, 1, 2, 0, 2, 3,  0, 3, 4, 0, 4, 5,  0, 5, 6, 0, 6, 1,
-                      1, 6, 7, 1, 7, 2,  7, 4, 3, 7, 3, 2,  4, 7, 6, 4, 6, 5], dtype=np.uint32)
+        I = np.array(cube_triangles, dtype=np.uint32)
         self.I = I.view(gloo.IndexBuffer)
 
-        O = np.array([0, 1, 1, 2, 2, 3, 3, 0, 4, 7, 7, 6,
-                      6, 5, 5, 4, 0, 5, 1, 6, 2, 7, 3, 4], dtype=np.uint32)
+        O = np.array(cube_outline, dtype=np.uint32)
         self.O = O.view(gloo.IndexBuffer)
 
         # Note that we do not specify the count argument because we'll bind explicitely our own vertex buffer.
@@ -116,3 +125,90 @@ void main()
     def resize(self, width, height):
         # should be called on every resizing loop (window event)
         self.program['u_projection'] = glm.perspective(45.0, width / float(height), 2.0, 200.0)
+
+
+class InstancedHollowCube:
+    # Draws many hollow cubes, each with its own transformation, in a single draw call
+    # The per instance transformation (model matrix included) is stored as 4 vertex attributes,
+    # repeated on the 8 corners of every cube, so the whole set of cubes is one vertex buffer upload and one draw
+    # Instances beyond the current count get an all zero transformation, which collapses them to nothing
+    def __init__(self, u_view, capacity):
+        vertex = """
+uniform mat4   u_view;          // View matrix
+uniform mat4   u_projection;    // Projection matrix
+uniform vec4   u_color;         // Global color
+attribute vec4 a_color;         // Vertex color
+attribute vec3 a_position;      // Vertex position
+attribute vec4 a_transform0;    // Per instance transform matrix, row 0 of the numpy (transposed) matrix
+attribute vec4 a_transform1;    // row 1
+attribute vec4 a_transform2;    // row 2
+attribute vec4 a_transform3;    // row 3
+varying vec3   v_position;      // Interpolated vertex position (out)
+varying vec4   v_color;         // Interpolated fragment color (out)
+
+void main()
+{
+    // the rows of the numpy matrix are the columns of the OpenGL one, just like uniforms
+    mat4 transform = mat4(a_transform0, a_transform1, a_transform2, a_transform3);
+    v_color = u_color * a_color;
+    v_position = a_position;
+    gl_Position = u_projection * u_view * transform * vec4(a_position,1.0);
+}
+"""
+        self.capacity = capacity
+        corners = len(cube_positions)
+
+        # cube geometry repeated for every instance
+        V = np.zeros(capacity * corners, [("a_position", np.float32, 3),
+                                          ("a_color",    np.float32, 4)])
+        V["a_position"] = np.tile(np.array(cube_positions, np.float32), (capacity, 1))
+        V["a_color"] = np.tile(np.array(cube_colors, np.float32), (capacity, 1))
+        V = V.view(gloo.VertexBuffer)
+
+        I = np.array(cube_triangles, dtype=np.uint32)
+        I = (I[None] + corners * np.arange(capacity, dtype=np.uint32)[:, None]).ravel()
+        self.I = I.view(gloo.IndexBuffer)
+
+        # per instance transformation, one vec4 attribute per row
+        T = np.zeros(capacity * corners, [("a_transform0", np.float32, 4),
+                                          ("a_transform1", np.float32, 4),
+                                          ("a_transform2", np.float32, 4),
+                                          ("a_transform3", np.float32, 4)])
+        self.T = T.view(gloo.VertexBuffer)
+        # cpu side staging buffer of the per instance transformation, shaped like the vertex buffer
+        self.transforms = np.zeros((capacity, corners, 4, 4), np.float32)
+
+        cube = gloo.Program(vertex, fragment)
+        cube.bind(V)
+        cube.bind(self.T)
+
+        self.global_scale = 0.1
+
+        cube['u_view'] = u_view
+        cube['u_color'] = 1, 1, 1, 1
+
+        self.program = cube
+        self.count = 0
+
+    def update(self, transforms):
+        """
+        Upload the transformation of all instances, should be called before draw when things moved
+        Note that the model matrix (like HollowCube.model) should already be multiplied into every transform
+
+        :param transforms: (N, 4, 4) np.array of transformations in glm (transposed) style, N <= capacity
+        """
+        count = len(transforms)
+        assert count <= self.capacity
+        self.transforms[:count] = transforms[:, None]
+        self.transforms[count:self.count] = 0  # collapse the instances that are no longer used
+        self.count = count
+        # a single full buffer update, uploaded to the GPU on the next draw
+        self.T[...] = self.transforms.reshape(-1, 16).view(self.T.dtype).ravel()
+
+    def draw(self):
+        # should be called on every draw loop (window event), draws all instances at once
+        self.program.draw(gl.GL_TRIANGLES, self.I)
+
+    def resize(self, width, height):
+        # should be called on every resizing loop (window event)
+        self.program['u_projection'] = glm.perspective(45.0, width / float(height), 2.0, 200.0)
@@ -0,0 +1,243 @@
+# Leap Motion frame decoder
+# JsonDecoder and its subclasses turn the raw websocket message into python objects,
+# using orjson or simdjson when installed and falling back to the standard json module
+# FrameDecoder turns a parsed v7 websocket frame into the position arrays of the Hand objects in one pass
+# The key points of all tracked hands are gathered through a fixed key table into one flat float array,
+# then scaled straight into a claimed frame of every Hand with a vectorized numpy call, no per finger arrays are built
+# and published, so that the readers only ever see complete frames
+# Note: np.fromiter over the flattened rows is about twice as fast as assigning the nested lists into an array
+# With a registry.HandRegistry, every hand of the frame is tracked in the registry instead, and the Hand objects are filled
+# with the operator hands picked from it, so that the parsers don't jump to another hand of the same type showing up
+
+import json
+from itertools import chain
+
+import numpy as np
+
+from hand import Hand
+
+# optional faster json parsers, see get_json_decoder
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+def extract(frame, to_list=list):
+    """
+    Pull only the fields used by FrameDecoder (and Hand.store_pos) out of a parsed tracking frame
+    Meta messages (without a timestamp) are not tracking frames and should not be passed in here
+
+    :param frame: parsed frame, a dict or a lazily parsed simdjson object
+    :param to_list: converter for the position arrays
+    :return: a small dict with the same layout as the original frame
+    """
+    hand_keys = FrameDecoder.arm_keys + ("palmNormal",)
+    finger_keys = FrameDecoder.finger_keys
+    hands = []
+    for hand in frame["hands"]:
+        obj = {key: to_list(hand[key]) for key in hand_keys}
+        obj["id"] = hand["id"]
+        obj["type"] = hand["type"]
+        obj["confidence"] = hand["confidence"]
+        hands.append(obj)
+    pointables = []
+    for pointable in frame["pointables"]:
+        obj = {key: to_list(pointable[key]) for key in finger_keys}
+        obj["handId"] = pointable["handId"]
+        obj["type"] = pointable["type"]
+        pointables.append(obj)
+    return {"timestamp": frame["timestamp"], "hands": hands, "pointables": pointables}
+
+
+class JsonDecoder:
+    # the standard library parser, always available
+    name = "json"
+
+    def __init__(self, selective=False):
+        """
+        :param selective: only keep the fields used by FrameDecoder, see extract
+        Note: this only saves parsing time for the simdjson decoder, which parses the rest lazily
+        the others have to parse the whole message anyway, but still hand out a smaller object
+        """
+        self.selective = selective
+
+    def loads(self, msg):
+        return json.loads(msg)
+
+    def __call__(self, msg):
+        """
+        Decode one websocket message
+
+        :param msg: str or bytes of the message
+        :return: parsed python object
+        """
+        frame = self.loads(msg)
+        if self.selective and "timestamp" in frame:
+            return extract(frame)
+        return frame
+
+
+class OrjsonDecoder(JsonDecoder):
+    name = "orjson"
+
+    def loads(self, msg):
+        return orjson.loads(msg)
+
+
+class SimdjsonDecoder(JsonDecoder):
+    name = "simdjson"
+
+    def __init__(self, selective=False):
+        super().__init__(selective)
+        # reused for every message, the previous document must not be referenced when parsing the next one
+        # which is why only plain python objects are returned from here
+        self.parser = simdjson.Parser()
+
+    def __call__(self, msg):
+        frame = self.parser.parse(msg)
+        if self.selective and "timestamp" in frame:
+            return extract(frame, lambda array: array.as_list())
+        return frame.as_dict()
+
+
+# all decoders by name, from the fastest to the slowest, the unavailable ones are None
+json_decoders = {
+    "simdjson": SimdjsonDecoder if simdjson is not None else None,
+    "orjson": OrjsonDecoder if orjson is not None else None,
+    "json": JsonDecoder,
+}
+
+
+def get_json_decoder(name=None, selective=False):
+    """
+    Construct a websocket message decoder
+
+    :param name: one of json_decoders, default to the fastest one installed
+    :param selective: only keep the fields used by FrameDecoder, see extract
+    :return: the decoder, call it with the raw message
+    """
+    if name is None:
+        # orjson is faster than simdjson when the whole frame has to be converted to python objects
+        order = ["simdjson", "orjson", "json"] if selective else ["orjson", "simdjson", "json"]
+        name = next(n for n in order if json_decoders[n] is not None)
+    if json_decoders.get(name) is None:
+        raise ValueError(f"JSON decoder {name} is not available, installed ones: {[n for n, d in json_decoders.items() if d is not None]}")
+    return json_decoders[name](selective)
+
+
+class FrameDecoder:
+    # ! Fixed key tables, in the same order as Hand.pos
+    arm_keys = tuple(Hand.arm_pos_names)
+    finger_keys = tuple(Hand.finger_pos_names)
+    finger_count = len(Hand.finger_names)
+    # the hand pool slot of every hand type
+    type_to_slot = {"left": 0, "right": 1}
+
+    def __init__(self, hands, confidence=0.7, scale=1/100, registry=None, device=0):
+        """
+        :param hands: list of Hand objects, indexed by the slots in type_to_slot
+        :param confidence: hands with a lower Leap Motion confidence are skipped, keeping their last position
+        :param scale: scale from Leap Motion millimeters to our space
+        :param registry: optional registry.HandRegistry tracking all hands, see decode_registry
+        :param device: the device of the frames in the registry
+        """
+        self.hands = hands
+        self.confidence = confidence
+        self.scale = scale
+        self.shape = (-1, Hand.key_pt_count, 3)
+        self.registry = registry
+        self.device = device
+
+    def decode(self, frame, update=True):
+        """
+        Update every Hand from a parsed Leap Motion frame
+        Hands missing from the frame are cleaned, hands with low confidence keep their last position
+
+        :param frame: parsed json frame from the Leap Motion websocket
+        :param update: if False, clean all hands instead of updating them (paused)
+        :return: whether the frame is a regular tracking frame (instead of some meta message)
+        """
+        if "timestamp" not in frame:
+            return False
+        if self.registry is not None:
+            return self.decode_registry(frame, update)
+
+        hands_json = frame["hands"]
+        if not hands_json or not update:
+            # fast path: nothing tracked, nothing to gather
+            for hand in self.hands:
+                hand.clean()
+            return True
+
+        # select the first hand of every type, and prepare the finger slots of them
+        selected = [None] * len(self.hands)
+        fingers = {}
+        for hand_json in hands_json:
+            slot = self.type_to_slot.get(hand_json["type"])
+            if slot is not None and slot < len(selected) and selected[slot] is None:
+                selected[slot] = hand_json
+                fingers[hand_json["id"]] = [None] * self.finger_count
+
+        # bucket the pointables into their hand, from thumb to pinky, in one pass
+        for pointable in frame["pointables"]:
+            slots = fingers.get(pointable["handId"])
+            if slots is not None:
+                slots[pointable["type"]] = pointable
+
+        # gather the key points of all valid hands through the fixed key table
+        rows = []
+        valid = []
+        arm_keys = self.arm_keys
+        finger_keys = self.finger_keys
+        for slot, hand_json in enumerate(selected):
+            if hand_json is None:
+                self.hands[slot].clean()
+                continue
+            slots = fingers[hand_json["id"]]
+            if hand_json["confidence"] < self.confidence or None in slots:
+                continue
+            rows += [hand_json[key] for key in arm_keys]
+            rows += [finger[key] for finger in slots for key in finger_keys]
+            valid.append((slot, hand_json))
+
+        if not valid:
+            return True
+
+        # the single gather of all valid hands
+        values = np.fromiter(chain.from_iterable(rows), np.float32, len(rows) * 3).reshape(self.shape)
+        timestamp = frame["timestamp"]
+        for i, (slot, hand_json) in enumerate(valid):
+            hand = self.hands[slot]
+            hand_frame = hand.claim()
+            np.multiply(values[i], self.scale, out=hand_frame.pos)
+            hand_frame.palm_normal[:] = hand_json["palmNormal"]
+            hand_frame.timestamp = timestamp
+            hand.publish()
+        return True
+
+    def decode_registry(self, frame, update=True):
+        # track every hand of the frame in the registry, then fill every Hand with the operator hand of its type
+        registry = self.registry
+        registry.decode(frame, self.device, update)
+        latest = registry.latest_frame
+        for hand_type, index in self.type_to_slot.items():
+            if index >= len(self.hands):
+                continue
+            hand = self.hands[index]
+            slot = registry.select(hand_type)
+            if slot is None:
+                hand.clean()
+            elif registry.updated[slot]:
+                hand_frame = hand.claim()
+                hand_frame.pos[:] = latest.pos[slot]
+                hand_frame.palm_normal[:] = latest.palm_normal[slot]
+                hand_frame.timestamp = int(latest.timestamp[slot])
+                hand.publish()
+            # otherwise low confidence, the hand keeps its last position
+        return True
@@ -0,0 +1,221 @@
+# All asyncio pipeline engine, an alternative to the sampler / parser / reader threads in main.py
+# The websocket sampler, the decoder, the serial reader and the gesture parser all run as tasks on one event loop,
+# connected by bounded queues: when a consumer falls behind, the oldest queued item is dropped (and counted),
+# so the pipeline always works on the latest data and the websocket never backs up
+# Shutdown is just cancelling the tasks, which also closes the websocket and detaches the serial reader
+# The websocket is a connection.Connection, reconnecting by itself
+
+import asyncio
+import time
+
+import protocol
+from log import log
+from metrics import metrics, receive_histogram, decode_histogram, store_histogram
+from record import ReplayFinished
+from connection import Closed
+
+
+def put_latest(queue, item):
+    """
+    Put item into a bounded asyncio.Queue without blocking, dropping the oldest item if it's full
+
+    :return: number of dropped items (0 or 1)
+    """
+    dropped = 0
+    if queue.full():
+        queue.get_nowait()
+        dropped = 1
+    queue.put_nowait(item)
+    return dropped
+
+
+class AsyncBeacon:
+    # Async reader around a Beacon, handing out the messages sent by the MCU as protocol.Packet (see Beacon.read_packets)
+    # On POSIX the serial port's file descriptor is watched by the event loop itself, no thread is involved
+    # Otherwise (Windows or a disabled beacon) the blocking Beacon.read_packets runs in the default executor
+    def __init__(self, beacon, queue_size=64):
+        self.beacon = beacon
+        self.messages = asyncio.Queue(queue_size)
+        self.fd = None
+        self.dropped = 0
+
+    def start(self):
+        ser = self.beacon.ser
+        if not self.beacon.enable:
+            return
+        try:
+            fd = ser.fileno()
+            asyncio.get_running_loop().add_reader(fd, self.on_readable)
+            self.fd = fd
+        except (AttributeError, NotImplementedError, OSError, ValueError):
+            self.fd = None  # fall back to the executor
+
+    def stop(self):
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            self.fd = None
+
+    def on_readable(self):
+        # called by the event loop when there's something to read, never blocks
+        ser = self.beacon.ser
+        for packet in self.beacon.feed_packets(ser.read(ser.in_waiting or 1)):
+            self.dropped += put_latest(self.messages, packet)
+
+    async def read(self):
+        """
+        :return: list of the next protocol.Packet
+        """
+        if self.fd is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.beacon.read_packets)
+        messages = [await self.messages.get()]
+        while not self.messages.empty():
+            messages.append(self.messages.get_nowait())
+        return messages
+
+
+class Engine:
+    def __init__(self, connection, json_decoder, decoder, parse_and_send, beacon,
+                 should_update=lambda: True, on_fps=None, queue_size=2, recorder=None, scheduler=None):
+        """
+        :param connection: connection.Connection to the Leap Motion service, sending the settings and reconnecting by itself
+        :param json_decoder: websocket message decoder, see decoder.get_json_decoder
+        :param decoder: decoder.FrameDecoder, filling the hand pool
+        :param parse_and_send: function parsing the hand pool and sending the command through the beacon
+        :param beacon: Beacon to read the MCU messages from
+        :param should_update: function returning whether the hands should be updated and commands sent (not paused)
+        :param on_fps: function called with the MCU frame rate when it's reported
+        :param queue_size: size of the raw message queue between the websocket and the decoder
+        :param recorder: optional record.Recorder, every received message is recorded
+        :param scheduler: optional scheduler.FrameScheduler, deciding which messages are decoded, all of them if None
+        """
+        self.connection = connection
+        self.recorder = recorder
+        self.json_decoder = json_decoder
+        self.decoder = decoder
+        self.parse_and_send = parse_and_send
+        self.beacon = beacon
+        self.should_update = should_update
+        self.on_fps = on_fps
+        self.queue_size = queue_size
+        self.scheduler = scheduler
+
+        self.loop = None
+        self.task = None
+        self.messages = None  # raw websocket messages, bounded
+        self.ready = None  # set when the MCU said "OK"
+        self.ready_time = 0
+        self.arduino_fps = 0
+
+        # statistics
+        self.dropped_frames = 0  # raw messages dropped because the decoder fell behind
+        self.send_latency = 0  # from "OK" to the command being written, in seconds
+        self.max_send_latency = 0
+        metrics.counter("dropped_frames_total", "Websocket messages dropped because the asyncio decoder fell behind", lambda: self.dropped_frames)
+
+    async def sampler(self):
+        # receive websocket messages into the bounded queue, the connection reconnects if it drops
+        try:
+            while True:
+                receiving = time.perf_counter()
+                msg = await self.connection.recv()
+                receive_histogram.record(time.perf_counter() - receiving)
+                if self.recorder is not None:
+                    self.recorder.write(msg)
+                self.dropped_frames += put_latest(self.messages, msg)
+        except ReplayFinished:
+            log.info(f"Replay finished")
+            self.stop()  # nothing else to parse
+        except Closed:
+            pass
+        finally:
+            await self.connection.aclose()
+            if self.recorder is not None:
+                self.recorder.close()  # by its only writer, once nothing is recorded anymore
+
+    async def decode(self):
+        # decode the latest websocket message into the hand pool
+        scheduler = self.scheduler
+        while True:
+            if scheduler is None:
+                msg = await self.messages.get()
+            else:
+                # with a held message, only wait for a newer one until it's due, see scheduler.py
+                receiving = time.perf_counter()
+                timeout = scheduler.timeout(receiving)
+                try:
+                    msg = await (self.messages.get() if timeout is None else asyncio.wait_for(self.messages.get(), timeout))
+                except asyncio.TimeoutError:
+                    msg = scheduler.take_pending()
+                else:
+                    now = time.perf_counter()
+                    msg = scheduler.offer(msg, now, now - receiving)
+                if msg is None:
+                    continue
+            decoding = time.perf_counter()
+            msg = self.json_decoder(msg)
+            start = time.perf_counter()
+            decode_histogram.record(start - decoding)
+            if self.decoder.decode(msg, self.should_update()):
+                store_histogram.record(time.perf_counter() - start)
+            else:
+                log.info(f"Getting message: {msg}")  # log the meta message for the user
+            if scheduler is not None:
+                scheduler.decoded(decoding, time.perf_counter())
+
+    async def reader(self):
+        # read the MCU messages, waking up the parser on "OK"
+        serial = AsyncBeacon(self.beacon)
+        serial.start()
+        try:
+            while True:
+                # corrupted data never makes it into a packet, see the decoders in protocol.py
+                for packet in await serial.read():
+                    if packet.type == protocol.ACK:
+                        self.on_ready()
+                    elif packet.type == protocol.FPS:
+                        self.update_fps(packet.fps)
+        finally:
+            serial.stop()
+
+    def on_ready(self):
+        self.ready_time = time.perf_counter()
+        self.ready.set()
+
+    def update_fps(self, fps):
+        self.arduino_fps = fps
+        if self.on_fps is not None:
+            self.on_fps(fps)
+
+    async def parser(self):
+        # parse and send a command every time the MCU is ready
+        while True:
+            await self.ready.wait()
+            if not self.should_update():
+                # paused, keep the ready flag for when we resume
+                await asyncio.sleep(1 / (self.arduino_fps or 20))
+                continue
+            self.ready.clear()
+            self.parse_and_send()
+            self.send_latency = time.perf_counter() - self.ready_time
+            self.max_send_latency = max(self.max_send_latency, self.send_latency)
+
+    async def run(self):
+        # run all stages until cancelled (or until one of them fails)
+        self.loop = asyncio.get_running_loop()
+        self.messages = asyncio.Queue(self.queue_size)
+        self.ready = asyncio.Event()
+        stages = [self.sampler(), self.decode(), self.reader(), self.parser()]
+        self.task = asyncio.gather(*stages)
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            log.info(f"Asyncio engine stopped")
+
+    def run_forever(self):
+        # blocking entry point, can be used as the target of a thread
+        asyncio.run(self.run())
+
+    def stop(self):
+        # thread safe, cancels all stages
+        if self.loop is not None and self.task is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.task.cancel)
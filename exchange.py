@@ -0,0 +1,109 @@
+# Latest-frame-wins exchange between the writers (the sampler, the interactive Hand setters) and any number of readers (renderer, parser)
+# A writer claims a free frame, fills it, and publishes it as the latest one
+# Every writer thread gets its own claimed frame, so a setter running while the sampler fills a frame never writes into it,
+# the one publishing last wins with a complete frame of its own
+# Readers pin the latest published frame for as long as they use it, the writers never touch a pinned frame
+# So readers always see one complete frame, without copying it and without holding a lock while parsing
+# The lock is only held for a few index updates in claim, publish and snapshot, never while reading or writing the data
+#
+# Note: the pool needs (1 per concurrent writer + 1 latest + 1 per concurrent reader) frames, claim grows it if it runs out
+# so a slow reader never blocks the writer, the writer just keeps overwriting the other free frames
+
+import threading
+
+
+class Snapshot:
+    # A pinned frame, use it like `with exchange.snapshot() as frame:`, or call release() when done
+    __slots__ = ["exchange", "index", "frame"]
+
+    def __init__(self, exchange, index):
+        self.exchange = exchange
+        self.index = index
+        self.frame = exchange.frames[index]
+
+    def release(self):
+        if self.index is not None:
+            self.exchange.release(self.index)
+            self.index = None
+
+    def __enter__(self):
+        return self.frame
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class FrameExchange:
+    def __init__(self, make_frame, size=4):
+        """
+        :param make_frame: function constructing an empty frame, the first one is the initial latest frame
+        :param size: initial number of frames in the pool, at least 2
+        """
+        assert size >= 2
+        self.make_frame = make_frame
+        self.frames = [make_frame() for _ in range(size)]
+        self.pins = [0] * size  # number of readers of every frame, -1 for the frame being written
+        self.latest = 0  # index of the latest published frame
+        self.writing = {}  # thread id -> index of the frame it claimed, not yet published
+        self.published = 0  # number of published frames
+        self.lock = threading.Lock()
+
+    @property
+    def latest_frame(self):
+        # the latest published frame, without pinning it
+        # only valid until the writer publishes a few more frames, use snapshot() for anything longer than a peek
+        return self.frames[self.latest]
+
+    def claim(self):
+        """
+        Get a free frame for the calling thread to fill, nobody else reads or writes it until it's published
+        Claiming again from the same thread before publishing returns the same frame
+
+        :return: the frame to be filled
+        """
+        thread = threading.get_ident()
+        with self.lock:
+            i = self.writing.get(thread)
+            if i is not None:
+                return self.frames[i]
+            for i, pins in enumerate(self.pins):
+                if pins == 0 and i != self.latest:
+                    break
+            else:
+                # every frame is pinned by a reader, grow the pool instead of waiting for them
+                self.frames.append(self.make_frame())
+                self.pins.append(0)
+                i = len(self.frames) - 1
+            self.pins[i] = -1
+            self.writing[thread] = i
+            return self.frames[i]
+
+    def publish(self):
+        """
+        Make the frame claimed by the calling thread the latest one, new snapshots see it from now on
+
+        :return: the published frame
+        """
+        with self.lock:
+            i = self.writing.pop(threading.get_ident(), None)
+            assert i is not None, "publish without claim"
+            self.pins[i] = 0
+            self.latest = i
+            self.published += 1
+            return self.frames[i]
+
+    def snapshot(self):
+        """
+        Pin the latest published frame, so that the writer leaves it alone until it's released
+
+        :return: Snapshot, a context manager handing out the frame
+        """
+        with self.lock:
+            i = self.latest
+            self.pins[i] += 1
+        return Snapshot(self, i)
+
+    def release(self, index):
+        # unpin a frame, called by Snapshot
+        with self.lock:
+            self.pins[index] -= 1
@@ -0,0 +1,138 @@
+# Local stand in for the Leap Motion websocket service, for load and soak testing without a controller
+# Speaks the v7 json protocol: a version message on connect, then one tracking frame after another
+# Frames are synthetic (see synthetic.py) or replayed from a recording (see record.py), at a configurable rate
+#
+# Run with `python fakeleap.py --fps 500 --hands 2`, then point the driver at it with `python main.py --uri ws://localhost:6437/v7.json`
+# Every second the actual send rate (and how many frames were late) is logged, when the rate can't be kept up
+
+import argparse
+import asyncio
+import json
+import time
+
+import websockets
+
+from log import log
+from record import load_messages
+from synthetic import make_frame
+
+# the first message sent by the Leap Motion service after connecting
+VERSION_MESSAGE = json.dumps({"serviceVersion": "4.1.0+52211", "version": 7})
+
+
+class SyntheticFrames:
+    # Cycles through precomputed synthetic frames, only the id and the timestamp are formatted per frame
+    def __init__(self, hand_count=2, pad=0, cycle=240, fps=120):
+        """
+        :param hand_count: number of hands in every frame
+        :param pad: extra bytes (roughly) of numbers added to every frame, to tune the payload size
+        :param cycle: number of distinct frames, the motion repeats after this
+        :param fps: frame rate the motion is generated for
+        """
+        self.bodies = []
+        for i in range(cycle):
+            frame = make_frame(i, i / fps, hand_count)
+            del frame["id"], frame["timestamp"]
+            if pad:
+                frame["padding"] = [123.456] * (pad // 8)  # "123.456," is 8 bytes
+            self.bodies.append(json.dumps(frame)[:-1])  # without the closing brace
+        self.index = 0
+
+    def __call__(self, t):
+        """
+        :param t: time in seconds, used for the timestamp
+        :return: next message str
+        """
+        body = self.bodies[self.index % len(self.bodies)]
+        self.index += 1
+        return f'{body}, "id": {self.index}, "timestamp": {int(t * 1e6)}}}'
+
+
+class ReplayedFrames:
+    # Cycles through the messages of a recording
+    def __init__(self, path):
+        self.messages = load_messages(path)
+        self.index = 0
+
+    def __call__(self, t):
+        msg = self.messages[self.index % len(self.messages)]
+        self.index += 1
+        return msg
+
+
+async def stream(ws, frames, fps, report_interval=1.0):
+    """
+    Send frames to one client at a fixed rate until it disconnects
+    Late frames are sent right away (never skipped), so that an overloaded client really sees the load
+
+    :param ws: websocket connection of the client
+    :param frames: frame source, called with the time to get the next message
+    :param fps: target frame rate
+    """
+    await ws.send(VERSION_MESSAGE)
+    start = last_report = time.perf_counter()
+    sent = late = 0
+    i = 0
+    while True:
+        now = time.perf_counter()
+        target = start + i / fps
+        if target > now:
+            await asyncio.sleep(target - now)
+        else:
+            late += 1
+            await asyncio.sleep(0)  # let the other clients and the receiver run
+        await ws.send(frames(target - start))
+        i += 1
+        sent += 1
+
+        now = time.perf_counter()
+        if now - last_report >= report_interval:
+            log.info(f"Sending {sent / (now - last_report):.1f} frames/second (target {fps}), late: {late}")
+            last_report = now
+            sent = late = 0
+
+
+def serve(host="localhost", port=6437, fps=120, hand_count=2, pad=0, replay=None, frames=None):
+    """
+    Run the fake service until interrupted
+
+    :param replay: recording to replay instead of synthetic frames
+    :param frames: optional function returning a frame source for every client, instead of the synthetic or replayed frames
+    """
+    make_frames = frames or (lambda: ReplayedFrames(replay) if replay else SyntheticFrames(hand_count, pad))
+
+    async def handler(ws):
+        # every client gets its own stream, messages from the client (focus, background, etc.) are ignored
+        frames = make_frames()
+        log.info(f"Client connected, streaming {'recording ' + replay if replay else f'{hand_count} synthetic hands'} at {fps} frames/second")
+        sender = asyncio.ensure_future(stream(ws, frames, fps))
+        try:
+            async for _ in ws:
+                pass
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            sender.cancel()
+        log.info(f"Client disconnected")
+
+    async def main():
+        async with websockets.serve(handler, host, port, compression=None):
+            log.info(f"Fake Leap Motion service listening on ws://{host}:{port}/v7.json")
+            await asyncio.Future()
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Fake Leap Motion websocket service")
+    arg_parser.add_argument("--host", default="localhost")
+    arg_parser.add_argument("--port", type=int, default=6437)
+    arg_parser.add_argument("--fps", type=float, default=120, help="frames per second, like 120, 500 or 1000")
+    arg_parser.add_argument("--hands", type=int, default=2, help="number of synthetic hands in every frame")
+    arg_parser.add_argument("--pad", type=int, default=0, help="extra bytes added to every synthetic frame")
+    arg_parser.add_argument("--replay", metavar="PATH", help="replay a recording instead of synthetic frames")
+    args = arg_parser.parse_args()
+    try:
+        serve(args.host, args.port, args.fps, args.hands, args.pad, args.replay)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,286 @@
+# Simulated MCU behind a fake serial port, used by the beacon when it's disabled (`enable=False`, or `python main.py --simulate`)
+# Stands in for the serial.Serial object of the beacon (write, read, readline, in_waiting, out_waiting, timeout, close),
+# in process, so the parser -> serial path can be run and benchmarked without any hardware, with realistic timing
+#
+# It runs the loop() of the Arduino sketch (see ppt.md):
+#
+#   if a command is available: read it and apply it (command_size bytes, or one COMMAND packet with the framed protocol)
+#   else: print "OK" (an ACK of the last applied command with the framed protocol)
+#   print "FPS:<1 / duration of this loop>"
+#
+# - every loop takes at least loop_time, and one command at most is applied per loop
+# - both directions of the link carry baudrate/10 bytes per second (8N1), the bytes queue up on the wire
+# - the MCU receive buffer holds rx_buffer bytes, the overflow is dropped like on the Arduino
+# - printing blocks the loop while the MCU transmit buffer (tx_buffer bytes) is full, so a chatty MCU is slowed down by the link
+# - the host buffers hold host_buffer bytes in each direction, a host that never reads loses the oldest replies
+#
+# Nothing runs in the background: the loops up to the current time are simulated whenever the port is used,
+# and reads block (with the timeout) until the simulated bytes arrive, so a reader thread never spins
+
+import time
+from collections import deque
+from threading import Condition
+
+import protocol
+
+READY_MESSAGE = b"OK\r\n"
+
+
+class FakeMCU:
+    def __init__(self, baudrate=115200, loop_time=1/240, command_size=8, framed=False, timeout=None,
+                 rx_buffer=64, tx_buffer=64, host_buffer=4096):
+        """
+        :param baudrate: of the simulated link
+        :param loop_time: duration of one loop() without any printing, 1/240 s for our sketch
+        :param command_size: bytes of a raw command, wheels then servos
+        :param framed: whether the MCU speaks the framed protocol of protocol.py
+        :param timeout: read timeout in seconds, None to block until something arrives, like serial.Serial.timeout
+        :param rx_buffer: size of the MCU receive buffer
+        :param tx_buffer: size of the MCU transmit buffer
+        :param host_buffer: size of the host buffers, in each direction
+        """
+        self.port = "simulated"
+        self.baudrate = baudrate
+        self.byte_time = 10 / baudrate  # 8N1: 10 bits on the wire per byte
+        self.loop_time = loop_time
+        self.command_size = command_size
+        self.framed = framed
+        self.timeout = timeout
+        self.write_timeout = 0
+        self.rx_buffer = rx_buffer
+        self.tx_buffer = tx_buffer
+        self.host_buffer = host_buffer
+        self.is_open = True
+        self.condition = Condition()
+
+        now = time.perf_counter()
+        # host -> MCU
+        self.to_mcu = deque()  # (arrival time, write time, bytes) of the writes still on the wire
+        self.to_mcu_bytes = 0
+        self.to_mcu_free = now  # time the wire is done with the bytes written so far
+        self.mcu_rx = deque()  # [write time, bytes] in the MCU receive buffer
+        self.mcu_rx_bytes = 0
+        self.decoder = protocol.PacketDecoder()  # of the framed MCU
+        self.packets = deque()  # (write time, packet) of the decoded commands, framed
+        # MCU -> host
+        self.to_host = deque()  # (arrival time, bytes) of the MCU messages, arrived or on the wire
+        self.to_host_bytes = 0
+        self.to_host_free = now
+        # the MCU
+        self.loop_start = now  # start of the next loop to simulate
+        self.last_seq = 0  # sequence number of the last applied command
+        self.last_command = None  # bytes of the last applied command
+
+        # statistics
+        self.loops = 0
+        self.applied = 0  # number of commands applied
+        self.latency = 0  # from writing a command to the end of the loop applying it, in seconds, of the last command
+        self.max_latency = 0
+        self.mean_latency = 0  # exponential moving average
+        self.overflowed = 0  # bytes dropped by the MCU because its receive buffer was full
+        self.dropped = 0  # bytes dropped by the host buffers
+        self.fps = 0  # last reported frame rate
+
+    def __str__(self):
+        return (f"FakeMCU(baudrate={self.baudrate}, loop_time={self.loop_time:.4f}, framed={self.framed}, "
+                f"timeout={self.timeout}, open={self.is_open})")
+
+    def write(self, data):
+        """
+        Put bytes on the wire to the MCU, never blocks
+
+        :return: number of bytes written, the ones that don't fit into the host buffer are dropped
+        """
+        data = bytes(data)
+        with self.condition:
+            now = time.perf_counter()
+            self.advance(now)
+            room = self.host_buffer - self.out_waiting_at(now)
+            if len(data) > room:
+                self.dropped += len(data) - max(room, 0)
+                data = data[:max(room, 0)]
+            if data:
+                self.to_mcu_free = max(now, self.to_mcu_free) + len(data) * self.byte_time
+                self.to_mcu.append((self.to_mcu_free, now, data))
+                self.to_mcu_bytes += len(data)
+            self.condition.notify_all()
+            return len(data)
+
+    def read(self, size=1):
+        """
+        Block until at least one byte arrived (or the timeout passed) and read what's there
+
+        :param size: max number of bytes
+        :return: bytes, empty on timeout or when closed
+        """
+        with self.condition:
+            now = time.perf_counter()
+            deadline = None if self.timeout is None else now + self.timeout
+            while True:
+                self.advance(now)
+                if self.to_host and self.to_host[0][0] <= now:
+                    return self.take(size, now)
+                if not self.is_open or (deadline is not None and now >= deadline):
+                    return b""
+                # nothing can change before the next message arrives or the next loop runs, unless something is written
+                wake = self.loop_start
+                if self.to_host:
+                    wake = min(wake, self.to_host[0][0])
+                if deadline is not None:
+                    wake = min(wake, deadline)
+                self.condition.wait(max(wake - now, 0))
+                now = time.perf_counter()
+
+    def readline(self):
+        # like serial.Serial.readline, a partial line on timeout
+        line = bytearray()
+        while not line.endswith(b"\n"):
+            byte = self.read(1)
+            if not byte:
+                break
+            line += byte
+        return bytes(line)
+
+    @property
+    def in_waiting(self):
+        with self.condition:
+            now = time.perf_counter()
+            self.advance(now)
+            return sum(len(data) for arrival, data in self.to_host if arrival <= now)
+
+    @property
+    def out_waiting(self):
+        with self.condition:
+            return self.out_waiting_at(time.perf_counter())
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify_all()
+
+    def out_waiting_at(self, now):
+        # bytes written by the host and not on the wire yet
+        return max(int((self.to_mcu_free - now) / self.byte_time), 0)
+
+    def take(self, size, now):
+        # read up to size arrived bytes, with the lock held
+        out = bytearray()
+        to_host = self.to_host
+        while to_host and to_host[0][0] <= now and len(out) < size:
+            arrival, data = to_host[0]
+            rest = size - len(out)
+            if len(data) > rest:
+                to_host[0] = (arrival, data[rest:])
+                data = data[:rest]
+            else:
+                to_host.popleft()
+            out += data
+        self.to_host_bytes -= len(out)
+        return bytes(out)
+
+    def advance(self, now):
+        # simulate the MCU loops started up to now, with the lock held
+        if not self.to_mcu and not self.mcu_rx and now - self.loop_start > 1.0:
+            self.loop_start = now - 1.0  # idle for long, only the last second of chatter matters (the host buffer is full anyway)
+        while self.loop_start <= now:
+            start = self.loop_start
+            self.receive(start)
+            command = self.take_command(start)
+            if command is None and self.mcu_rx and self.to_mcu and not self.framed:
+                self.loop_start = self.to_mcu[0][0]  # a partial command, readBytes waits for the rest
+                continue
+            end = start + self.loop_time
+            if command is None:
+                end = self.send(protocol.encode(protocol.ACK, self.last_seq) if self.framed else READY_MESSAGE, end)
+            else:
+                self.apply(command, end)
+            self.fps = 1 / (end - start)
+            if self.framed:
+                end = self.send(protocol.encode_fps(self.last_seq, self.fps), end)
+            else:
+                end = self.send(b"FPS:%.4f\r\n" % self.fps, end)
+            self.loop_start = end
+            self.loops += 1
+
+    def receive(self, now):
+        # move the bytes arrived by now into the MCU receive buffer
+        while self.to_mcu and self.to_mcu[0][0] <= now:
+            _, write_time, data = self.to_mcu.popleft()
+            self.to_mcu_bytes -= len(data)
+            room = self.rx_buffer - self.mcu_rx_bytes
+            if len(data) > room:
+                self.overflowed += len(data) - room
+                data = data[:room]
+            if data:
+                self.mcu_rx.append([write_time, data])
+                self.mcu_rx_bytes += len(data)
+
+    def take_command(self, now):
+        """
+        Take the next complete command out of the MCU receive buffer
+
+        :return: (write time, command bytes, sequence number or None), None if there's no complete command
+        """
+        mcu_rx = self.mcu_rx
+        if self.framed:
+            # decode until there's a COMMAND packet, the other packets (and the corrupted bytes) are ignored
+            while not self.packets and mcu_rx:
+                write_time, data = mcu_rx.popleft()
+                self.mcu_rx_bytes -= len(data)
+                self.packets.extend((write_time, packet) for packet in self.decoder.feed(data) if packet.type == protocol.COMMAND)
+            if not self.packets:
+                return None
+            write_time, packet = self.packets.popleft()
+            return write_time, packet.payload, packet.seq
+        if self.mcu_rx_bytes < self.command_size:
+            if mcu_rx and not self.to_mcu:
+                # readBytes times out on a partial command that will never be completed
+                self.overflowed += self.mcu_rx_bytes
+                mcu_rx.clear()
+                self.mcu_rx_bytes = 0
+            return None
+        write_time = mcu_rx[0][0]
+        command = bytearray()
+        while len(command) < self.command_size:
+            chunk = mcu_rx[0]
+            rest = self.command_size - len(command)
+            command += chunk[1][:rest]
+            if len(chunk[1]) > rest:
+                chunk[1] = chunk[1][rest:]
+            else:
+                mcu_rx.popleft()
+        self.mcu_rx_bytes -= self.command_size
+        return write_time, bytes(command), None
+
+    def apply(self, command, now):
+        write_time, self.last_command, seq = command
+        if seq is not None:
+            self.last_seq = seq
+        latency = now - write_time
+        self.latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.mean_latency += (latency - self.mean_latency) / min(self.applied + 1, 100)
+        self.applied += 1
+
+    def send(self, data, now):
+        """
+        Print bytes to the host at time now
+
+        :return: the time the print returns, later than now if the MCU transmit buffer was full
+        """
+        self.to_host_free = max(now, self.to_host_free) + len(data) * self.byte_time
+        self.to_host.append((self.to_host_free, data))
+        self.to_host_bytes += len(data)
+        while self.to_host_bytes > self.host_buffer:
+            # nobody reads, the oldest bytes are lost
+            _, old = self.to_host.popleft()
+            self.to_host_bytes -= len(old)
+            self.dropped += len(old)
+        # the print returns once all but tx_buffer bytes are on the wire
+        return max(now, self.to_host_free - self.tx_buffer * self.byte_time)
+
+    @property
+    def stats(self):
+        # the statistics of the simulated MCU, as a str for the console and the log
+        return (f"{self.applied} applied, latency {self.mean_latency*1e3:.1f} ms (max {self.max_latency*1e3:.1f} ms), "
+                f"FPS {self.fps:.1f}, {self.overflowed} bytes overflowed, {self.dropped} bytes dropped")
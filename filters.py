@@ -0,0 +1,220 @@
+# Temporal filters for the gesture parser, smoothing the jitter of the Leap Motion key points and of the parser outputs
+# Every filter works element wise on an array of any shape, like the (28, 3) key points of a hand or a (2,) output,
+# so a whole hand is filtered with a handful of numpy calls
+# Call a filter with the new value and its time in seconds, it returns the filtered value (a buffer reused by the next call)
+# Calling it again with the same time (the same Leap Motion frame parsed twice) returns the previous result unchanged
+# A filter can also update only some rows of the first axis, like the occupied slots of a batch of hands (see Filter.state)
+# The default parameters are tuned for the key points in our space (1 unit is 100 mm) with the 0.5 mm jitter of the Leap Motion
+#
+# - ExponentialFilter: fixed smoothing factor, cheapest, lags behind fast motion
+# - OneEuroFilter: adaptive cutoff, smooth when still and responsive when moving, see https://gery.casiez.net/1euro/
+# - KalmanFilter: constant velocity Kalman filter, can also predict `lead` seconds ahead to compensate for the MCU loop
+
+import math
+
+import numpy as np
+
+
+class Filter:
+    # Common bookkeeping of the filters: the first value is passed through, repeated times don't update the state
+    state = ["value"]  # the element wise arrays of the state, narrowed down to the rows being filtered
+
+    def __init__(self):
+        self.value = None  # last filtered value
+        self.t = None  # time of the last update, in seconds
+
+    def reset(self):
+        # forget the state, the next value is passed through
+        self.value = None
+        self.t = None
+
+    def __call__(self, x, t, rows=None):
+        """
+        :param x: np.array of the new raw value, the shape must stay the same between calls
+        :param t: time of the value in seconds
+        :param rows: slice, or indices, of the first axis to filter, the state of the other rows is left as it is, None for all of them
+        Note: all rows share the time of the last update, restart a row before filtering it again after leaving it out
+        :return: np.array of the filtered value (of the rows), float64
+        """
+        if self.value is None:
+            self.value = np.array(x, dtype=np.float64)
+            self.start(self.value)
+        elif rows is not None:
+            return self.update_rows(x, t, rows)
+        elif t > self.t:
+            self.update(x, t - self.t)
+        self.t = t
+        return self.output() if rows is None else self.output()[rows]
+
+    def update_rows(self, x, t, rows):
+        # like __call__ with the state narrowed down to some rows: update works in place on a slice of them (views),
+        # or on copies of the indexed ones, written back afterwards
+        state = [getattr(self, name) for name in self.state]
+        try:
+            for name, array in zip(self.state, state):
+                setattr(self, name, array[rows])
+            if t > self.t:
+                self.update(x[rows], t - self.t)
+            output = self.output()
+            if not isinstance(rows, slice):
+                for name, array in zip(self.state, state):
+                    array[rows] = getattr(self, name)
+        finally:
+            for name, array in zip(self.state, state):
+                setattr(self, name, array)
+        self.t = t
+        return output
+
+    def restart(self, x, rows):
+        """
+        Pass some rows of the new value through, like the slots of a batch of hands given to a new hand, see registry.BatchFilter
+
+        :param x: np.array of the new raw value
+        :param rows: boolean mask, or indices, of the first axis
+        """
+        if self.value is None:
+            return  # the whole value is passed through anyway
+        self.value[rows] = x[rows]
+        self.start_rows(x, rows)
+
+    def start(self, x):
+        # initialize the state from the first value
+        pass
+
+    def start_rows(self, x, rows):
+        # initialize the state of some rows, like start()
+        pass
+
+    def update(self, x, dt):
+        # update self.value in place with the new raw value, dt seconds after the previous one
+        raise NotImplementedError
+
+    def output(self):
+        return self.value
+
+
+class ExponentialFilter(Filter):
+    def __init__(self, alpha=0.5):
+        """
+        :param alpha: weight of the new value, in (0, 1], 1 disables the smoothing
+        """
+        super().__init__()
+        self.alpha = alpha
+
+    def update(self, x, dt):
+        self.value += self.alpha * (x - self.value)
+
+
+class OneEuroFilter(Filter):
+    state = ["value", "previous", "speed"]
+
+    def __init__(self, min_cutoff=1.0, beta=30.0, d_cutoff=1.0):
+        """
+        :param min_cutoff: cutoff frequency when still, in Hz, lower for less jitter
+        :param beta: how fast the cutoff frequency grows with the speed, higher for less lag
+        :param d_cutoff: cutoff frequency of the speed estimation, in Hz
+        """
+        super().__init__()
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.previous = None  # last raw value
+        self.speed = None  # filtered speed of every element
+
+    def start(self, x):
+        self.previous = x.copy()
+        self.speed = np.zeros_like(x)
+
+    def start_rows(self, x, rows):
+        self.previous[rows] = x[rows]
+        self.speed[rows] = 0
+
+    def update(self, x, dt):
+        # smoothing factor of a first order low pass filter with the cutoff frequency, for a time step of dt
+        d_alpha = 1 / (1 + 1 / (2 * math.pi * self.d_cutoff * dt))
+        self.speed += d_alpha * ((x - self.previous) / dt - self.speed)
+        self.previous[:] = x
+
+        cutoff = self.min_cutoff + self.beta * np.abs(self.speed)
+        alpha = 1 / (1 + 1 / (2 * math.pi * dt * cutoff))
+        self.value += alpha * (x - self.value)
+
+
+class KalmanFilter(Filter):
+    # Independent constant velocity model for every element, with white noise acceleration
+    # The state is the position and the velocity, the 2x2 covariance is kept as three arrays (pp, pv, vv)
+    state = ["value", "velocity", "pp", "pv", "vv", "predicted"]
+
+    def __init__(self, process_noise=1.0, measurement_noise=1e-4, lead=0.0):
+        """
+        :param process_noise: variance of the acceleration, higher to follow changes of speed faster
+        :param measurement_noise: variance of the raw values, higher for more smoothing
+        :param lead: predict this many seconds ahead of the last value, like the time until the MCU applies the command
+        """
+        super().__init__()
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.lead = lead
+        self.velocity = None
+        self.pp = self.pv = self.vv = None
+        self.predicted = None
+
+    def start(self, x):
+        self.velocity = np.zeros_like(x)
+        self.pp = np.full_like(x, self.measurement_noise)
+        self.pv = np.zeros_like(x)
+        self.vv = np.full_like(x, 1.0)  # the speed is unknown at first
+        self.predicted = x.copy()
+
+    def start_rows(self, x, rows):
+        self.velocity[rows] = 0
+        self.pp[rows] = self.measurement_noise
+        self.pv[rows] = 0
+        self.vv[rows] = 1.0
+
+    def update(self, x, dt):
+        q = self.process_noise
+        # predict
+        self.value += self.velocity * dt
+        self.pp += dt * (2 * self.pv + dt * self.vv) + q * dt**3 / 3
+        self.pv += dt * self.vv + q * dt**2 / 2
+        self.vv += q * dt
+        # correct
+        gain_p = self.pp / (self.pp + self.measurement_noise)
+        gain_v = self.pv / (self.pp + self.measurement_noise)
+        residual = x - self.value
+        self.value += gain_p * residual
+        self.velocity += gain_v * residual
+        self.vv -= gain_v * self.pv
+        self.pv *= 1 - gain_p
+        self.pp *= 1 - gain_p
+
+    def output(self):
+        if not self.lead:
+            return self.value
+        np.multiply(self.velocity, self.lead, out=self.predicted)
+        self.predicted += self.value
+        return self.predicted
+
+
+# all filters by name
+filters = {
+    "exponential": ExponentialFilter,
+    "one_euro": OneEuroFilter,
+    "kalman": KalmanFilter,
+}
+
+
+def get_filter(name=None, **kwargs):
+    """
+    Construct a filter by name
+
+    :param name: one of filters, None for no filtering
+    :param kwargs: parameters of the filter
+    :return: the filter, or None
+    """
+    if name is None:
+        return None
+    if name not in filters:
+        raise ValueError(f"Filter {name} is not available, available ones: {list(filters)}")
+    return filters[name](**kwargs)
@@ -22,16 +22,74 @@
 
 import math
 import numpy as np
-from log import log
-from hand import Hand
-from cube import HollowCube
-from glumpy import app, gl, glm, gloo, __version__
-from helper import rotate_to_direction, rotate_to_2directions, normalized
-import json
+from log import channel
+from hand import Hand, HandFrame
+from helper import rotate_to_2directions
+from helper import translate, translation, scale  # pure numpy glm, so that we don't depend on glumpy when headless
+
+gesture_log = channel("gesture", rate=2)  # the arm position of the servo parser, on every parse
+
+
+class GestureFeatures:
+    # Everything GestureParser needs from one frame, computed once by GestureParser.features
+    __slots__ = ["palm", "wrist", "palm_normal", "fist", "tip_distances", "hold_distance", "holding", "wrapping"]
+
+    def __init__(self, palm, wrist, palm_normal, fist, tip_distances, hold_distance, holding, wrapping):
+        self.palm = palm  # palm position
+        self.wrist = wrist  # wrist position
+        self.palm_normal = palm_normal  # normal vector of the palm
+        self.fist = fist  # center of the fist, a little bit in front of the palm
+        self.tip_distances = tip_distances  # (5,) distances from every finger tip to the fist, from thumb to pinky
+        self.hold_distance = hold_distance  # root of the summed squared tip distances, the hold metric
+        self.holding = holding  # whether the hand is holding (fist), see fist_threshold
+        self.wrapping = wrapping  # (5,) bool, whether every finger is wrapped around the fist
+
+    def row(self, i):
+        # the features of one hand of a batch, see batch_features
+        return GestureFeatures(self.palm[i], self.wrist[i], self.palm_normal[i], self.fist[i], self.tip_distances[i],
+                               self.hold_distance[i], self.holding[i], self.wrapping[i])
+
+
+def batch_features(pos, palm_normal, fist_threshold=1):
+    """
+    GestureParser.features of a batch of hands at once, like all slots of a registry.HandRegistry
+    Lost hands (all zero) get infinite distances, so nothing is held or wrapped
+
+    :param pos: (H, 28, 3) key points
+    :param palm_normal: (H, 3) palm normals
+    :param fist_threshold: see GestureParser.fist_threshold
+    :return: GestureFeatures, every field with an extra leading axis of H
+    """
+    wrist = pos[:, Hand.arm_pos_names.index("wrist")]
+    palm = pos[:, Hand.arm_pos_names.index("palmPosition")]
+    direction = palm - wrist
+    length = np.sqrt(np.einsum("ij,ij->i", direction, direction))
+    lost = length == 0
+    length[lost] = 1
+    fist = palm + (0.05 / length)[:, None] * direction + 0.35 * palm_normal
+
+    vec = pos[:, GestureParser.tip_slice] - fist[:, None]
+    squared = np.einsum("hij,hij->hi", vec, vec)
+    squared[lost] = np.inf
+    tip_distances = np.sqrt(squared)
+    hold_distance = np.sqrt(squared.sum(axis=1))
+    return GestureFeatures(palm, wrist, palm_normal, fist, tip_distances, hold_distance,
+                           hold_distance < fist_threshold, tip_distances < fist_threshold / 2)
 
 
 class GestureParser:
-    def __init__(self, hand: Hand, direction):
+    # every finger tip (the last key point of a finger) in Hand.pos, from thumb to pinky
+    # all fingers have the same number of key points, so this is a strided slice, giving a view instead of a copy
+    tip_slice = slice(Hand.arm_key_pt_count + len(Hand.finger_pos_names) - 1, None, len(Hand.finger_pos_names))
+
+    def __init__(self, hand: Hand, direction, render=True, keypoint_filter=None, output_filter=None):
+        """
+        :param hand: the Hand to be parsed
+        :param direction: 0 for the servos (arm), 1 for the wheels (voltage)
+        :param render: whether to create the debug cube, False when headless
+        :param keypoint_filter: optional filters.Filter smoothing the key points and the palm normal before parsing
+        :param output_filter: optional filters.Filter smoothing the output before it's quantized into the command
+        """
         self.should_apply_force = False
         self.fist_threshold = 1
 
@@ -40,30 +98,57 @@ class GestureParser:
         self.hand = hand  # store a reference to the hand
         self.base_left = np.array([-0.8, 0.6, .6])  # left palm base position
         self.base_right = np.array([0.8, 0, 0])  # rhgt palm base position
-        self.debug_cube = HollowCube(glm.translation(0, -2, -10), np.eye(4, dtype=np.float32))
+        self.debug_cube = None  # OpenGL cube showing the fist, None when headless
+        if render:
+            from cube import HollowCube  # imports glumpy, only when rendering
+            self.debug_cube = HollowCube(translation(0, -2, -10), np.eye(4, dtype=np.float32))
         self.cube_scale = 2
         self.direction = direction
-    
-    def is_wrap(self, fist, finger):
-        tip = getattr(self.hand, finger)[-1]
-        vec = tip - fist
-        dist = np.sqrt(np.dot(vec, vec))
-        return dist < self.fist_threshold / 2
-    
-    def is_hold(self):
-        palm = self.hand.palm.copy()
-        wrist = self.hand.wrist.copy()
-        palm_normal = self.hand.palm_normal.copy()
-
-        fist = palm + 0.05 * normalized(palm-wrist) + 0.35 * palm_normal
-        dist = 0
-        for finger in self.hand.finger_names:
-            tip = getattr(self.hand, finger)[-1]
-            vec = tip - fist
-            dist += np.dot(vec, vec)
 
-        dist = np.sqrt(dist)
-        return dist < self.fist_threshold
+        # temporal filters, see filters.py
+        self.keypoint_filter = keypoint_filter
+        self.output_filter = output_filter
+        self.filter_input = np.zeros((Hand.key_pt_count + 1, 3), np.float32)  # key points and the palm normal, filtered together
+        self.filtered = HandFrame()  # the filtered frame, private to the parser
+        self.timestamp = 0  # Leap Motion timestamp of the last parsed frame, in microseconds, for measuring the latency
+    
+    def features(self, frame):
+        """
+        The feature stage of the parser, all fingers at once
+        Computes the fist, the tip to fist distances of all five fingers and the hold metric in a few vectorized calls
+        Note: the same as normalized(palm-wrist), but np.linalg.norm costs more than the rest of this function
+
+        :param frame: HandFrame to be parsed, usually a snapshot
+        :return: GestureFeatures
+        """
+        palm = frame.palm
+        wrist = frame.wrist
+        palm_normal = frame.palm_normal
+        direction = palm - wrist
+        length = math.sqrt(direction.dot(direction))
+        if not length:
+            # lost hand (cleaned frame), there's no fist, so nothing is held or wrapped
+            nothing = np.full(len(Hand.finger_names), np.inf)
+            return GestureFeatures(palm, wrist, palm_normal, palm.copy(), nothing, np.inf, False, nothing < 0)
+        fist = palm + (0.05 / length) * direction + 0.35 * palm_normal
+
+        vec = frame.pos[self.tip_slice] - fist
+        squared = np.einsum("ij,ij->i", vec, vec)
+        tip_distances = np.sqrt(squared)
+        hold_distance = math.sqrt(squared.sum())
+        return GestureFeatures(palm, wrist, palm_normal, fist, tip_distances, hold_distance,
+                               hold_distance < self.fist_threshold, tip_distances < self.fist_threshold / 2)
+
+    def is_wrap(self, fist, finger, frame=None):
+        # whether a single finger is wrapped around the fist, parse uses the batched features instead
+        frame = self.hand.frame if frame is None else frame
+        vec = frame.views[finger][-1] - fist
+        return np.sqrt(np.dot(vec, vec)) < self.fist_threshold / 2
+
+    def is_hold(self, frame=None):
+        # whether the hand is holding (fist), parse uses the batched features instead
+        frame = self.hand.frame if frame is None else frame
+        return self.features(frame).holding
 
     # def get_angle(self, vector):                
     #     # [x right, y up, z in]
@@ -72,20 +157,91 @@ class GestureParser:
     #     return [angle_hor, angle_ver]
 
     def parse(self):
-        palm = self.hand.palm.copy()
-        wrist = self.hand.wrist.copy()
-        # elbow = self.hand.elbow.copy()
-        palm_normal = self.hand.palm_normal.copy()
-        fist = palm + 0.05 * normalized(palm-wrist) + 0.35 * palm_normal
+        # parse a snapshot of the latest frame, it can't change under us and doesn't need to be copied
+        with self.hand.snapshot() as frame:
+            return self.parse_frame(frame)
+
+    def reset_filters(self):
+        # forget the filter states, the next frame is parsed as is
+        for f in (self.keypoint_filter, self.output_filter):
+            if f is not None:
+                f.reset()
+
+    def filter_frame(self, frame):
+        """
+        Smooth all key points and the palm normal of a frame with the keypoint filter, in one call
+
+        :param frame: HandFrame to be filtered, it's not modified
+        :return: HandFrame of the filtered values, owned by the parser and overwritten by the next call
+        """
+        t = frame.timestamp * 1e-6  # Leap Motion timestamp is in microseconds
+        stacked = self.filter_input
+        stacked[:-1] = frame.pos
+        stacked[-1] = frame.palm_normal
+        stacked = self.keypoint_filter(stacked, t)
+
+        filtered = self.filtered
+        filtered.pos[:] = stacked[:-1]
+        normal = stacked[-1]
+        filtered.palm_normal[:] = normal / (math.sqrt(normal.dot(normal)) or 1)  # averaged unit vectors are shorter
+        filtered.timestamp = frame.timestamp
+        return filtered
+
+    def filter_output(self, value, frame):
+        """
+        Smooth the output with the output filter, if any
+
+        :param value: np.array of the raw output
+        :param frame: HandFrame the output is computed from, for its time
+        :return: np.array of the filtered output, a copy that can be modified
+        """
+        if self.output_filter is None:
+            return value
+        return self.output_filter(value, frame.timestamp * 1e-6).copy()
+
+    def parse_frame(self, frame):
+        self.timestamp = frame.timestamp
+        if not frame.pos.any():
+            # the hand is lost (cleaned frame), don't smooth into or out of the all zero frame
+            self.reset_filters()
+        elif self.keypoint_filter is not None:
+            frame = self.filter_frame(frame)
+        return self.parse_features(frame, self.features(frame))
+
+    def parse_batch(self, pos, palm_normal, timestamp, features=None):
+        """
+        Parse one hand of a batch, already filtered by registry.BatchFilter, the keypoint filter of the parser isn't used
+
+        :param pos: (28, 3) filtered key points, None (or all zero) for a lost hand
+        :param palm_normal: (3,) filtered palm normal
+        :param timestamp: Leap Motion timestamp of the hand, in microseconds
+        :param features: its row of gesture.batch_features, None to compute them here
+        """
+        frame = self.filtered
+        if pos is None:
+            frame.pos[:] = 0  # keeping the last palm normal, like Hand.clean
+        else:
+            frame.pos[:] = pos
+            frame.palm_normal[:] = palm_normal
+        frame.timestamp = timestamp
+        self.timestamp = timestamp
+        if not frame.pos.any():
+            self.reset_filters()
+        return self.parse_features(frame, self.features(frame) if features is None else features)
+
+    def parse_features(self, frame, features):
+        # the features are computed once, and consumed by both branches below
+        palm = features.palm
+        wrist = features.wrist
+        # elbow = frame.elbow
+        palm_normal = features.palm_normal
+        fist = features.fist
 
         # arm_direction = wrist - elbow 
         #[angle_hor, angle_ver] = self.get_angle(arm_direction)
-        palm_normal = self.hand.palm_normal.copy()
         
-        holding = self.is_hold()
-        is_wrap = []
-        for finger in self.hand.finger_names:
-            is_wrap.append(self.is_wrap(fist, finger))
+        holding = features.holding
+        is_wrap = features.wrapping
 
         msg = {}
         if self.direction == 1 :
@@ -104,14 +260,16 @@ class GestureParser:
                 force[1] *= -1
                 cube_scale *= 1.5
                 # log.info(f"Adding force: {force}")
+            force = self.filter_output(force, frame)  # also filtered while not holding, so that the force ramps up and down
             # else:
             #     self.base = palm
 
-            m = rotate_to_2directions(np.eye(4, dtype=np.float32), palm_normal, palm-wrist)
-            m = glm.scale(m, cube_scale, cube_scale, cube_scale)
-            m = glm.translate(m, *fist)
-            # log.info(f"New transformation:\n{m}")
-            self.debug_cube.transform = m
+            if self.debug_cube is not None:
+                m = rotate_to_2directions(np.eye(4, dtype=np.float32), palm_normal, palm-wrist)
+                m = scale(m, cube_scale, cube_scale, cube_scale)
+                m = translate(m, *fist)
+                # log.info(f"New transformation:\n{m}")
+                self.debug_cube.transform = m
 
             # remapping of force to wheel voltage
             # ! Assuming Arduino.h: LOW 0x0, HIGH 0x1
@@ -177,17 +335,15 @@ class GestureParser:
             # y -> 上臂
             # z -> 下臂
 
-            dis_pos = (palm - self.base_left)[[1, 2]]
+            dis_pos = self.filter_output((palm - self.base_left)[[1, 2]], frame)
 
-            print(dis_pos)
+            raw_pos = dis_pos.copy()  # formatted later by the log writer, after dis_pos is clamped in place
             dis_pos[1] = max(-1.5, min(0.6, dis_pos[1]))
             dis_pos[0] = max(0.6, min(3.3, dis_pos[0]))
             msg["angle2"] = 10 + round((100 - 10) * (dis_pos[0] / (3.3 - 0.6)))
             msg["angle1"] = 40 + round((120 - 40) * (dis_pos[1] / (-1.5)))
 
-            print(dis_pos)
-            print(msg["angle2"])
-            print(msg["angle1"])
+            gesture_log.info("Arm position: %s, clamped: %s, angle2: %d, angle1: %d", raw_pos, dis_pos, msg["angle2"], msg["angle1"])
 
             msggg = [msg["angle0"], msg["angle1"], msg["angle2"], msg["angle3"]]
             # 底部舵机是否左右转
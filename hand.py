@@ -23,52 +23,79 @@
 # Actual Core of the Leap Motion Python Driver (based on WebSocket)
 # It contains compact information about the hand recognized from the Leap Motion Controller
 # And it also manages the "HollowCube"s to be rendered on the screen for some debugging
+# Pass render=False to skip all OpenGL objects, glumpy is then never imported (headless mode)
+# The positions live in HandFrame objects exchanged through a FrameExchange: the sampler claims a frame, fills it and publishes it,
+# readers (renderer, parser) take a snapshot of the latest complete frame, so that they never see half of one frame and half of the next
 # Note that you can print information about a specific hand by just printing the str of it, like `str(hand)` or just print(hand)
 
-from glumpy import app, gl, glm, gloo, __version__
-from cube import HollowCube
 import numpy as np
 import json
-import time
-from helper import rotate_to_direction  # helper function to construct transformation
+from helper import rotate_to_direction, scaled_translations, bone_transforms  # helper function to construct transformation
+from helper import translate, translation, scale  # pure numpy glm, so that we don't depend on glumpy when headless
+from history import HandHistory  # bounded ring buffer of past frames
+from exchange import FrameExchange  # latest-frame-wins exchange between the sampler and the readers
 
 
 class Hand:
-    def __init__(self):
-
-        # ! Actual init definitions, want more bones? Add them here
-        # the names of the fingers, with order
-        # Note: for both fingers and arms, the joints all starts from your heart and goes to your tips, for example, with arm, the first element is the cloest to your heart, which is the elbow, then wrist, then plam
-        self.finger_names = ["thumb", "index", "middle", "ring", "pinky"]
-        self.arm_names = ["arm"]
-        # all components of a hand, including arm, fingers
-        self.component_names = self.arm_names + self.finger_names
-        # Leap Motion subscription of arm keypoints
-        self.arm_pos_names = ["elbow", "wrist", "palmPosition"]
-        # Leap Motion subscription of finger keypoints
-        # metacarpal, proximal, middle, distal
-        self.finger_pos_names = ["carpPosition", "mcpPosition", "pipPosition", "dipPosition", "btipPosition"]
-
-        # ! Derived information from the above definitions
-        self.name_to_pos_names = {**{name: self.arm_pos_names for name in self.arm_names}, **{name: self.finger_pos_names for name in self.finger_names}}
-        # number of key points of the fingers
-        self.finger_key_pt_count = len(self.finger_pos_names) * len(self.finger_names)
-        # number of key points of the arm
-        self.arm_key_pt_count = len(self.arm_pos_names)
-        # mapper from all finger names and "arm" to their index in the position list
-        self.name_to_index = {}
-        arm_name_count = len(self.arm_pos_names)
-        finger_name_count = len(self.finger_pos_names)
-        index = 0
-        self.name_to_index["arm"] = [index, index+arm_name_count]
-        index += arm_name_count
-        for name in self.finger_names:
-            self.name_to_index[name] = [index, index+finger_name_count]
-            index += finger_name_count
+    # ! Actual init definitions, want more bones? Add them here
+    # these are shared by all hands, so they live on the class instead of every instance
+    # the names of the fingers, with order
+    # Note: for both fingers and arms, the joints all starts from your heart and goes to your tips, for example, with arm, the first element is the cloest to your heart, which is the elbow, then wrist, then plam
+    finger_names = ["thumb", "index", "middle", "ring", "pinky"]
+    arm_names = ["arm"]
+    # all components of a hand, including arm, fingers
+    component_names = arm_names + finger_names
+    # Leap Motion subscription of arm keypoints
+    arm_pos_names = ["elbow", "wrist", "palmPosition"]
+    # Leap Motion subscription of finger keypoints
+    # metacarpal, proximal, middle, distal
+    finger_pos_names = ["carpPosition", "mcpPosition", "pipPosition", "dipPosition", "btipPosition"]
+
+    # ! Derived information from the above definitions
+    name_to_pos_names = {**dict.fromkeys(arm_names, arm_pos_names), **dict.fromkeys(finger_names, finger_pos_names)}
+    # number of key points of the fingers
+    finger_key_pt_count = len(finger_pos_names) * len(finger_names)
+    # number of key points of the arm
+    arm_key_pt_count = len(arm_pos_names)
+    # number of key points of the whole hand
+    key_pt_count = finger_key_pt_count + arm_key_pt_count
+    # mapper from all finger names and "arm" to their index in the position list
+    name_to_index = {}
+    # key point index of the start and the end of every bone, every component connects its key points in order
+    bone_starts = []
+    bone_ends = []
+    index = 0
+    for name in component_names:
+        name_to_index[name] = [index, index+len(name_to_pos_names[name])]
+        index += len(name_to_pos_names[name])
+        bone_starts += range(name_to_index[name][0], index-1)
+        bone_ends += range(name_to_index[name][0]+1, index)
+    del index, name
+    bone_starts = np.array(bone_starts)
+    bone_ends = np.array(bone_ends)
+    # whether a key point / bone belongs to the arm (arm is the first component), they are not scaled like fingers
+    key_is_arm = np.arange(key_pt_count) < arm_key_pt_count
+    bone_is_arm = bone_starts < arm_key_pt_count
+    # number of bones of the whole hand
+    bone_count = len(bone_starts)
+
+    # ! Per instance storage, no __dict__ to keep attribute access fast and the object compact
+    __slots__ = [
+        "u_view", "finger_scale", "bone_scale", "show_type",  # OpenGL controls
+        "cubes", "key_model", "bone_model", "transforms",  # OpenGL objects
+        "exchange", "history",  # bare metal data
+    ]
+
+    def __init__(self, history_capacity=1024, render=True, frame_count=4):
+        """
+        :param history_capacity: number of frames remembered in the history
+        :param render: whether to create the OpenGL objects, False when headless
+        :param frame_count: initial number of frames in the exchange, 1 written + 1 latest + 1 per concurrent reader
+        """
 
         # ! OpenGL controls
         # global camera view transformation
-        self.u_view = glm.translation(0, -2, -10)
+        self.u_view = translation(0, -2, -10)
         # global finger key point scale relative to arm
         self.finger_scale = 0.5
         # global bones scale relative to finger
@@ -76,45 +103,99 @@ class Hand:
         # show_type: 1: only joints, 2: joints + bones, 0: bones
         self.show_type = 0
 
-        # OpenGL objects
-        # actual OpenGL object wrapper of all key points, reused
-        self.key_point = HollowCube(self.u_view, np.eye(4, dtype=np.float32))
-        self.bone = HollowCube(self.u_view, np.eye(4, dtype=np.float32))
+        # OpenGL objects, None when headless
+        # actual OpenGL object wrapper of all key points and bones, drawn with one call per frame
+        self.cubes = None
+        if render:
+            from cube import InstancedHollowCube  # imports glumpy, only when rendering
+            self.cubes = InstancedHollowCube(self.u_view, self.key_pt_count + self.bone_count)
+        # model matrices of the key points and the bones, multiplied into every instance transformation
+        cube_scale = 0.1 if self.cubes is None else self.cubes.global_scale
+        self.key_model = scale(np.eye(4, dtype=np.float32), cube_scale, cube_scale, cube_scale)
+        self.bone_model = scale(np.eye(4, dtype=np.float32), cube_scale, cube_scale, cube_scale)
+        # staging array of the instance transformations, filled on every draw
+        self.transforms = np.zeros((self.key_pt_count + self.bone_count, 4, 4), np.float32)
 
         # ! Actual bare metal data
-        # keypoint position list, queried every frame update for new keypoint position
-        # websockt process should update this list instead of the raw OpenGL obj
-        self.pos = np.array([np.zeros(3, np.float32) for _ in range(self.finger_key_pt_count+self.arm_key_pt_count)])
-        # Extra information to be remembered in the history
-        # The normal vector of the palm
-        self.palm_normal = np.zeros(3, np.float32)
-        # timestamp
-        self.timestamp = 256101634501  # currently not used in parsing
+        # keypoint positions of the hand, one HandFrame per published frame
+        # websockt process should claim a frame, fill it and publish it, instead of updating the raw OpenGL obj
+        self.exchange = FrameExchange(HandFrame, frame_count)
 
-        # ! History list
+        # ! History ring buffer
         # empty gesture history, updated withe new infromation from the above mentioned data
-        self.history = []
+        # bounded by history_capacity frames, older ones are overwritten
+        self.history = HandHistory(history_capacity, self.key_pt_count)
+
+    # ! Frame exchange, see exchange.py
+    def claim(self):
+        """
+        Get a free frame for the sampler to fill, readers won't see it until it's published
+
+        :return: HandFrame, its content is some older frame, overwrite all of it
+        """
+        return self.exchange.claim()
+
+    def publish(self, history=True):
+        """
+        Make the claimed frame the latest one
 
+        :param history: whether to append the frame to the history
+        :return: the published HandFrame
+        """
+        frame = self.exchange.publish()
+        if history:
+            self.history.append(frame.pos, frame.timestamp, frame.palm_normal)
+        return frame
+
+    def snapshot(self):
+        """
+        Pin the latest complete frame, use it like `with hand.snapshot() as frame: frame.palm`
+        The frame won't change until the with block is left, no copy is made
+
+        :return: context manager handing out the HandFrame
+        """
+        return self.exchange.snapshot()
+
+    # ! Convenient properties to access the latest frame
+    # these peek at the latest frame without pinning it, fine for the interactive shell or a single read
+    # use snapshot() when reading more than one thing, or the values might come from different frames
+    @property
+    def frame(self):
+        return self.exchange.latest_frame
+
+    @property
+    def pos(self):
+        return self.exchange.latest_frame.pos
+
+    @property
+    def palm_normal(self):
+        return self.exchange.latest_frame.palm_normal
+
+    @property
+    def timestamp(self):
+        return self.exchange.latest_frame.timestamp
+
+    @property
+    def views(self):
+        return self.exchange.latest_frame.views
 
-    # ! Convenient properties to access the hand structure
-    # TODO: find a way to optimize this implementation
-    # getter and setter logic already extracted
-    # Note: tried to use "inspect" package, too slow
     @property
     def palm(self):
-        return self.arm[2]
+        return self.exchange.latest_frame.palm
 
     @property
     def wrist(self):
-        return self.arm[1]
+        return self.exchange.latest_frame.wrist
 
     @property
     def elbow(self):
-        return self.arm[0]
+        return self.exchange.latest_frame.elbow
 
+    # every setter publishes a new frame, copied from the latest one with one component changed
+    # the setter thread claims a frame of its own (see exchange.py), so it's safe while the sampler is filling one
     @property
     def arm(self):
-        return self.getter("arm")
+        return self.exchange.latest_frame.arm
 
     @arm.setter
     def arm(self, value):
@@ -122,7 +203,7 @@ class Hand:
 
     @property
     def thumb(self):
-        return self.getter("thumb")
+        return self.exchange.latest_frame.thumb
 
     @thumb.setter
     def thumb(self, value):
@@ -130,7 +211,7 @@ class Hand:
 
     @property
     def index(self):
-        return self.getter("index")
+        return self.exchange.latest_frame.index
 
     @index.setter
     def index(self, value):
@@ -138,7 +219,7 @@ class Hand:
 
     @property
     def middle(self):
-        return self.getter("middle")
+        return self.exchange.latest_frame.middle
 
     @middle.setter
     def middle(self, value):
@@ -146,7 +227,7 @@ class Hand:
 
     @property
     def ring(self):
-        return self.getter("ring")
+        return self.exchange.latest_frame.ring
 
     @ring.setter
     def ring(self, value):
@@ -154,7 +235,7 @@ class Hand:
 
     @property
     def pinky(self):
-        return self.getter("pinky")
+        return self.exchange.latest_frame.pinky
 
     @pinky.setter
     def pinky(self, value):
@@ -173,23 +254,27 @@ class Hand:
     def getter(self, caller):
         """
         Get the position of the corresponding component
-        This should be called by the above @property stuff
+        Kept for looking up a component by name, the properties above skip this
 
         :param caller: caller name, defined in self.component_names
         :return: np.array of positions, with order
         """
-        return self.position(*self.name_to_index[caller])
+        return self.views[caller]
 
     def setter(self, value, caller):
         """
         Set the position of the corresponding component
-        This should be called by the above @property stuff
+        Publishes a copy of the latest frame with the component replaced, the history is not updated
+        Note: for updating a whole frame, claim and publish it directly instead
 
         :param value: np.array of the new positions to be updated, with order
         :param caller: caller name, defined in self.component_names
         """
-        for p, i in enumerate(range(*self.name_to_index[caller])):
-            self.pos[i] = value[p]
+        frame = self.claim()
+        with self.exchange.snapshot() as latest:  # pinned, the sampler can't reuse it while it's copied
+            frame.copy_from(latest)
+        frame.views[caller][:] = value
+        self.publish(history=False)
 
     def get_key_point_transform(self, position, caller):
         """
@@ -200,9 +285,9 @@ class Hand:
         :param caller: caller name, defined in self.component_names
         """
         if caller == "arm":
-            return glm.translation(*position)
+            return translation(*position)
         else:
-            return glm.translate(glm.scale(np.eye(4, dtype=np.float32), self.finger_scale, self.finger_scale, self.finger_scale), *position)
+            return translate(scale(np.eye(4, dtype=np.float32), self.finger_scale, self.finger_scale, self.finger_scale), *position)
 
     def get_bone_transform(self, start, end, compensation_cube_scale, caller):
         """
@@ -221,44 +306,71 @@ class Hand:
         bone_scale = self.bone_scale * finger_scale
 
         direction = end-start
-        m = glm.scale(np.eye(4, dtype=np.float32), bone_scale, 1/compensation_cube_scale/2 * np.linalg.norm(direction), bone_scale)  # scale down a little bit
+        m = scale(np.eye(4, dtype=np.float32), bone_scale, 1/compensation_cube_scale/2 * np.linalg.norm(direction), bone_scale)  # scale down a little bit
         m = rotate_to_direction(m, direction)
-        m = glm.translate(m, *((start+end)/2))  # to middle point
+        m = translate(m, *((start+end)/2))  # to middle point
         return m
 
+    def get_key_point_transforms(self, out=None, pos=None):
+        """
+        Batched get_key_point_transform of all key points, in the order of self.pos
+
+        :param out: optional (key_pt_count, 4, 4) array to be filled
+        :param pos: key point positions, default to the latest frame
+        :return: (key_pt_count, 4, 4) np.array of transformations
+        """
+        pos = self.pos if pos is None else pos
+        scales = np.where(self.key_is_arm, 1, self.finger_scale)
+        return scaled_translations(pos, scales[:, None], out)
+
+    def get_bone_transforms(self, compensation_cube_scale, out=None, pos=None):
+        """
+        Batched get_bone_transform of all bones, in the order of bone_starts
+
+        :param compensation_cube_scale: the OpenGL cube scale, to compasate for transformation
+        :param out: optional (bone_count, 4, 4) array to be filled
+        :param pos: key point positions, default to the latest frame
+        :return: (bone_count, 4, 4) np.array of transformations
+        """
+        pos = self.pos if pos is None else pos
+        widths = self.bone_scale * np.where(self.bone_is_arm, 1, self.finger_scale)
+        return bone_transforms(pos[self.bone_starts], pos[self.bone_ends], widths, compensation_cube_scale, out)
+
     def draw(self):
         """
         Draw the hand in app event loop
+        All key points and bones are uploaded as one instance buffer and drawn with a single call
         """
-        c = self.key_point
-        b = self.bone
-        for i, name in enumerate(self.component_names):
-            positions = getattr(self, name)
-            show_bone = self.show_type == 0 or self.show_type == 2
-            show_key = self.show_type == 1 or self.show_type == 2
+        show_bone = self.show_type == 0 or self.show_type == 2
+        show_key = self.show_type == 1 or self.show_type == 2
+        transforms = self.transforms
+        count = 0
+        with self.snapshot() as frame:
             if show_bone:
-                for i in range(len(positions)-1):
-                    # iterate through all positions except last
-                    start = positions[i]
-                    end = positions[i+1]
-                    b.transform = self.get_bone_transform(start, end, b.global_scale, name)
-                    b.draw()
+                count += self.bone_count
+                self.get_bone_transforms(self.cubes.global_scale, transforms[:count], frame.pos)
+            bones = count
             if show_key:
-                for v in positions:
-                    c.transform = self.get_key_point_transform(v, name)
-                    c.draw()
+                count += self.key_pt_count
+                self.get_key_point_transforms(transforms[bones:count], frame.pos)
+
+        # apply the model matrix first, like u_transform * u_model in the shader of HollowCube
+        np.matmul(self.bone_model, transforms[:bones], out=transforms[:bones])
+        np.matmul(self.key_model, transforms[bones:count], out=transforms[bones:count])
+        self.cubes.update(transforms[:count])
+        self.cubes.draw()
 
     def resize(self, width, height):
         """
         Resize according to window size
         """
-        self.key_point.resize(width, height)
-        self.bone.resize(width, height)
+        self.cubes.resize(width, height)
 
     def store_pos(self, leap_json, index):
         """
         Update pos list by Leap Motion Websocket json object
         Extract hand #index in the json obj and their corresponding pointables
+        Note: the sampler uses decoder.FrameDecoder to update all hands at once, this is for a single hand
 
         :param leap_json: raw json from Leap Motion Websocket
         "param index": hand #index in the json obj
@@ -269,46 +381,50 @@ class Hand:
         hand_id = hand_json["id"]
         if hand_json["confidence"] < 0.7:
             return
-        pointables = [p for p in leap_json["pointables"] if p["handId"] == hand_id]
-        pointables = sorted(pointables, key=lambda x: x["type"])  # from thumb to pinky
-        assert len(pointables) == len(self.finger_names)
+        # bucket the pointables of this hand by their type, from thumb to pinky
+        pointables = [None] * len(self.finger_names)
+        for p in leap_json["pointables"]:
+            if p["handId"] == hand_id:
+                pointables[p["type"]] = p
+        assert None not in pointables
 
         # log.info(f"Getting hand_json: {hand_json}")
         # log.info(f"Getting sorted pointables: {pointables}")
 
-        self.timestamp = leap_json["timestamp"]
-        self.palm_normal = np.array(hand_json["palmNormal"])
-
-        arm = np.array([hand_json[name] for name in self.arm_pos_names]) / 100
-        self.arm = arm
-        for i, name in enumerate(self.finger_names):
-
-            time.sleep(0)
-            finger_json = pointables[i]
-            finger = np.array([finger_json[name] for name in self.finger_pos_names]) / 100
+        frame = self.claim()
+        frame.timestamp = leap_json["timestamp"]
+        frame.palm_normal[:] = hand_json["palmNormal"]
 
-            setattr(self, name, finger)
+        # gather all key points in the order of self.pos, then scale them into the claimed frame
+        rows = [hand_json[name] for name in self.arm_pos_names]
+        rows += [finger_json[name] for finger_json in pointables for name in self.finger_pos_names]
+        np.multiply(rows, 1/100, out=frame.pos)
 
-        self.update_history()
+        self.publish()
 
     def clean(self):
-        self.pos = np.zeros_like(self.pos)
+        # publish an all zero frame, keeping the palm normal and the timestamp of the latest one
+        with self.exchange.snapshot() as latest:  # pinned, a setter thread can't reuse it meanwhile
+            if not latest.pos.any():
+                return  # already clean, nothing new for the readers
+            frame = self.claim()
+            frame.pos[:] = 0
+            frame.palm_normal[:] = latest.palm_normal
+            frame.timestamp = latest.timestamp
+        self.publish(history=False)
 
     def update_history(self):
-        self.history.append(
-            {
-                "pos": self.pos,
-                "timestamp": self.timestamp,
-                "palm_normal": self.palm_normal
-            }
-        )
+        # append the latest frame to the history again, publish already does this for new frames
+        with self.exchange.snapshot() as frame:
+            self.history.append(frame.pos, frame.timestamp, frame.palm_normal)
 
     @property
     def formatted_data(self):
         # you can surely guess what this does from the name
-        obj = {name: {n: v.tolist() for n, v in zip(self.name_to_pos_names[name], getattr(self, name))} for name in self.component_names}
-        obj["timestamp"] = self.timestamp
-        obj["palm_normal"] = self.palm_normal.tolist()
+        with self.snapshot() as frame:
+            obj = {name: {n: v.tolist() for n, v in zip(self.name_to_pos_names[name], frame.views[name])} for name in self.component_names}
+            obj["timestamp"] = frame.timestamp
+            obj["palm_normal"] = frame.palm_normal.tolist()
         return obj
 
     def __str__(self):
@@ -316,3 +432,76 @@ class Hand:
 
     def __repr__(self):
         return json.dumps(self.formatted_data)
+
+
+class HandFrame:
+    # One complete frame of a hand, exchanged between the sampler and the readers by Hand.exchange
+    # Every instance has its own arrays and views, they are never rebound, only filled in place
+    __slots__ = [
+        "pos", "palm_normal", "timestamp",  # bare metal data
+        "views", "_arm", "_thumb", "_index", "_middle", "_ring", "_pinky", "_elbow", "_wrist", "_palm",  # cached views into pos
+    ]
+
+    def __init__(self):
+        # keypoint position array, in the order of Hand.component_names
+        self.pos = np.zeros((Hand.key_pt_count, 3), np.float32)
+        # Extra information to be remembered in the history
+        # The normal vector of the palm
+        self.palm_normal = np.zeros(3, np.float32)
+        # timestamp
+        self.timestamp = 256101634501  # currently not used in parsing
+
+        # ! Cached views of every component, computed once
+        self.views = {name: self.pos[slice(*Hand.name_to_index[name])] for name in Hand.component_names}
+        self._arm = self.views["arm"]
+        self._thumb = self.views["thumb"]
+        self._index = self.views["index"]
+        self._middle = self.views["middle"]
+        self._ring = self.views["ring"]
+        self._pinky = self.views["pinky"]
+        self._elbow = self._arm[0]
+        self._wrist = self._arm[1]
+        self._palm = self._arm[2]
+
+    def copy_from(self, other):
+        # fill this frame with the content of another one
+        self.pos[:] = other.pos
+        self.palm_normal[:] = other.palm_normal
+        self.timestamp = other.timestamp
+
+    # ! Convenient properties to access the hand structure, every getter returns a cached view into self.pos
+    @property
+    def palm(self):
+        return self._palm
+
+    @property
+    def wrist(self):
+        return self._wrist
+
+    @property
+    def elbow(self):
+        return self._elbow
+
+    @property
+    def arm(self):
+        return self._arm
+
+    @property
+    def thumb(self):
+        return self._thumb
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def middle(self):
+        return self._middle
+
+    @property
+    def ring(self):
+        return self._ring
+
+    @property
+    def pinky(self):
+        return self._pinky
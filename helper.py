@@ -1,9 +1,35 @@
 import numpy as np
 
 
+# ! Pure numpy versions of the `glm` functions we use, so that the driver runs without glumpy (headless)
+# they behave exactly like their glumpy counterparts, modifying the input matrix in place and returning it
+
+
+def translate(m, x, y=None, z=None):
+    y = x if y is None else y
+    z = x if z is None else z
+    t = np.eye(4, dtype=m.dtype)
+    t[3, :3] = x, y, z  # transposed style, translation in the last row
+    m[...] = np.dot(m, t)
+    return m
+
+
+def translation(x, y=None, z=None):
+    return translate(np.eye(4, dtype=np.float32), x, y, z)
+
+
+def scale(m, x, y=None, z=None):
+    y = x if y is None else y
+    z = x if z is None else z
+    s = np.diag(np.array([x, y, z, 1], dtype=m.dtype))
+    m[...] = np.dot(m, s)
+    return m
+
+
 def normalized(x):
     # return the normalized unit vector in the direction of the input vector
-    return x / np.linalg.norm(x)
+    # works on a single vector or on a (N, 3) batch of them
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
 
 
 def rotate_to_direction(m, direction):
@@ -47,3 +73,103 @@ def rotate_to_2directions(m, d1, d2):
     r[:3, 2] = new_z
     m = np.dot(m, r.T)  # transposed
     return m
+
+
+# ! Batched variants of the above, operating on (N, 3) arrays of vectors and returning (N, 4, 4) matrices
+# all of them are in the same transposed OpenGL style as `glm`, the translation lives in the last row
+
+
+def cross(a, b):
+    # row-wise cross product of two (N, 3) arrays, np.cross is much slower on small batches
+    ax, ay, az = a[:, 0], a[:, 1], a[:, 2]
+    bx, by, bz = b[:, 0], b[:, 1], b[:, 2]
+    return np.stack([ay*bz - az*by, az*bx - ax*bz, ax*by - ay*bx], axis=-1)
+
+
+def rotations_to_direction(directions):
+    # the rotation part of rotate_to_direction for a batch of directions, already transposed
+    # including the special case of a direction (anti)parallel to the y axis
+    directions = np.asarray(directions, dtype=np.float32)
+    r = np.zeros((len(directions), 4, 4), dtype=np.float32)
+    r[:, 3, 3] = 1
+
+    with np.errstate(invalid="ignore", divide="ignore"):  # the vertical ones are replaced below
+        new_y = normalized(directions)
+        # cross(new_y, [0, 1, 0])
+        new_z = normalized(np.stack([-new_y[:, 2], np.zeros(len(new_y), np.float32), new_y[:, 0]], axis=-1))
+        new_x = normalized(cross(new_y, new_z))
+    r[:, 0, :3] = new_x  # rows of r.T are the columns of r
+    r[:, 1, :3] = new_y
+    r[:, 2, :3] = new_z
+
+    vertical = (directions[:, 0] == 0) & (directions[:, 2] == 0)
+    if vertical.any():
+        flip = np.where(directions[vertical, 1] < 0, -1, 1)
+        r[vertical, :3, :3] = np.eye(3, dtype=np.float32)
+        r[vertical, 0, 0] = flip
+        r[vertical, 1, 1] = flip
+    return r
+
+
+def rotate_to_direction_batch(m, directions):
+    # rotate_to_direction for a batch of directions
+    # m can be a single (4, 4) matrix shared by all directions or a (N, 4, 4) batch
+    return np.matmul(m, rotations_to_direction(directions))
+
+
+def rotate_to_2directions_batch(m, d1, d2):
+    # rotate_to_2directions for a batch of direction pairs
+    # m can be a single (4, 4) matrix shared by all directions or a (N, 4, 4) batch
+    d1 = np.asarray(d1, dtype=np.float32)
+    d2 = np.asarray(d2, dtype=np.float32)
+    r = np.zeros((len(d1), 4, 4), dtype=np.float32)
+    r[:, 3, 3] = 1
+    r[:, 0, :3] = normalized(cross(d1, d2))
+    r[:, 1, :3] = normalized(d1)
+    r[:, 2, :3] = normalized(d2)
+    return np.matmul(m, r)
+
+
+def scaled_translations(positions, scales, out=None):
+    """
+    Batched glm.translate(glm.scale(np.eye(4), *scale), *position)
+
+    :param positions: (N, 3) array of translations
+    :param scales: (N, 3) or (N, 1) array of scales along the axes, or a scalar
+    :param out: optional (N, 4, 4) array to be filled
+    :return: (N, 4, 4) array of transformations
+    """
+    m = np.zeros((len(positions), 4, 4), dtype=np.float32) if out is None else out
+    if out is not None:
+        m[...] = 0
+    axes = np.arange(3)
+    m[:, axes, axes] = np.reshape(scales, (len(positions), -1))
+    m[:, 3, :3] = positions
+    m[:, 3, 3] = 1
+    return m
+
+
+def bone_transforms(starts, ends, widths, compensation_cube_scale, out=None):
+    """
+    Batched transformation of cubes stretched from starts to ends, see Hand.get_bone_transform
+    Equal to scale(width, length/scale/2, width) -> rotate_to_direction(end - start) -> translate((start + end) / 2)
+
+    :param starts: (N, 3) array of starting points
+    :param ends: (N, 3) array of ending points
+    :param widths: (N,) array of the bone widths, or a scalar
+    :param compensation_cube_scale: the OpenGL cube scale, to compasate for transformation
+    :param out: optional (N, 4, 4) array to be filled
+    :return: (N, 4, 4) array of transformations
+    """
+    directions = ends - starts
+    lengths = np.linalg.norm(directions, axis=-1) / compensation_cube_scale / 2
+    r = rotations_to_direction(directions)
+    # the scale is diagonal, so it just scales the rows of the rotation
+    r[:, 0, :3] *= np.reshape(widths, (-1, 1))
+    r[:, 1, :3] *= lengths[:, None]
+    r[:, 2, :3] *= np.reshape(widths, (-1, 1))
+    r[:, 3, :3] = (starts + ends) / 2  # to middle point
+    if out is not None:
+        out[...] = r
+        return out
+    return r
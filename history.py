@@ -0,0 +1,87 @@
+# Bounded gesture history for the Hand object
+# Stores the last `capacity` frames of key point positions, timestamps and palm normals
+# in preallocated NumPy arrays, so a long running session never grows in memory
+# Note: every frame is written twice (at i and i+capacity), so that any "last k frames" window
+# is always a contiguous slice of the underlying storage, and can be returned as a view without copying
+
+import numpy as np
+
+
+class HandHistory:
+    def __init__(self, capacity=1024, key_pt_count=28):
+        """
+        :param capacity: max number of frames remembered, older frames are overwritten
+        :param key_pt_count: number of key points stored per frame
+        """
+        assert capacity > 0
+        self.capacity = capacity
+        # mirrored storage, see the note at the top of this file
+        self.pos = np.zeros((2*capacity, key_pt_count, 3), np.float32)
+        self.timestamp = np.zeros(2*capacity, np.int64)  # Leap Motion timestamp, in microseconds
+        self.palm_normal = np.zeros((2*capacity, 3), np.float32)
+
+        self.head = 0  # next index to write, in [0, capacity)
+        self.count = 0  # number of valid frames, saturates at capacity
+
+    def __len__(self):
+        return self.count
+
+    def append(self, pos, timestamp, palm_normal):
+        """
+        Copy one frame into the history, O(1) and allocation free
+
+        :param pos: (key_pt_count, 3) np.array of key point positions
+        :param timestamp: Leap Motion timestamp of the frame
+        :param palm_normal: len 3 np.array of the palm normal
+        """
+        i = self.head
+        j = i + self.capacity
+        self.pos[i] = pos
+        self.pos[j] = pos
+        self.timestamp[i] = self.timestamp[j] = timestamp
+        self.palm_normal[i] = palm_normal
+        self.palm_normal[j] = palm_normal
+
+        self.head = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def window(self, k=None):
+        """
+        Zero-copy views of the last k frames, oldest first
+        The views stay intact for (capacity - k) more appends, copy them if you want to keep them longer
+
+        :param k: number of frames, default to all remembered frames
+        :return: tuple of (pos (k, key_pt_count, 3), timestamp (k,), palm_normal (k, 3))
+        """
+        k = self.count if k is None else min(k, self.count)
+        end = self.head + self.capacity
+        s = slice(end - k, end)
+        return self.pos[s], self.timestamp[s], self.palm_normal[s]
+
+    def last(self, k=1):
+        # positions of the last k frames, oldest first
+        return self.window(k)[0]
+
+    @property
+    def latest(self):
+        # positions of the most recent frame, None if nothing has been recorded
+        if self.count == 0:
+            return None
+        return self.pos[self.head + self.capacity - 1]
+
+    def velocity(self, k=2):
+        """
+        Average velocity of every key point over the last k frames
+        In units of position per second (Leap Motion timestamp is in microseconds)
+
+        :param k: number of frames to look back, at least 2
+        :return: (key_pt_count, 3) np.array, zeros if there isn't enough history
+        """
+        pos, timestamp, _ = self.window(max(k, 2))
+        if len(pos) < 2 or timestamp[-1] == timestamp[0]:
+            return np.zeros(pos.shape[1:], np.float32)
+        return (pos[-1] - pos[0]) / ((timestamp[-1] - timestamp[0]) * 1e-6)
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
@@ -0,0 +1,255 @@
+# End to end latency of the driver: from the timestamp of a Leap Motion frame to the command it turned into reaching the serial port
+# Runs the whole sampler -> Hand -> GestureParser -> Beacon chain of main.py, headless, fed by an in process fake Leap Motion service
+# (synthetic frames, or a recording with --replay) and writing into the simulated MCU of fakemcu.py, in a matrix of configurations:
+#
+#   engine: the sampler, parser and reader threads, or the asyncio engine (--asyncio)
+#   logging: the console and command logs on, or off (the root logger set to WARNING)
+#   renderer: off, or a 60 Hz thread doing the per frame work of the renderer (snapshots and the bone and key point transformations),
+#             glumpy and the OpenGL draw calls are left out so that it runs anywhere
+#
+# The fake service stamps every frame with the perf_counter time it's sent at, so both ends are measured on one clock
+# "write" is the latency from that stamp to the command written to the serial port, "applied" to the end of the MCU loop applying it
+# Every configuration runs in its own process (main.py is configured when it's imported), the results are printed as a table
+# and saved as json for tracking regressions
+#
+# Run with `python latency.py --seconds 10 --json latency.json`, arguments after `--` are passed on to main.py, like `-- --window 4`
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+PERCENTILES = [50, 99, 99.9]
+RENDER_FPS = 60  # of the emulated renderer
+TIMESTAMP = re.compile(r'"timestamp":\s*-?\d+')
+
+
+class StampedFrames:
+    # Replaces the timestamp of every message by the perf_counter time it's sent at, in microseconds
+    def __init__(self, frames):
+        self.frames = frames
+
+    def __call__(self, t):
+        msg = self.frames(t)
+        return TIMESTAMP.sub(f'"timestamp": {int(time.perf_counter() * 1e6)}', msg)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            with socket.create_connection(("localhost", port), 0.1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"The fake Leap Motion service didn't start on port {port}")
+
+
+def render(hand_pool, stop, on_draw=None):
+    # the per frame work of main.render() and Hand.draw(), without the OpenGL calls
+    while not stop.wait(1 / RENDER_FPS):
+        for hand in hand_pool:
+            transforms = hand.transforms
+            with hand.snapshot() as frame:
+                hand.get_bone_transforms(0.1, transforms[:hand.bone_count], frame.pos)
+                hand.get_key_point_transforms(transforms[hand.bone_count:], frame.pos)
+            np.matmul(hand.bone_model, transforms, out=transforms)
+        if on_draw is not None:
+            on_draw()
+
+
+def describe(histogram):
+    # the summary of a histogram, in milliseconds
+    p50, p99, p999 = histogram.percentiles(*PERCENTILES)
+    return {"count": histogram.count, "p50_ms": p50 * 1e3, "p99_ms": p99 * 1e3, "p999_ms": p999 * 1e3,
+            "max_ms": histogram.max * 1e3, "mean_ms": histogram.sum / max(histogram.count, 1) * 1e3}
+
+
+def measure(config, seconds, warmup, fps, hand_count, replay, main_args):
+    """
+    Run the pipeline of main.py in this process with one configuration, called in the child process
+
+    :param config: {"engine": "threads" or "asyncio", "logging": bool, "renderer": bool}
+    :return: result dict, see the readme
+    """
+    import fakeleap
+
+    port = free_port()
+    source = (lambda: fakeleap.ReplayedFrames(replay)) if replay else (lambda: fakeleap.SyntheticFrames(hand_count))
+    threading.Thread(target=fakeleap.serve, kwargs=dict(port=port, fps=fps, frames=lambda: StampedFrames(source())),
+                     name="fake leap", daemon=True).start()
+    wait_for_port(port)
+
+    sys.argv = ["main.py", "--headless", "--simulate", "--uri", f"ws://localhost:{port}/v7.json", *main_args]
+    if config["engine"] == "asyncio":
+        sys.argv.append("--asyncio")
+    import main  # configures the pipeline from sys.argv
+    import logging
+    if not config["logging"]:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    # the latency of every command, from the newest frame it's parsed from
+    write_histogram = metrics.Histogram("write_latency_seconds", "Time from a frame to its command written to the serial port")
+    applied_histogram = metrics.Histogram("applied_latency_seconds", "Time from a frame to its command applied by the MCU")
+    ser = main.beacon.ser
+    stamps = {}  # write time of the simulated MCU -> frame timestamp, of the commands on the way
+    written = [0]
+    measuring = threading.Event()
+    original_write, original_apply = ser.write, ser.apply
+
+    def write(data):
+        stamp = max(p.timestamp for p in main.parser)
+        with ser.condition:
+            count = original_write(data)
+            if count and stamp:
+                stamps[ser.to_mcu[-1][1]] = stamp
+        if count and stamp and measuring.is_set():
+            write_histogram.record(time.perf_counter() - stamp * 1e-6)
+            written[0] += 1
+        return count
+
+    def apply(command, now):
+        original_apply(command, now)
+        stamp = stamps.pop(command[0], None)
+        if stamp is not None and measuring.is_set():
+            applied_histogram.record(now - stamp * 1e-6)
+
+    ser.write = write
+    ser.apply = apply
+
+    stop_renderer = threading.Event()
+    if config["renderer"]:
+        consumer = main.scheduler.add_consumer("renderer", main.RENDER_TARGET_RATE)
+        threading.Thread(target=render, args=(main.hand_pool, stop_renderer, lambda: main.scheduler.consumed(consumer)),
+                         name="renderer", daemon=True).start()
+
+    threading.Thread(target=main.main, name="main", daemon=True).start()
+    time.sleep(warmup)
+
+    # measure from a clean slate, after connecting and filling the caches
+    for histogram in metrics.metrics.histograms():
+        histogram.reset()
+    applied = ser.applied
+    measuring.set()
+    start = time.perf_counter()
+    time.sleep(seconds)
+    measuring.clear()
+    duration = time.perf_counter() - start
+    # both engines record every received message and every parse into the stage histograms
+    received, parsed, applied = metrics.receive_histogram.count, metrics.parse_histogram.count, ser.applied - applied
+
+    stop_renderer.set()
+    main.kill()
+    return {
+        "config": config,
+        "seconds": duration,
+        "latency": {"write": describe(write_histogram), "applied": describe(applied_histogram)},
+        "throughput": {"frames_per_second": received / duration, "parses_per_second": parsed / duration,
+                       "writes_per_second": written[0] / duration, "applied_per_second": applied / duration},
+        "stages": {histogram.name: describe(histogram) for histogram in metrics.metrics.histograms()},
+        "mcu": ser.stats,
+    }
+
+
+def configurations(engines, logging, renderer):
+    return [{"engine": engine, "logging": log_on, "renderer": render_on}
+            for engine, log_on, render_on in itertools.product(engines, logging, renderer)]
+
+
+def run(config, args):
+    """
+    Measure one configuration in a child process
+
+    :return: result dict, or None if the child failed
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--child", json.dumps(config), "--seconds", str(args.seconds),
+               "--warmup", str(args.warmup), "--fps", str(args.fps), "--hands", str(args.hands)]
+    if args.replay:
+        command += ["--replay", os.path.abspath(args.replay)]
+    command += ["--", *args.main_args]
+    # the child runs in a temporary directory, so that its command log doesn't overwrite the one of the driver
+    with tempfile.TemporaryDirectory() as cwd:
+        child = subprocess.run(command, cwd=cwd, stdout=subprocess.PIPE, text=True,
+                               stderr=None if args.verbose else subprocess.DEVNULL,
+                               timeout=args.warmup + args.seconds + 60)
+    lines = [line for line in child.stdout.splitlines() if line.startswith("{")]
+    if child.returncode or not lines:
+        print(f"{describe_config(config)}: failed with exit code {child.returncode}, rerun with --verbose", file=sys.stderr)
+        return None
+    return json.loads(lines[-1])
+
+
+def describe_config(config):
+    return f"{config['engine']}, logging {'on' if config['logging'] else 'off'}, renderer {'on' if config['renderer'] else 'off'}"
+
+
+def print_table(results):
+    print(f"{'configuration':<40} {'write p50':>10} {'p99':>8} {'p999':>8} {'applied p50':>12} {'p99':>8} {'p999':>8} "
+          f"{'frames/s':>9} {'writes/s':>9}")
+    for result in results:
+        write, applied, throughput = result["latency"]["write"], result["latency"]["applied"], result["throughput"]
+        print(f"{describe_config(result['config']):<40} {write['p50_ms']:>8.2f}ms {write['p99_ms']:>6.2f}ms {write['p999_ms']:>6.2f}ms "
+              f"{applied['p50_ms']:>10.2f}ms {applied['p99_ms']:>6.2f}ms {applied['p999_ms']:>6.2f}ms "
+              f"{throughput['frames_per_second']:>9.1f} {throughput['writes_per_second']:>9.1f}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="End to end latency of the driver, from a Leap Motion frame to the serial port")
+    arg_parser.add_argument("--seconds", type=float, default=10, help="measured duration of every configuration")
+    arg_parser.add_argument("--warmup", type=float, default=2, help="seconds run before measuring, connecting included")
+    arg_parser.add_argument("--fps", type=float, default=120, help="frame rate of the fake Leap Motion service")
+    arg_parser.add_argument("--hands", type=int, default=2, help="number of synthetic hands in every frame")
+    arg_parser.add_argument("--replay", metavar="PATH", help="stream a recording instead of synthetic frames")
+    arg_parser.add_argument("--engine", nargs="+", default=["threads", "asyncio"], choices=["threads", "asyncio"])
+    arg_parser.add_argument("--logging", nargs="+", default=["on", "off"], choices=["on", "off"])
+    arg_parser.add_argument("--renderer", nargs="+", default=["off", "on"], choices=["on", "off"])
+    arg_parser.add_argument("--json", metavar="PATH", help="save the results as json, to compare them across changes")
+    arg_parser.add_argument("--verbose", action="store_true", help="show the log of the measured driver")
+    arg_parser.add_argument("--child", help=argparse.SUPPRESS)  # a configuration to measure in this process
+    arg_parser.add_argument("main_args", nargs=argparse.REMAINDER, help="arguments passed on to main.py, after --")
+    args = arg_parser.parse_args()
+    args.main_args = [arg for arg in args.main_args if arg != "--"]
+
+    if args.child:
+        result = measure(json.loads(args.child), args.seconds, args.warmup, args.fps, args.hands, args.replay, args.main_args)
+        print(json.dumps(result), flush=True)
+        os._exit(0)  # don't wait for the threads blocked in the pipeline
+
+    results = []
+    for config in configurations(args.engine, [v == "on" for v in args.logging], [v == "on" for v in args.renderer]):
+        print(f"Measuring {describe_config(config)}...", file=sys.stderr)
+        result = run(config, args)
+        if result is not None:
+            results.append(result)
+    print_table(results)
+
+    if args.json:
+        report = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "settings": {"seconds": args.seconds, "warmup": args.warmup, "fps": args.fps, "hands": args.hands,
+                         "replay": args.replay, "main_args": args.main_args},
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved the results into {args.json}", file=sys.stderr)
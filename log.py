@@ -1,6 +1,271 @@
 import coloredlogs
 import logging
+import atexit
+import threading
+import time
+from collections import deque
 
 log = logging.getLogger(__name__)
 
-coloredlogs.install(level='INFO')  # Change this to DEBUG to see more info.
\ No newline at end of file
+coloredlogs.install(level='INFO')  # Change this to DEBUG to see more info.
+
+
+# Asynchronous logging: the threads calling log.info only append the record to a bounded queue, they never block on the console or a file
+# The log writer thread formats the records (so "%s" arguments are formatted lazily, off the hot path) and writes them in batches,
+# one write and one flush per handler every WRITE_INTERVAL
+# Note: the arguments are formatted later in another thread, pass values that don't change afterwards (str, bytes, numbers, copies)
+#
+# The chatty sources log through channels, which can be sampled and rate limited before any record is created, see channel()
+# A channel doesn't even create the record: it queues the call, and the writer makes the record out of it (see Channel.log)
+
+QUEUE_SIZE = 10000  # records waiting for the writer, the ones that don't fit are dropped and counted
+WRITE_INTERVAL = 0.05  # seconds between two batches of the writer, the records logged meanwhile are written together
+
+
+class LogWriter:
+    # The background thread writing the records of all AsyncHandlers
+    def __init__(self, size=QUEUE_SIZE, interval=WRITE_INTERVAL):
+        self.queue = deque()  # (handlers, record or the call of a Channel), appending and popping are thread safe
+        self.size = size
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.dropped = 0  # number of records dropped because the queue was full
+        self.batches = 0  # number of batches written
+        self.thread = threading.Thread(target=self.run, name="log writer", daemon=True)
+        self.thread.start()
+
+    def put(self, handlers, record):
+        # called by the logging threads, never blocks
+        if len(self.queue) >= self.size:
+            self.dropped += 1
+            return
+        self.queue.append((handlers, record))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+        self.flush()  # what's been logged before stopping
+
+    def flush(self):
+        # write everything queued as one batch
+        queue = self.queue
+        batch = []
+        while queue:
+            batch.append(queue.popleft())
+        if batch:
+            self.write(batch)
+            self.batches += 1
+
+    def write(self, batch):
+        # group the records by handler, keeping their order
+        records = {}
+        for handlers, record in batch:
+            if type(record) is tuple:
+                record = self.make_record(*record)
+            for handler in handlers:
+                records.setdefault(handler, []).append(record)
+        for handler, handler_records in records.items():
+            try:
+                if isinstance(handler, logging.StreamHandler):
+                    self.write_stream(handler, handler_records)
+                else:
+                    for record in handler_records:
+                        if record.levelno >= handler.level:
+                            handler.handle(record)
+            except Exception:
+                handler.handleError(handler_records[0])
+
+    @staticmethod
+    def make_record(logger, level, msg, args, created, thread):
+        # the record of a call queued by a Channel, with the time and the thread of the call
+        # there's no caller to look up, the file and the line are left unknown
+        record = logger.makeRecord(logger.name, level, "(unknown file)", 0, msg, args, None)
+        record.relativeCreated -= (record.created - created) * 1000
+        record.created = created
+        record.msecs = int((created - int(created)) * 1000) + 0.0
+        record.thread = thread.ident
+        record.threadName = thread.name
+        return record
+
+    @staticmethod
+    def write_stream(handler, records):
+        # one write and one flush for all the records, instead of one per record
+        lines = [handler.format(record) + handler.terminator for record in records
+                 if record.levelno >= handler.level and handler.filter(record)]
+        if not lines:
+            return
+        handler.acquire()
+        try:
+            handler.stream.write("".join(lines))
+            handler.flush()
+        finally:
+            handler.release()
+
+    def stop(self, timeout=1.0):
+        # write what's queued and stop the thread, called on exit
+        self.stopped.set()
+        self.thread.join(timeout)
+
+
+class AsyncHandler(logging.Handler):
+    # Stands in for some handlers on a logger, the records go to them through the LogWriter
+    def __init__(self, handlers, writer):
+        super().__init__()
+        self.handlers = handlers
+        self.writer = writer
+
+    def handle(self, record):
+        # no lock needed to queue the record
+        self.emit(record)
+        return record
+
+    def emit(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)  # the traceback won't be there later
+            record.exc_info = None
+        self.writer.put(self.handlers, record)
+
+
+class Lazy:
+    # Defers an expensive formatting to the writer thread, like log.info("%s", Lazy(decode, raw)), only done if the record is written
+    __slots__ = ["func", "args"]
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class Channel:
+    # One chatty source of messages, like the parser or the beacon, logging through a child logger of log
+    # Sampling and rate limiting happen before a record is created, so a dropped message costs next to nothing
+    # The dropped messages are counted, and the count is added to the next message let through
+    # A message let through is queued as is, when all the handlers of the logger are behind the writer (see queued_handlers),
+    # the writer creates the record
+    def __init__(self, logger, rate=None, burst=None, every=None):
+        """
+        :param logger: logging.Logger of the channel
+        :param rate: max messages per second, a token bucket, None for no limit
+        :param burst: number of messages that can go through back to back, None for one second worth of them
+        :param every: only keep one message out of every this many, None to keep all of them
+        """
+        self.logger = logger
+        self.rate = rate
+        self.burst = burst or max(rate or 0, 1)
+        self.every = every
+        self.tokens = self.burst
+        self.time = time.perf_counter()
+        self.count = 0  # number of messages, for the sampling
+        self.suppressed = 0  # messages dropped since the last one let through
+        self.total_suppressed = 0
+        self.handlers = None  # see queued_handlers, looked up again once the handlers change
+        self.version = -1  # handlers_version of the lookup
+
+    def allow(self):
+        self.count += 1
+        if self.every and self.count % self.every != 1 and self.every != 1:
+            return False
+        if self.rate:
+            now = time.perf_counter()
+            self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+            self.time = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+        return True
+
+    def log(self, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        if not self.allow():
+            self.suppressed += 1
+            self.total_suppressed += 1
+            return
+        if self.suppressed:
+            msg = f"{msg} ({self.suppressed} more suppressed)"
+            self.suppressed = 0
+        if self.version != handlers_version:
+            self.handlers = queued_handlers(self.logger)
+            self.version = handlers_version
+        if self.handlers:
+            writer.put(self.handlers, (self.logger, level, msg, args, time.time(), threading.current_thread()))
+        else:
+            self.logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(logging.ERROR, msg, *args)
+
+
+def queued_handlers(logger):
+    """
+    The handlers a record of a logger goes to, when they're all behind AsyncHandlers of the writer,
+    so that a Channel can queue its messages without creating the records
+
+    :param logger: logging.Logger
+    :return: list of the handlers behind the writer, None if the record has to go through the logger
+    (some other handler or a filter on the way, or no handler at all)
+    """
+    handlers = []
+    while logger:
+        if logger.filters:
+            return None
+        for handler in logger.handlers:
+            if not isinstance(handler, AsyncHandler) or handler.writer is not writer or handler.filters or handler.level:
+                return None
+            handlers += handler.handlers
+        if not logger.propagate:
+            break
+        logger = logger.parent
+    return handlers or None
+
+
+def channel(name, rate=None, burst=None, every=None):
+    """
+    Construct the channel of one chatty source of messages, see Channel
+
+    :param name: name of the channel, shown in the records as log.<name>
+    :return: Channel
+    """
+    return Channel(log.getChild(name), rate, burst, every)
+
+
+def to_file(channel, path, mode="w", fmt="%(message)s"):
+    """
+    Write the messages of a channel into a file instead of the console, through the writer thread
+
+    :param channel: Channel, or a logging.Logger
+    :param path: of the file
+    :param fmt: format of the records in the file, just the message by default
+    """
+    logger = getattr(channel, "logger", channel)
+    handler = logging.FileHandler(path, mode)
+    handler.setFormatter(logging.Formatter(fmt))
+    logger.addHandler(AsyncHandler([handler], writer))
+    logger.propagate = False
+    changed_handlers()
+    return channel
+
+
+def changed_handlers():
+    # the channels look up their handlers again, call it after adding or removing a handler of a channel's logger by hand
+    global handlers_version
+    handlers_version += 1
+
+
+# move the console handler installed by coloredlogs behind the writer
+writer = LogWriter()
+root = logging.getLogger()
+root.handlers = [AsyncHandler(root.handlers, writer)]
+handlers_version = 0  # incremented by changed_handlers
+atexit.register(writer.stop)
@@ -22,32 +22,122 @@
 
 
 # imports, don't change theses unless necessary
-import json  # for some object communification
 import time  # used for some timing and performance profiling
+import argparse  # command line options
 
 import threading
-from threading import Thread, Lock  # Python-Mulitithreading. Though GIL (Global Interpreter Lock) exist, we can still utilize this for some multitasking and synchronization
-
-from glumpy import app, gl, glm, gloo, __version__  # the easy to use python OpenGL framework
+from threading import Thread  # Python-Mulitithreading. Though GIL (Global Interpreter Lock) exist, we can still utilize this for some multitasking and synchronization
 
 from hand import Hand  # Leap Motion Driver object: Hand, including arm
-from beacon import Beacon  # Serial Communication beacon, for all in one serial control
-from gesture import GestureParser  # Hand/Arm gesture parser, implements gestures to voltage/angle transformation
+from beacon import Beacon, ReadySignal, SerialReader  # Serial Communication beacon, for all in one serial control
+from gesture import GestureParser, batch_features  # Hand/Arm gesture parser, implements gestures to voltage/angle transformation
+from decoder import FrameDecoder, get_json_decoder, simdjson  # Leap Motion frame to Hand position decoder
+from filters import filters, get_filter  # temporal smoothing of the gesture parser inputs and outputs
+from engine import Engine  # all asyncio alternative to the sampler / parser / reader threads
+from record import Recorder, Replay, ReplayFinished  # record and replay of websocket sessions
+from connection import Connection, Closed, CONNECTED, DISCONNECTED  # managed websocket connection, reconnecting with backoff
+from scheduler import FrameScheduler  # adaptive frame skipping, based on how fast the parser and the renderer take the frames
+from registry import HandRegistry, BatchFilter  # all the tracked hands, by Leap Motion device and hand id
+import protocol  # framed binary protocol with the MCU
+from pipeline import CommandPipeline  # sliding window command sending
 
 import asyncio  # used only for the websocket implementation
 import websockets  # websocket interface
 # Note: we've also tried the websocket-client (import websocket), but it performs so poorly that it's nearly unusable
 
-from log import log  # for some timestamped logging
-import numpy as np  # used here only to log the beacon
-
-
-# Init Control, whether to simulate an Arduino device or not
-ENABLE_BEACON = True
+from log import log, channel, to_file, Lazy, writer  # for some timestamped logging, written by a background thread
+import metrics  # per stage latency histograms and counters, for the console and Prometheus
+from metrics import receive_histogram, decode_histogram, store_histogram, parse_histogram, send_histogram, round_trip_histogram
+
+
+# Command line options, parsed on import since the global objects below depend on them
+arg_parser = argparse.ArgumentParser(description="Leap Motion Python Driver")
+arg_parser.add_argument("--headless", action="store_true", help="run the sampler -> parser -> beacon pipeline without a window, glumpy is never imported")
+arg_parser.add_argument("--asyncio", action="store_true", help="run the sampler, parser and reader as tasks on a single asyncio event loop instead of threads")
+arg_parser.add_argument("--uri", default="ws://localhost:6437/v7.json", help="Leap Motion websocket, point it at fakeleap.py for load testing")
+arg_parser.add_argument("--record", metavar="PATH", help="record every websocket message into PATH (gzipped if it ends with .gz)")
+arg_parser.add_argument("--replay", metavar="PATH", help="replay a recording instead of connecting to the Leap Motion service")
+arg_parser.add_argument("--speed", type=float, default=1.0, help="replay speed relative to the recording, 0 for as fast as possible")
+arg_parser.add_argument("--framed", action="store_true", help="talk to the MCU with the framed binary protocol of protocol.py instead of raw commands and ASCII lines")
+arg_parser.add_argument("--window", type=int, default=1, help="max number of commands in flight with --framed, 1 for the stop-and-wait \"OK\" handshake, "
+                        "more only helps on a fast link: at 9600 baud the MCU replies fill the link and 4 is slower than 1 "
+                        "(34 vs 37 commands/s, 40 vs 29 ms), at 115200 baud 4 gives 161 vs 120 commands/s, see benchmark.py simulated_mcu")
+arg_parser.add_argument("--simulate", action="store_true", help="talk to a simulated MCU (fakemcu.py) with the timing of the real link instead of the serial port")
+arg_parser.add_argument("--metrics", type=int, metavar="PORT", help="serve the metrics in the Prometheus text format on http://localhost:PORT/metrics")
+arg_parser.add_argument("--filter", default="none", choices=["none", *filters], help="temporal filter of the key points before the gesture parsers, off by default since it adds some lag")
+args, _ = arg_parser.parse_known_args()
+
+
+# Init Control, whether to simulate an Arduino device or not, see fakemcu.py
+ENABLE_BEACON = not args.simulate
+# Whether to use the framed binary protocol (sync, length, type, sequence number, CRC) with the MCU, see protocol.py
+FRAMED_BEACON = args.framed
+# Whether to run without the renderer, no OpenGL object will be created
+HEADLESS = args.headless
+# Whether to run the pipeline on the asyncio engine instead of the sampler / parser / reader threads
+USE_ASYNCIO = args.asyncio
+
+
+# Leap Motion WebSocket, this URL should be updated along with the SDK version
+LEAP_URI = args.uri
+LEAP_SETTINGS = [
+    {"focused": True},  # focus on the Leap Motion device
+    {"background": True},  # allow background running of the application
+    {"optimizeHMD": False},
+]
+# Record / replay of the websocket session, None to disable
+RECORD_PATH = args.record
+REPLAY_PATH = args.replay
+REPLAY_SPEED = args.speed
+
+
+# Websocket message parser, None: the fastest one installed, or one of "simdjson", "orjson", "json"
+JSON_DECODER = None
+# Only extract the fields used by the Hand objects, this only pays off with simdjson, which parses the rest lazily
+SELECTIVE_JSON = simdjson is not None
+
+
+# Temporal filters of the gesture parsers, None, "exponential", "one_euro" or "kalman", see filters.py
+KEYPOINT_FILTER = None if args.filter == "none" else args.filter  # smooths all key points before parsing
+OUTPUT_FILTER = None  # smooths the force / arm position before it's quantized into the command
+FILTER_LEAD = 1/60  # seconds the kalman filter predicts ahead, about the time until the MCU applies the command
+
+
+# Change detection of the commands written by the beacon, per byte of the command:
+# wheel 0 direction, wheel 0 voltage, wheel 1 direction, wheel 1 voltage, then servo angle0 (turn), angle1, angle2, angle3 (claw)
+# a byte at rest has to change by more than its deadband to trigger a write, and keeps triggering while it changes by more than its hysteresis
+BEACON_DEADBAND = [0, 3, 0, 3, 0, 2, 2, 0]
+BEACON_HYSTERESIS = [0, 1, 0, 1, 0, 1, 1, 0]
+BEACON_MAX_RATE = None  # max writes per second, None for what the baudrate can carry
+# Max number of commands in flight, 1: wait for "OK" before parsing and sending the next command
+# more: parse every new frame and keep up to this many commands unacknowledged, see pipeline.py (threads and --framed only)
+COMMAND_WINDOW = args.window
+ACK_TIMEOUT = 0.5  # seconds after which a command in flight is considered lost
 
 
 # Some multithreading intervals, should be careful not to busy wait too much considering GIL
-READ_INTERVAL = 0  # global constant: extra time to wait after one reading loop
+READ_TIMEOUT = 0.1  # global constant: max time the reader thread blocks on the serial port, before checking whether it should stop
+WAIT_TIMEOUT = 0.1  # global constant: max time the parser blocks waiting for the MCU, before checking whether it should stop
+SAMPLER_REPORT_INTERVAL = 5  # global constant: interval of logging the sampler frame rate, in seconds
+MAX_BACKOFF = 0.1  # global constant: max time between two attempts to reconnect to the Leap Motion service, see connection.py
+PING_INTERVAL = 1.0  # global constant: interval of the websocket heartbeat, in seconds
+PING_TIMEOUT = 1.0  # global constant: a connection without a pong for this long is dropped and reconnected
+# Frames per second decoded for the consumers of the hands at most, None for as many as they take, see scheduler.py
+PARSER_TARGET_RATE = None
+RENDER_TARGET_RATE = 60
+# Whether the frames decoded for the parser follow the rate it parses at, the parser waits for the MCU and not for the frames,
+# so decimating makes the frame it parses older (about +4 ms p50 of the latency at 120 frames/second, see latency.py)
+PARSER_ADAPTIVE = False
+# Slots of the hand registry, every tracked hand of every device, the parsers use the first left and right hands, see registry.py
+HAND_CAPACITY = 8
+HAND_EXPIRY = 1.0  # seconds a lost hand keeps its slot, so that it gets it back when it's tracked again
+
+
+# Logging of the hot loops, the parser and the beacon log every command, see log.py
+LOG_RATE = 10  # max messages per second of the parser and the beacon channels, the others are dropped (and counted)
+COMMAND_LOG_PATH = "output(decoded).txt"  # every command written to the MCU, decoded
+# Port of the Prometheus metrics endpoint, None to disable it, see metrics.py
+METRICS_PORT = args.metrics
 
 
 # Global Threading States, updated dynamically
@@ -58,17 +148,109 @@ stop_beacon = False  # used only once, to stop the reader thread
 update_hand_obj = True  # can be used repeatedly, to pause or resume receiving WebSocket information from the Leap Motion Controller
 
 
+# Sampler statistics, updated dynamically
+received_frames = 0  # number of websocket messages received
+
+
 # Device Control, updated dynamically
-device_ready = False  # whether the MCU said he's ready after we've sent a command
+device_ready = ReadySignal()  # set when the MCU said he's ready after we've sent a command, wakes up the parser
+new_frame = threading.Event()  # set by the sampler after every tracking frame, wakes up the parser when pipelining commands
 arduino_fps = 0  # the loop time received from the MCU, updated upon receiving
-parse_interval = 1/20  # extra time to wait after one parsing operation, updated with 1/arduino_fps
+parse_interval = 1/20  # time to wait between checks when paused, updated with 1/arduino_fps
+
+
+def make_filter(name):
+    # a new filter for every parser, they keep their own state
+    return get_filter(name, lead=FILTER_LEAD) if name == "kalman" else get_filter(name)
 
 
 # * the actual hand pool, stores global hand object, updated by sampler, used by renderer
-hand_pool = [Hand() for _ in range(2)]  # the actual hand object
-parser = [GestureParser(hand_pool[i], i) for i in range(2)]  # the gesture parsers
-beacon = Beacon(port="COM8", baudrate=9600, enable=ENABLE_BEACON)  # the serial controller
-log_file = open("output(decoded).txt", "w")  # used to log and debug outgoing device commands
+hand_pool = [Hand(render=not HEADLESS) for _ in range(2)]  # the actual hand object
+registry = HandRegistry(HAND_CAPACITY, HAND_EXPIRY)  # every tracked hand, the hand pool holds the operator hands picked from it
+decoder = FrameDecoder(hand_pool, registry=registry)  # fills the registry and the hand pool from websocket frames, 0: left, 1: right
+json_decoder = get_json_decoder(JSON_DECODER, SELECTIVE_JSON)  # parses the raw websocket messages
+batch_filter = BatchFilter(make_filter(KEYPOINT_FILTER), HAND_CAPACITY) if KEYPOINT_FILTER else None  # smooths every tracked hand in one call
+parser = [GestureParser(hand_pool[i], i, render=not HEADLESS, output_filter=make_filter(OUTPUT_FILTER)) for i in range(2)]  # the gesture parsers, fed by batch_filter when filtering
+beacon = Beacon(port="COM8", baudrate=9600, enable=ENABLE_BEACON, deadband=BEACON_DEADBAND, hysteresis=BEACON_HYSTERESIS,
+                max_rate=BEACON_MAX_RATE, framed=FRAMED_BEACON, read_timeout=READ_TIMEOUT)  # the serial controller
+serial_reader = SerialReader(beacon, lambda packet: on_device_message(packet))  # reads the MCU messages, run by the reader thread
+parser_log = channel("parser", rate=LOG_RATE)  # the parser results
+beacon_log = channel("beacon", rate=LOG_RATE)  # the commands sent and the messages echoed by the MCU
+command_log = channel("commands")  # used to log and debug outgoing device commands, into COMMAND_LOG_PATH once main() runs
+recorder = Recorder(RECORD_PATH) if RECORD_PATH else None  # records the raw websocket messages
+scheduler = FrameScheduler()  # decides which websocket frames the sampler decodes
+parser_consumer = scheduler.add_consumer("parser", PARSER_TARGET_RATE, PARSER_ADAPTIVE)  # the renderer adds itself when the window opens
+pipeline = CommandPipeline(beacon, COMMAND_WINDOW, ACK_TIMEOUT, on_write=lambda signal: log_command(signal)) if COMMAND_WINDOW > 1 and FRAMED_BEACON and not USE_ASYNCIO else None  # sliding window sending
+if COMMAND_WINDOW > 1 and not FRAMED_BEACON:
+    log.warning(f"--window {COMMAND_WINDOW} needs --framed, the \"OK\" of the line protocol doesn't tell which command it acknowledges, waiting for \"OK\" instead")
+
+
+# * the counters kept by the objects above, exported along with the stage histograms
+metrics.metrics.counter("received_frames_total", "Websocket messages received by the sampler thread", lambda: received_frames)
+metrics.metrics.counter("skipped_frames_total", "Websocket messages never decoded, not needed by the consumers or the sampler behind", lambda: scheduler.skipped)
+metrics.metrics.counter("decimated_frames_total", "Websocket messages held because no consumer needed them yet", lambda: scheduler.decimated)
+metrics.metrics.counter("late_frames_total", "Held websocket messages decoded because nothing newer arrived in time", lambda: scheduler.late)
+metrics.metrics.gauge("decode_rate", "Frames per second the consumers need decoded, 0 for all of them", lambda: scheduler.rate)
+metrics.metrics.gauge("sampler_backlog", "Websocket messages in a row that were already waiting when received", lambda: scheduler.backlog)
+metrics.metrics.gauge("parser_rate", "Frames per second read by the parser", lambda: parser_consumer.rate)
+metrics.metrics.gauge("parser_depth", "Frames decoded between the last two reads of the parser", lambda: parser_consumer.depth)
+metrics.metrics.gauge("tracked_hands", "Hands in the latest frame of their device", lambda: int(registry.latest_frame.active.sum()))
+metrics.metrics.counter("expired_hands_total", "Registry slots released after their hand was lost for too long", lambda: registry.expired)
+metrics.metrics.counter("rejected_hands_total", "Hand frames dropped because every registry slot was taken", lambda: registry.rejected)
+metrics.metrics.counter("sent_commands_total", "Commands written to the MCU", lambda: beacon.sent)
+metrics.metrics.counter("suppressed_commands_total", "Commands not written because they didn't change enough", lambda: beacon.suppressed)
+metrics.metrics.counter("rate_limited_commands_total", "Commands not written because of the rate limit", lambda: beacon.rate_limited)
+metrics.metrics.counter("serial_skipped_bytes_total", "Bytes from the MCU dropped by the decoder", lambda: beacon.decoder.skipped)
+metrics.metrics.counter("log_dropped_total", "Log records dropped because the log writer fell behind", lambda: writer.dropped)
+metrics.metrics.gauge("arduino_fps", "Loop rate reported by the MCU", lambda: arduino_fps)
+if pipeline is not None:
+    metrics.metrics.counter("coalesced_commands_total", "Commands replaced by a newer one while the window was full", lambda: pipeline.coalesced)
+    metrics.metrics.counter("timed_out_commands_total", "Commands in flight given up on", lambda: pipeline.timeouts)
+
+
+def connect():
+    # the websocket connection of the sampler, or a replay of a recording standing in for it
+    if REPLAY_PATH:
+        return Replay(REPLAY_PATH, REPLAY_SPEED)
+    return websockets.connect(LEAP_URI, ping_interval=None)  # the heartbeat is done by the connection
+
+
+def on_connection_state(state, error):
+    """
+    Handle a state change of the websocket connection, called by the sampler (or the asyncio engine) which owns the hands
+
+    :param state: connection.CONNECTING, CONNECTED, DISCONNECTED or CLOSED
+    :param error: the exception causing it, or None
+    """
+    if state == DISCONNECTED:
+        connection_log.warning("Leap Motion service disconnected: %s, reconnecting", error)
+        # don't act on the last frame received before losing the service, the parsers see lost hands until it's back
+        scheduler.reset()  # the held frame is stale
+        registry.clear()
+        for hand in hand_pool:
+            hand.clean()
+        new_frame.set()
+    elif state == CONNECTED:
+        log.info(f"Connected to the Leap Motion service (connect #{connection.connects}, down for {connection.downtime:.3f} s)")
+
+
+def update_arduino_fps(fps):
+    global arduino_fps, parse_interval
+    arduino_fps = fps
+    parse_interval = 1 / arduino_fps
+
+
+# * the websocket connection of the sampler, or of the asyncio engine
+connection_log = channel("connection", rate=1)  # the failed attempts to reconnect
+connection = Connection(connect, LEAP_SETTINGS, on_state=on_connection_state, max_backoff=MAX_BACKOFF,
+                        ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT)
+metrics.metrics.counter("websocket_connects_total", "Successful connects to the Leap Motion service", lambda: connection.connects)
+metrics.metrics.counter("websocket_disconnects_total", "Connections to the Leap Motion service dropped", lambda: connection.disconnects)
+metrics.metrics.gauge("websocket_connected", "Whether the Leap Motion service is connected", lambda: int(connection.state == CONNECTED))
+
+# * the asyncio engine, only used with --asyncio
+engine = Engine(connection, json_decoder, decoder, lambda: parse_and_send(), beacon, scheduler=scheduler,
+                should_update=lambda: update_hand_obj and not stop_beacon, on_fps=update_arduino_fps, recorder=recorder)
 
 
 def render(interactive=False):
@@ -89,12 +271,15 @@ def render(interactive=False):
 
     log.info(f"Runnning glfw renderer")
 
+    from glumpy import app, gl, glm, gloo, __version__  # the easy to use python OpenGL framework, only imported when rendering
+
     app.use("glfw")  # setting OpenGL backend, you'll need glfw installed
     config = app.configuration.Configuration()
     config.samples = 16  # super sampling anti-aliasing
-    console = app.Console(rows=32, cols=80, scale=3, color=(0.1, 0.1, 0.1, 1))  # easy to use info displayer
+    console = app.Console(rows=40, cols=80, scale=3, color=(0.1, 0.1, 0.1, 1))  # easy to use info displayer
     global window  # to be used to close the window, declared as global var for interpreter to reference
     window = app.Window(width=console.cols*console.cwidth*console.scale, height=console.rows*console.cheight*console.scale, color=(1, 1, 1, 1), config=config)
+    render_consumer = scheduler.add_consumer("renderer", RENDER_TARGET_RATE)  # the frames drawn, see scheduler.py
 
     @window.timer(1/30.0)
     def timer(dt):
@@ -108,6 +293,23 @@ def render(interactive=False):
                                              window._backend.__version__))
         console.write(" Actual FPS: %.2f frames/second" % (window.fps))
         console.write(" Arduino FPS: %.2f frames/second" % (arduino_fps))
+        console.write(" Websocket frames: %d received, %d skipped" % (received_frames, scheduler.skipped))
+        console.write(" Scheduler: %s" % (scheduler.stats))
+        console.write(" Websocket: %s" % (connection.stats))
+        console.write(" Hands: %s" % (registry.stats))
+        console.write(" Commands: %s" % (beacon.stats))
+        if pipeline is not None:
+            console.write(" Pipeline: %s" % (pipeline.stats))
+        if not ENABLE_BEACON:
+            console.write(" Simulated MCU: %s" % (beacon.ser.stats))
+        if USE_ASYNCIO:
+            console.write(" OK to send: %.1f us (max %.1f us)" % (engine.send_latency*1e6, engine.max_send_latency*1e6))
+            console.write(" Dropped websocket frames: %d" % (engine.dropped_frames))
+        else:
+            console.write(" OK to send: %.1f us (mean %.1f us, max %.1f us)" % (device_ready.send_latency*1e6, device_ready.mean_send_latency*1e6, device_ready.max_send_latency*1e6))
+        for name, histogram in [("Receive", receive_histogram), ("JSON decode", decode_histogram), ("Store pos", store_histogram),
+                                ("Parse", parse_histogram), ("Send", send_histogram), ("Round trip", round_trip_histogram)]:
+            console.write(" %s: %s" % (name, histogram.summary()))
         console.write(" Hit 'V' key to toggle bone view")
         console.write(" Hit 'P' key to pause or unpause")
         console.write("-------------------------------------------------------")
@@ -121,14 +323,13 @@ def render(interactive=False):
 
         # Rotate cube
         for hand in hand_pool:
-            model = hand.key_point.model
+            # the model matrices are rotated in place, and picked up by the next Hand.draw
+            model = hand.key_model
             glm.rotate(model, 1, 0, 0, 1)
             glm.rotate(model, 1, 0, 1, 0)
-            hand.key_point.model = model
 
-            model = hand.bone.model
+            model = hand.bone_model
             glm.rotate(model, 1, 0, 1, 0)
-            hand.bone.model = model
 
     @window.event
     def on_draw(dt):
@@ -139,6 +340,7 @@ def render(interactive=False):
 
         for hand in hand_pool:
             hand.draw()
+        scheduler.consumed(render_consumer)
 
     @window.event
     def on_resize(width, height):
@@ -210,162 +412,255 @@ def sample():
     Uses websockets and asyncio to simplify the communication process
     """
     async def leap_sampler():
-        global stop_websocket, update_hand_obj
-        uri = "ws://localhost:6437/v7.json"  # this URL should be updated along with the SDK version
-
-        while not stop_websocket:
-            async with websockets.connect(uri) as ws:  # open the websocket connection, it's pretty hard to close manually...
-                await ws.send(json.dumps({"focused": True}))  # focus on the Leap Motion device
-                await ws.send(json.dumps({"background": True}))  # allow background running of the application
-                await ws.send(json.dumps({"optimizeHMD": False}))
-                log.info(f"Focused on the leap motion controller...")
-
-                # initialize the performance counter
-                end = start = previous = time.perf_counter()
-
-                while not stop_websocket:
-                    # always waiting for messages
-                    msg = await ws.recv()
-                    current = time.perf_counter()
-                    if current - previous < end - start:
-                        # if the time used to update the current window is longer than
-                        # the currently accumulated time for reading the websocket, just wait until
-                        # the next websocket information and skip the frame update
-
-                        # this is for synchronizing the rendering thread and websocket thread better
-                        continue
-
-                    msg = json.loads(msg)  # hand object information comes with JSON format
-                    if "timestamp" in msg:  # used to identity regular frame from some meta info update frame
-                        start = time.perf_counter()  # starting time of the frame update
-
-                        # the index of the left and right hand
-                        left = [i for i in range(len(msg["hands"])) if msg["hands"][i]["type"] == "left"]
-                        right = [i for i in range(len(msg["hands"])) if msg["hands"][i]["type"] == "right"]
-
-                        # update the hand if there's some left/right hand present in the current websocket package
-                        if len(left) > 0 and update_hand_obj:
-                            i = left[0]
-                            hand_pool[0].store_pos(msg, i)
-                        else:
-                            hand_pool[0].clean()
-
-                        if len(right) > 0 and update_hand_obj:
-                            i = right[0]
-                            hand_pool[1].store_pos(msg, i)
-                        else:
-                            # else just clean up the hand object location
-                            hand_pool[1].clean()
-
-                        end = time.perf_counter()  # end time of the frame update
-                    else:
-                        log.info(f"Getting message: {msg}")  # log the meta message for the user
-
-                    previous = time.perf_counter()  # only update the previous time log if the full loop is run successfully
-                log.info("Reconnecting" if not stop_websocket else "Sampler terminated")
-
+        global stop_websocket, update_hand_obj, received_frames
+
+        # initialize the performance counter
+        last_report = time.perf_counter()
+        last_received = last_skipped = 0
+
+        # the connection (re)connects and sends the settings by itself, and kill() closes it
+        try:
+            while not stop_websocket:
+                # always waiting for messages
+                receiving = time.perf_counter()
+                timeout = scheduler.timeout(receiving)  # with a held frame, only wait for a newer one until it's due
+                try:
+                    msg = await (connection.recv() if timeout is None else asyncio.wait_for(connection.recv(), timeout))
+                except asyncio.TimeoutError:
+                    msg = None
+                except ReplayFinished:
+                    log.info(f"Replay finished")
+                    return
+                except Closed:
+                    break
+                current = time.perf_counter()
+                if msg is None:
+                    msg = scheduler.take_pending()  # nothing newer arrived in time, decode the held frame
+                    if msg is None:
+                        continue  # reset meanwhile
+                else:
+                    receive_histogram.record(current - receiving)
+                    received_frames += 1
+                    if recorder is not None:
+                        recorder.write(msg, current)
+                    # decode it now, or hold it until the consumers need it, see scheduler.py
+                    msg = scheduler.offer(msg, current, current - receiving)
+                if current - last_report >= SAMPLER_REPORT_INTERVAL:
+                    # log the rate of the sampler, to check the frame skipping logic under load
+                    received = received_frames - last_received
+                    skipped = scheduler.skipped - last_skipped
+                    log.info(f"Sampler: {received / (current - last_report):.1f} frames/second received, {skipped / max(received, 1):.1%} skipped")
+                    log.info(f"Beacon: {beacon.stats}")
+                    log.info(f"Websocket: {connection.stats}")
+                    log.info(f"Scheduler: {scheduler.stats}")
+                    log.info(f"Hands: {registry.stats}")
+                    if pipeline is not None:
+                        log.info(f"Pipeline: {pipeline.stats}")
+                    if not ENABLE_BEACON:
+                        log.info(f"Simulated MCU: {beacon.ser.stats}")
+                    last_report, last_received, last_skipped = current, received_frames, scheduler.skipped
+                if msg is None:
+                    continue
+
+                decoding = time.perf_counter()
+                msg = json_decoder(msg)  # hand object information comes with JSON format
+                start = time.perf_counter()  # starting time of the frame update
+                decode_histogram.record(start - decoding)
+                if decoder.decode(msg, update_hand_obj):  # update all hands in the hand pool in one pass
+                    end = time.perf_counter()  # end time of the frame update
+                    store_histogram.record(end - start)
+                    new_frame.set()
+                else:
+                    # used to identity regular frame from some meta info update frame
+                    log.info(f"Getting message: {msg}")  # log the meta message for the user
+                scheduler.decoded(decoding, time.perf_counter())
+        finally:
+            await connection.aclose()
+            if recorder is not None:
+                recorder.close()  # by its only writer, once nothing is recorded anymore
         log.info(f"Leap motion sampler is stopped")
 
-    log.info(f"Running demo sampler from leap motion")
+    log.info(f"Running demo sampler from leap motion, parsing messages with {json_decoder.name}")
     loop = asyncio.new_event_loop()  # new thread has no event loop by default
     loop.run_until_complete(leap_sampler())  # run the Leap Motion Websocket sampler
     log.info(f"Sampler runner thread exited")
 
 
-def parse():
+def decode_command(signal):
+    # the bytes of a command as 3 digit numbers, like 030072...
+    return "".join([f"{v:03d}" for v in signal])
+
+
+def log_command(signal):
+    # log an outgoing device command into the command log, decoded by the log writer thread
+    command_log.info("%s", Lazy(decode_command, signal))
+
+
+def parse_hands():
     """
-    Using global hand_pool, parse the gesture to custom package
-    Then sent it through the beacon (Serial communication, bluetooth, etc)
-    Parsing interval (to avoid busy waiting) is updated to match the "frame rate" of the MCU
+    Parse both operator hands
+    When filtering, the key points of every tracked hand in the registry are filtered, and their features computed, in one batch
+
+    :return: the commands of the parsers 0 and 1
     """
-    if not thread_check():
-        return
+    if batch_filter is None:
+        return parser[0].parse(), parser[1].parse()
+    with registry.snapshot() as frame:
+        pos, palm_normal = batch_filter(frame)  # up to the last occupied slot, owned by the filter, still valid after the snapshot
+        slots = [registry.select(hand_type, frame) for hand_type in ("left", "right")]  # the slots of the hand pool
+        timestamps = [p.timestamp if slot is None else int(frame.timestamp[slot]) for p, slot in zip(parser, slots)]
+    features = batch_features(pos, palm_normal, parser[0].fist_threshold)
+    return tuple(p.parse_batch(None, None, timestamp) if slot is None
+                 else p.parse_batch(pos[slot], palm_normal[slot], timestamp, features.row(slot))
+                 for p, slot, timestamp in zip(parser, slots, timestamps))
+
+
+def parse_and_send():
+    """
+    Parse the gesture of both hands in the hand_pool, and send the command through the beacon
+    Or submit it to the pipeline, which sends it when there's room in the window
+    Shared by the parser thread and the asyncio engine
+    """
+    # print("AAA")
+    # log.info(f"Parsing position data...")
+    parsing = time.perf_counter()
+    signal0, signal1 = parse_hands()
+    parse_histogram.record(time.perf_counter() - parsing)
+    scheduler.consumed(parser_consumer, parsing)
 
-    def parse_and_send():
-        # print("AAA")
-        # log.info(f"Parsing position data...")
-        signal0 = parser[0].parse()
-        signal1 = parser[1].parse()
+    parser_log.info("Getting parser result: %s", signal0)
+    parser_log.info("Getting parser result: %s", signal1)
 
-        log.info(f"Getting parser result: {signal0}")
-        log.info(f"Getting parser result: {signal1}")
+    # signal = {**signal0, **signal1}
 
-        # signal = {**signal0, **signal1}
+    # signal = json.dumps(signal) + "\n"
 
-        # signal = json.dumps(signal) + "\n"
+    # signal = "".join([ f"{v:03.0f}" for v in signal1["voltage"]])
 
-        # signal = "".join([ f"{v:03.0f}" for v in signal1["voltage"]])
+    signal = signal1 + signal0
 
-        signal = signal1 + signal0
+    beacon_log.info("[Beacon] Send: %s", signal)
 
-        log.info(f"[Beacon] Send: {signal}")
+    sending = time.perf_counter()
+    if pipeline is not None:
+        pipeline.submit(signal)  # logged by the pipeline when it's actually written
+        send_histogram.record(time.perf_counter() - sending)
+    else:
+        written = beacon.send_raw(signal)
+        send_histogram.record(time.perf_counter() - sending)
+        if written:
+            # only the commands actually written, the others are suppressed by the deadband or the rate limit
+            log_command(signal)
 
-        decoded = np.frombuffer(signal, dtype="uint8")
-        decoded = "".join([f"{v:03.0f}" for v in decoded])
-        print(decoded, file=log_file)
 
-        beacon.send_raw(signal)
+def parse():
+    """
+    Using global hand_pool, parse the gesture to custom package
+    Then sent it through the beacon (Serial communication, bluetooth, etc)
+    Blocks on the device_ready signal, so that a command is sent the moment the MCU says it's ready
+    Or, with a pipeline, blocks on new frames and submits a command for every one of them
+    """
+    if not thread_check():
+        return
 
     log.info(f"Parser thread opened")
-    start = time.perf_counter()
-    global device_ready
     while not stop_parser:
-        end = time.perf_counter()
-        time.sleep(max(0, parse_interval - end + start))
-        start = time.perf_counter()
-
-        # the reader thread will update the device_ready flag
-        if update_hand_obj and not stop_beacon and device_ready:
+        if not update_hand_obj or stop_beacon:
+            # paused, keep the ready flag for when we resume
+            time.sleep(parse_interval)
+            continue
+
+        if pipeline is not None:
+            # the sampler will set the new_frame event, the pipeline decides when the command is written
+            # a command held back by the rate limit is retried once the beacon can write it, unless a newer frame comes first
+            delay = pipeline.retry_delay()
+            if new_frame.wait(WAIT_TIMEOUT if delay is None else min(delay, WAIT_TIMEOUT)):
+                new_frame.clear()
+                parse_and_send()
+            elif delay is not None:
+                pipeline.flush()
+            continue
+
+        # the reader thread will set the device_ready signal
+        if device_ready.wait(WAIT_TIMEOUT):
             parse_and_send()
-            device_ready = False
+            device_ready.sent()  # clear the flag and record the latency from "OK" to here
 
     log.info(f"Parser thread exited")
 
 
+def on_device_message(packet):
+    """
+    Handle a message sent by the MCU, called by the serial reader for every one of them
+    Update arduino_fps, parse_interval and device_ready signal if needed
+
+    :param packet: protocol.Packet, "OK" is ACK and "FPS:240" is FPS with the line protocol
+    """
+    if packet.type == protocol.ACK:
+        device_ready.set()
+        if pipeline is not None:
+            pipeline.on_ack(packet.seq)
+    elif packet.type == protocol.FPS:
+        update_arduino_fps(packet.fps)
+    elif ENABLE_BEACON:
+        beacon_log.info("[Beacon] Echo: %s", packet.text)
+
+
 def read():
     """
     Read messages sent by the MCU from the Serial beacon
-    Update arduino_fps, parse_interval and device_ready flag if needed
+    Bulk reads with a timeout, until kill() stops the serial reader
     """
     if not thread_check():
         return
 
-    # log.warning(f"Setting read timeout to None (indefinitely) and looping...")
-    start = time.perf_counter()
-    while not stop_beacon:
-        end = time.perf_counter()
-        time.sleep(max(0, READ_INTERVAL - end + start))
-        start = time.perf_counter()
-        global device_ready
-        try: # sometimes the beacon send corrupted data, filter it by a try except block
-            msg = beacon.readline()
-            if ENABLE_BEACON:
-                log.info(f"[Beacon] Echo: {msg}")
-            if msg.strip() == "OK":
-                device_ready = True
-
-            elif msg.startswith("FPS:"):
-                global arduino_fps, parse_interval
-                arduino_fps = float(msg[len("FPS:"):])
-                parse_interval = 1 / arduino_fps
-
-        except Exception as e:
-            log.error(e)
+    # corrupted bytes are dropped by the decoder of the beacon (CRC with --framed, malformed lines otherwise)
+    serial_reader.run()
 
 
 def main():
 
-    # spawn websocket communication thread
-    sampler_thread = Thread(target=sample)
-    sampler_thread.start()
+    # when headless, nothing waits for the threads on exit, some of them might be blocked on IO
+    daemon = HEADLESS
+
+    # opened here and not on import, importing main (benchmark.py, latency.py) doesn't touch the file
+    to_file(command_log, COMMAND_LOG_PATH)
 
-    # spawn hand gesture parser thread
-    parser_thread = Thread(target=parse)
-    parser_thread.start()
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
 
-    # spawn the incoming message processor thread
-    beacon_thread = Thread(target=read)
-    beacon_thread.start()
+    if USE_ASYNCIO:
+        # a single thread running the whole pipeline on an asyncio event loop
+        log.info(f"Running the pipeline on the asyncio engine")
+        engine_thread = Thread(target=engine.run_forever, daemon=daemon)
+        engine_thread.start()
+        threads = [engine_thread]
+    else:
+        # spawn websocket communication thread
+        sampler_thread = Thread(target=sample, daemon=daemon)
+        sampler_thread.start()
+
+        # spawn hand gesture parser thread
+        parser_thread = Thread(target=parse, daemon=daemon)
+        parser_thread.start()
+
+        # spawn the incoming message processor thread
+        beacon_thread = Thread(target=read, daemon=daemon)
+        beacon_thread.start()
+        threads = [sampler_thread, parser_thread, beacon_thread]
+
+    if HEADLESS:
+        log.info(f"Running headless, hit Ctrl+C to quit")
+        try:
+            # the pipeline is done when any stage is, like the sampler at the end of a replay
+            while all(thread.is_alive() for thread in threads):
+                threads[0].join(0.5)  # with a timeout, so that Ctrl+C gets through
+        except KeyboardInterrupt:
+            log.info("The user interrupted the headless pipeline")
+        kill()
+        for thread in threads:
+            thread.join(1.0)  # the threads are daemons, don't hang on one blocked on IO
+        return
 
     # run the renderer thread
     render(interactive=True)
@@ -378,8 +673,12 @@ def kill():
     # kill other threads
     global stop_websocket, stop_parser, stop_beacon
     stop_websocket = stop_parser = stop_beacon = True
+    device_ready.interrupt()
+    new_frame.set()
+    connection.close()  # interrupts the sampler, even when it's blocked on the websocket
+    serial_reader.stop()
+    engine.stop()
     beacon.close()
-    # sampler.create_task(websocket.close())
 
 
 if __name__ == "__main__":
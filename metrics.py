@@ -0,0 +1,211 @@
+# Live metrics of the pipeline: per stage latency histograms and counters, shown on the console and exported for Prometheus
+# Histogram is HDR style: every power of two is split into 2**precision linear sub-buckets, so any recorded value
+# is known within a relative error of 2**-precision (3% by default), from microseconds to minutes with a few hundred counters,
+# and recording is a handful of arithmetic operations with no allocation
+# Note: a histogram or a counter should be recorded by one thread only (the stage it measures), they aren't locked
+#
+# The metrics are all registered in the global `metrics`, like the global `log` of log.py
+# serve() exposes them in the Prometheus text format on http://localhost:<port>/metrics (`python main.py --metrics 9100`)
+
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from log import log
+
+PREFIX = "leap_"  # of all the exported names
+
+
+class Histogram:
+    def __init__(self, name, help, lowest=1e-6, highest=100.0, precision=5):
+        """
+        :param name: exported name, like "parse_seconds"
+        :param help: one line description
+        :param lowest: smallest value told apart from 0, 1 us
+        :param highest: largest value told apart, bigger ones are counted in the last bucket
+        :param precision: number of bits of the sub-buckets, the relative error is 2**-precision
+        """
+        self.name = name
+        self.help = help
+        self.lowest = lowest
+        self.sub_count = 1 << precision
+        self.magnitudes = math.ceil(math.log2(highest / lowest)) + 1
+        self.counts = [0] * (self.magnitudes * self.sub_count)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, value):
+        self.count += 1
+        self.sum += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+        mantissa, exponent = math.frexp(value / self.lowest)  # value / lowest = mantissa * 2**exponent, mantissa in [0.5, 1)
+        if exponent <= 0 or mantissa < 0:
+            index = 0  # below lowest
+        else:
+            index = min((exponent - 1) * self.sub_count + int((mantissa * 2 - 1) * self.sub_count), len(self.counts) - 1)
+        self.counts[index] += 1
+
+    def upper(self, index):
+        # the largest value counted in a bucket
+        magnitude, sub = divmod(index, self.sub_count)
+        return self.lowest * 2**magnitude * (1 + (sub + 1) / self.sub_count)
+
+    def percentiles(self, *qs):
+        """
+        :param qs: percentiles, like 50, 99
+        :return: list of the values, within the precision, 0 when empty
+        """
+        if not self.count:
+            return [0.0] * len(qs)
+        targets = sorted((max(math.ceil(q / 100 * self.count), 1), i) for i, q in enumerate(qs))
+        values = [self.max] * len(qs)
+        cumulative = 0
+        t = 0
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            cumulative += count
+            while t < len(targets) and cumulative >= targets[t][0]:
+                values[targets[t][1]] = min(self.upper(index), self.max)
+                t += 1
+            if t == len(targets):
+                break
+        return values
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def summary(self):
+        # one line for the console, in milliseconds
+        p50, p99 = self.percentiles(50, 99)
+        return f"p50 {p50*1e3:.3f} ms, p99 {p99*1e3:.3f} ms, max {self.max*1e3:.3f} ms ({self.count})"
+
+    def export(self):
+        # Prometheus summary, with the max as a separate gauge
+        name = PREFIX + self.name
+        quantiles = [0.5, 0.9, 0.99, 0.999]
+        lines = [f"# HELP {name} {self.help}", f"# TYPE {name} summary"]
+        for q, value in zip(quantiles, self.percentiles(*[q * 100 for q in quantiles])):
+            lines.append(f'{name}{{quantile="{q}"}} {value:.9g}')
+        lines.append(f"{name}_sum {self.sum:.9g}")
+        lines.append(f"{name}_count {self.count}")
+        lines.append(f"# HELP {name}_max {self.help}, the largest one")
+        lines.append(f"# TYPE {name}_max gauge")
+        lines.append(f"{name}_max {self.max:.9g}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, func=None, type="counter"):
+        """
+        :param name: exported name, like "skipped_frames_total"
+        :param help: one line description
+        :param func: function returning the value, for the counters already kept somewhere else, None to count with inc()
+        :param type: "counter", or "gauge" for a value that can go down
+        """
+        self.name = name
+        self.help = help
+        self.func = func
+        self.type = type
+        self.count = 0
+
+    def inc(self, n=1):
+        self.count += n
+
+    @property
+    def value(self):
+        return self.func() if self.func is not None else self.count
+
+    def summary(self):
+        return f"{self.value}"
+
+    def export(self):
+        name = PREFIX + self.name
+        return [f"# HELP {name} {self.help}", f"# TYPE {name} {self.type}", f"{name} {self.value}"]
+
+
+class Registry:
+    # All the metrics by name, registering a name again returns the existing metric
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name, help, **kwargs):
+        return self.register(Histogram(name, help, **kwargs))
+
+    def counter(self, name, help, func=None, type="counter"):
+        """
+        :param func: see Counter, a function registered again replaces the previous one (like the one of a previous Beacon)
+        """
+        counter = self.register(Counter(name, help, func, type))
+        if func is not None:
+            counter.func = func
+        return counter
+
+    def gauge(self, name, help, func):
+        return self.counter(name, help, func, "gauge")
+
+    def histograms(self):
+        return [metric for metric in self.metrics.values() if isinstance(metric, Histogram)]
+
+    def counters(self):
+        return [metric for metric in self.metrics.values() if isinstance(metric, Counter)]
+
+    def prometheus(self):
+        # everything in the Prometheus text format
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.export())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Registry()
+
+
+def serve(port=9100, host="localhost", registry=metrics):
+    """
+    Serve the metrics in the Prometheus text format on a background thread, GET /metrics
+
+    :return: the http.server.ThreadingHTTPServer, call shutdown() to stop it
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # a scrape every few seconds isn't worth a log line
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info(f"Serving the metrics on http://{host}:{port}/metrics")
+    return server
+
+
+# The stages of the pipeline, recorded by the sampler and the parser (main.py, engine.py) and by the beacon
+receive_histogram = metrics.histogram("receive_seconds", "Time blocked in the websocket recv, the wait for the next frame included")
+decode_histogram = metrics.histogram("json_decode_seconds", "Time parsing one websocket message")
+store_histogram = metrics.histogram("store_pos_seconds", "Time filling the hands from one parsed frame (FrameDecoder.decode)")
+parse_histogram = metrics.histogram("parse_seconds", "Time parsing the gestures of both hands")
+send_histogram = metrics.histogram("send_raw_seconds", "Time writing, or suppressing, one command")
+round_trip_histogram = metrics.histogram("round_trip_seconds", "Time from writing a command to its OK (or ACK with --framed)")
@@ -0,0 +1,129 @@
+# Sliding window command sending, an alternative to the stop-and-wait "OK" handshake of the parser thread
+# Up to `window` commands are in flight at once, every ACK (or "OK") frees a slot
+# When the window is full, submitting keeps only the newest command as pending (the older pending one is coalesced away),
+# and the pending command goes out the moment a slot frees up, so the MCU never works through stale commands
+# A command held back by the rate limit of the beacon is kept as the pending one too, and retried on the next ACK,
+# or by the parser once the beacon has a token again (see retry_delay and flush)
+#
+# It needs the framed protocol: the ACKs carry the sequence number of the command, and are cumulative (the MCU applies commands in order)
+# The "OK" of the line protocol can't be used, the MCU prints one on every idle loop, so most of them belong to no command
+# Commands not acknowledged within ack_timeout are given up on, so a lost ACK can't shrink the window for good
+
+import threading
+import time
+from collections import deque
+
+
+class CommandPipeline:
+    def __init__(self, beacon, window=4, ack_timeout=0.5, on_write=None):
+        """
+        :param beacon: Beacon writing the commands, its deadband and rate limit still apply
+        :param window: max number of commands in flight, 1 is stop-and-wait
+        :param ack_timeout: seconds after which an unacknowledged command is given up on
+        :param on_write: optional function called with every command actually written
+        """
+        assert window >= 1
+        assert beacon.framed, "the pipeline needs the sequence numbers of the framed protocol"
+        self.beacon = beacon
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.on_write = on_write
+        self.lock = threading.Lock()  # submit is called by the parser, on_ack by the reader
+        self.in_flight = deque()  # (sequence number, perf_counter) of the commands in flight, oldest first
+        self.pending = None  # newest command waiting for a free slot
+
+        # statistics
+        self.written = 0  # number of commands written
+        self.acked = 0  # number of commands acknowledged
+        self.coalesced = 0  # number of pending commands replaced by a newer one before being written
+        self.timeouts = 0  # number of commands given up on
+        self.max_in_flight = 0
+
+    def submit(self, raw):
+        """
+        Send a command now if the window has room, otherwise keep it as the pending one
+
+        :param raw: bytes of the command
+        :return: raw if it's written now, "" if it's suppressed by the deadband, None if it's pending (window full or rate limited)
+        """
+        with self.lock:
+            self.expire()
+            if len(self.in_flight) >= self.window:
+                if self.pending is not None:
+                    self.coalesced += 1
+                self.pending = raw
+                return None
+            self.pending = None
+            return self.write(raw)
+
+    def flush(self):
+        """
+        Write the pending command if the window has room, like when the rate limit of the beacon lets it through again
+
+        :return: see submit, None without a pending command
+        """
+        with self.lock:
+            self.expire()
+            if self.pending is None or len(self.in_flight) >= self.window:
+                return None
+            raw, self.pending = self.pending, None
+            return self.write(raw)
+
+    def retry_delay(self):
+        """
+        :return: seconds until the pending command can be written, None if there's none or it waits for an ACK
+        """
+        with self.lock:
+            if self.pending is None or len(self.in_flight) >= self.window:
+                return None
+            return self.beacon.token_delay(len(self.pending))
+
+    def on_ack(self, seq):
+        """
+        Called by the reader for every ACK, frees the slot(s) and writes the pending command if any
+        The ACKs of the idle loops repeat the last applied command, they don't free anything
+
+        :param seq: sequence number of the acknowledged command
+        """
+        with self.lock:
+            in_flight = self.in_flight
+            if any(s == seq for s, _ in in_flight):
+                # cumulative, everything sent before it has been applied too
+                while in_flight:
+                    s, _ = in_flight.popleft()
+                    self.acked += 1
+                    if s == seq:
+                        break
+            self.expire()
+            if self.pending is not None and len(in_flight) < self.window:
+                raw, self.pending = self.pending, None
+                self.write(raw)
+
+    def expire(self):
+        # give up on the commands waiting for an ACK for too long, with the lock held
+        deadline = time.perf_counter() - self.ack_timeout
+        while self.in_flight and self.in_flight[0][1] < deadline:
+            self.in_flight.popleft()
+            self.timeouts += 1
+
+    def write(self, raw):
+        # write through the beacon and track it, with the lock held
+        # a rate limited command is kept as the pending one, a command suppressed by the deadband is dropped:
+        # it's judged against the last written command, which only changes with a newer command replacing it
+        rate_limited = self.beacon.rate_limited
+        written = self.beacon.send_raw(raw)
+        if not written and self.beacon.rate_limited != rate_limited:
+            self.pending = raw
+            return None
+        if written:
+            self.in_flight.append((self.beacon.last_seq, time.perf_counter()))
+            self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+            self.written += 1
+            if self.on_write is not None:
+                self.on_write(raw)
+        return written
+
+    @property
+    def stats(self):
+        return (f"window {len(self.in_flight)}/{self.window} (max {self.max_in_flight}), {self.written} written, {self.acked} acked, "
+                f"{self.coalesced} coalesced, {self.timeouts} timed out")
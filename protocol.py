@@ -0,0 +1,198 @@
+# Framed binary protocol between the beacon and the MCU, used instead of raw commands and ASCII lines with `python main.py --framed`
+# Every packet, in both directions, is
+#
+#   SYNC (0xA5) | LEN | TYPE | SEQ | PAYLOAD (LEN bytes) | CRC (2 bytes, big endian)
+#
+# CRC is CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) over LEN, TYPE, SEQ and PAYLOAD, which is binascii.crc_hqx(..., 0xFFFF)
+# To the MCU: COMMAND, the payload is the command bytes (wheels then servos), SEQ counts up and wraps at 256
+# From the MCU: ACK with the SEQ of the command it applied (replaces "OK"), FPS with a little endian float32 payload (replaces "FPS:240"),
+# and TEXT for anything else worth logging
+#
+# PacketDecoder is incremental: feed it whatever bytes arrived, it returns the complete packets and keeps the rest
+# Corrupted bytes (bad CRC, impossible length) are skipped one at a time until the next valid packet, so it never stalls
+# A stray sync byte with a plausible length would make it wait for bytes that never come, holding back the packets behind it,
+# so a complete valid packet found later in the buffer wins over an incomplete one
+# LineDecoder does the same for the default ASCII line protocol ("OK", "FPS:240"), turning the lines into the same packets
+# (without sequence numbers), so that the readers handle both protocols with one code path
+
+import binascii
+import struct
+
+SYNC = 0xA5
+HEADER = struct.Struct(">BBBB")  # SYNC, LEN, TYPE, SEQ
+CRC = struct.Struct(">H")
+MAX_PAYLOAD = 64  # longer packets are treated as corruption
+
+# packet types
+COMMAND = 0x01
+ACK = 0x81
+FPS = 0x82
+TEXT = 0x83
+
+FPS_PAYLOAD = struct.Struct("<f")
+
+
+class Packet:
+    __slots__ = ["type", "seq", "payload"]
+
+    def __init__(self, type, seq, payload=b""):
+        self.type = type
+        self.seq = seq
+        self.payload = payload
+
+    @property
+    def fps(self):
+        # the frame rate reported by a FPS packet
+        return FPS_PAYLOAD.unpack(self.payload)[0]
+
+    @property
+    def text(self):
+        # the content of a TEXT packet
+        return self.payload.decode(errors="replace")
+
+    def __repr__(self):
+        return f"Packet(type=0x{self.type:02X}, seq={self.seq}, payload={bytes(self.payload)})"
+
+
+def crc(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def encode(type, seq, payload=b""):
+    """
+    Build one packet
+
+    :param type: packet type, like COMMAND
+    :param seq: sequence number, taken modulo 256
+    :param payload: bytes, at most MAX_PAYLOAD
+    :return: bytes of the packet, ready to be written
+    """
+    assert len(payload) <= MAX_PAYLOAD
+    body = bytes([len(payload), type, seq & 0xFF]) + payload
+    return bytes([SYNC]) + body + CRC.pack(crc(body))
+
+
+def encode_fps(seq, fps):
+    # the FPS report of the MCU, for simulating it
+    return encode(FPS, seq, FPS_PAYLOAD.pack(fps))
+
+
+class PacketDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        # statistics
+        self.packets = 0  # number of valid packets
+        self.crc_errors = 0  # number of sync bytes followed by a packet with a wrong CRC
+        self.skipped = 0  # number of bytes dropped while looking for the next packet
+
+    def feed(self, data):
+        """
+        Add received bytes and extract all complete packets
+
+        :param data: bytes received from the serial port, any length
+        :return: list of Packet, possibly empty
+        """
+        buffer = self.buffer
+        buffer += data
+        packets = []
+        start = 0
+        size = HEADER.size
+        while True:
+            sync = buffer.find(SYNC, start)
+            if sync < 0:
+                self.skipped += len(buffer) - start
+                start = len(buffer)
+                break
+            self.skipped += sync - start
+            start = sync
+            if len(buffer) - start < size:
+                break  # wait for the rest of the header
+            _, length, type, seq = HEADER.unpack_from(buffer, start)
+            if length > MAX_PAYLOAD:
+                self.skipped += 1
+                start += 1  # not a real sync byte
+                continue
+            end = start + size + length + CRC.size
+            if len(buffer) < end:
+                later = self.find_packet(buffer, start + 1)
+                if later < 0:
+                    break  # wait for the rest of the packet
+                # a false sync byte, resync on the valid packet behind it
+                self.skipped += later - start
+                start = later
+                continue
+            if crc(buffer[start+1:end-CRC.size]) != CRC.unpack_from(buffer, end - CRC.size)[0]:
+                self.crc_errors += 1
+                self.skipped += 1
+                start += 1  # resync from the next byte
+                continue
+            packets.append(Packet(type, seq, bytes(buffer[start+size:end-CRC.size])))
+            start = end
+        del buffer[:start]
+        self.packets += len(packets)
+        return packets
+
+    @staticmethod
+    def find_packet(buffer, start):
+        """
+        :return: the position of the first complete packet with a valid CRC from start, -1 if there's none
+        """
+        size = HEADER.size
+        while True:
+            start = buffer.find(SYNC, start)
+            if start < 0 or len(buffer) - start < size:
+                return -1
+            length = buffer[start + 1]
+            end = start + size + length + CRC.size
+            if length <= MAX_PAYLOAD and end <= len(buffer) and \
+                    crc(buffer[start+1:end-CRC.size]) == CRC.unpack_from(buffer, end - CRC.size)[0]:
+                return start
+            start += 1
+
+
+class LineDecoder:
+    def __init__(self, max_line=256):
+        """
+        :param max_line: a partial line longer than this is garbage (no newline in sight) and is dropped
+        """
+        self.buffer = bytearray()
+        self.max_line = max_line
+        # statistics
+        self.packets = 0  # number of lines
+        self.errors = 0  # number of malformed FPS lines, passed on as TEXT
+        self.skipped = 0  # number of bytes dropped with overlong lines
+
+    def feed(self, data):
+        """
+        Add received bytes and turn all complete lines into packets
+        "OK" becomes ACK, "FPS:240" becomes FPS, anything else is TEXT, all of them with the sequence number None
+
+        :param data: bytes received from the serial port, any length
+        :return: list of Packet, possibly empty
+        """
+        buffer = self.buffer
+        buffer += data
+        packets = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            packets.append(self.parse(bytes(buffer[start:end]).strip()))
+            start = end + 1
+        del buffer[:start]
+        if len(buffer) > self.max_line:
+            self.skipped += len(buffer)
+            del buffer[:]
+        self.packets += len(packets)
+        return packets
+
+    def parse(self, line):
+        if line == b"OK":
+            return Packet(ACK, None)
+        if line.startswith(b"FPS:"):
+            try:
+                return Packet(FPS, None, FPS_PAYLOAD.pack(float(line[len(b"FPS:"):])))
+            except ValueError:  # sometimes the MCU sends corrupted data
+                self.errors += 1
+        return Packet(TEXT, None, line)
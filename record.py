@@ -0,0 +1,148 @@
+# Record and replay of Leap Motion websocket sessions
+# Recorder writes every raw websocket message with its receive time into a compact binary file (gzipped if the name ends with .gz)
+# Replay reads it back and stands in for the websocket connection of the sampler,
+# at the original timing, N times faster, or as fast as possible, so that the pipeline can be benchmarked without a controller
+#
+# File layout: MAGIC, then for every message a RECORD header (receive time in seconds since the first message, payload length)
+# followed by the utf-8 payload
+
+import asyncio
+import gzip
+import struct
+import time
+
+MAGIC = b"LEAPREC1"
+RECORD = struct.Struct("<dI")
+
+
+def open_file(path, mode):
+    # gzip for .gz files, plain binary otherwise
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, compresslevel=3)
+    return open(path, mode)
+
+
+class Recorder:
+    def __init__(self, path):
+        """
+        :param path: file to write, existing content is replaced
+        """
+        self.path = path
+        self.file = open_file(path, "wb")
+        self.file.write(MAGIC)
+        self.start = None
+        self.count = 0
+
+    def write(self, msg, t=None):
+        """
+        Record one raw websocket message
+
+        :param msg: str or bytes of the message
+        :param t: receive time (perf_counter), default to now
+        """
+        t = time.perf_counter() if t is None else t
+        if self.start is None:
+            self.start = t
+        if isinstance(msg, str):
+            msg = msg.encode()
+        self.file.write(RECORD.pack(t - self.start, len(msg)))
+        self.file.write(msg)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_recording(path):
+    """
+    Iterate over a recording
+
+    :param path: file written by Recorder
+    :return: generator of (receive time in seconds since the first message, message str)
+    """
+    with open_file(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a Leap Motion recording")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            t, length = RECORD.unpack(header)
+            yield t, f.read(length).decode()
+
+
+def load_messages(path):
+    """
+    Load all messages of a recording, or of a text file with one json frame per line
+
+    :return: list of message str
+    """
+    with open_file(path, "rb") as f:
+        is_recording = f.read(len(MAGIC)) == MAGIC
+    if is_recording:
+        return [msg for _, msg in read_recording(path)]
+    with open_file(path, "rt") as f:
+        return [line for line in f if line.strip()]
+
+
+class ReplayFinished(Exception):
+    # raised by Replay.recv after the last message, like a closed websocket
+    pass
+
+
+class Replay:
+    # Stand in for the websocket connection of the sampler, use it like `async with Replay(path) as ws: await ws.recv()`
+    def __init__(self, path, speed=1.0, loop=False):
+        """
+        :param path: file written by Recorder
+        :param speed: playback speed relative to the original timing, 0 for as fast as possible
+        :param loop: start over after the last message instead of raising ReplayFinished
+        """
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.messages = list(read_recording(path))
+        self.index = 0
+        self.start = None  # perf_counter of the first replayed message
+        self.sent = []  # messages the sampler sent to the "service", kept for inspection
+
+    async def __aenter__(self):
+        self.index = 0
+        self.start = None
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def send(self, msg):
+        self.sent.append(msg)
+
+    async def recv(self):
+        if self.index >= len(self.messages):
+            if not self.loop or not self.messages:
+                raise ReplayFinished(self.path)
+            self.index = 0
+            self.start = None
+        t, msg = self.messages[self.index]
+
+        # the message is only taken after waiting for it, so that cancelling recv (like a timeout) doesn't lose it
+        if not self.speed:
+            await asyncio.sleep(0)  # as fast as possible, but still let the other tasks run
+        else:
+            now = time.perf_counter()
+            if self.start is None:
+                self.start = now - t / self.speed
+            delay = self.start + t / self.speed - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self.index += 1
+        return msg
+
+    async def close(self):
+        self.index = len(self.messages)
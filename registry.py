@@ -0,0 +1,291 @@
+# Registry of all the tracked hands, of every Leap Motion device, keyed by (device, Leap Motion hand id)
+# A hand gets a slot when it first shows up, and keeps it while it's tracked, so a slot always holds the same hand:
+#
+# - a hand missing from a frame of its device is lost, its slot is cleaned (all zero) but kept until it expires
+# - a hand with a low confidence keeps its last position, like with FrameDecoder
+# - a slot not seen for `expiry` seconds is released, like the hands of an unplugged device, and given to the next new hand
+# - when all slots are taken, the lost hand seen the longest ago is evicted for the new one, and if all of them are tracked,
+#   the new hand is rejected (and counted)
+#
+# All slots live in one RegistryFrame, (H, 28, 3) key points and (H, 3) palm normals, so that the decoder scatters all hands
+# of a frame into their slots with one vectorized call, and the filters (BatchFilter) and the gesture features
+# (gesture.batch_features) work on every occupied slot at once, instead of looping over Hand objects
+# The frames are exchanged like the frames of a Hand (see exchange.py): the sampler is the only writer, readers take snapshots
+
+import time
+from itertools import chain
+
+import numpy as np
+
+from exchange import FrameExchange
+from hand import Hand
+
+# the hand types, as stored in RegistryFrame.type, the same as the hand pool slots of FrameDecoder
+type_codes = {"left": 0, "right": 1}
+
+
+class RegistryFrame:
+    # All slots of the registry at one point in time
+    __slots__ = ["pos", "palm_normal", "timestamp", "device", "hand_id", "type", "occupied", "active", "generation", "since", "time"]
+
+    def __init__(self, capacity):
+        self.pos = np.zeros((capacity, Hand.key_pt_count, 3), np.float32)  # key points of every slot, all zero when lost
+        self.palm_normal = np.zeros((capacity, 3), np.float32)
+        self.timestamp = np.zeros(capacity, np.int64)  # Leap Motion timestamp of the last update of every slot, in microseconds
+        self.device = np.zeros(capacity, np.int32)
+        self.hand_id = np.zeros(capacity, np.int64)  # Leap Motion hand id
+        self.type = np.full(capacity, -1, np.int8)  # see type_codes
+        self.occupied = np.zeros(capacity, bool)  # whether the slot belongs to a hand
+        self.active = np.zeros(capacity, bool)  # whether the hand was in the latest frame of its device, with a position
+        self.generation = np.zeros(capacity, np.int64)  # incremented every time the slot is given to a new hand
+        self.since = np.zeros(capacity)  # perf_counter every slot was given to its hand
+        self.time = 0.0  # perf_counter of the update
+
+    def copy_from(self, other):
+        # fill this frame with the content of another one
+        for name in self.__slots__[:-1]:
+            np.copyto(getattr(self, name), getattr(other, name))
+        self.time = other.time
+
+
+class HandRegistry:
+    arm_keys = tuple(Hand.arm_pos_names)
+    finger_keys = tuple(Hand.finger_pos_names)
+    finger_count = len(Hand.finger_names)
+
+    def __init__(self, capacity=8, expiry=1.0, confidence=0.7, scale=1/100, frame_count=4):
+        """
+        :param capacity: number of slots, H
+        :param expiry: seconds a slot is kept without its hand being seen
+        :param confidence: hands with a lower Leap Motion confidence keep their last position
+        :param scale: scale from Leap Motion millimeters to our space
+        :param frame_count: initial number of frames in the exchange
+        """
+        self.capacity = capacity
+        self.expiry = expiry
+        self.confidence = confidence
+        self.scale = scale
+        self.shape = (-1, Hand.key_pt_count, 3)
+        self.exchange = FrameExchange(lambda: RegistryFrame(capacity), frame_count)
+
+        # private to the writer
+        self.slots = {}  # (device, hand id) -> slot
+        self.free = list(range(capacity))
+        self.last_seen = np.zeros(capacity)  # perf_counter every slot was last in a frame
+        self.updated = np.zeros(capacity, bool)  # slots with a new position in the latest frame
+        self.next_expiry = 0.0
+
+        # statistics
+        self.allocated = 0  # number of hands given a slot
+        self.expired = 0  # number of slots released after expiry
+        self.evicted = 0  # number of lost hands evicted for a new one
+        self.rejected = 0  # number of hand frames dropped because every slot was taken by a tracked hand
+
+    # ! Readers, see exchange.py
+    def snapshot(self):
+        """
+        Pin the latest complete RegistryFrame, use it like `with registry.snapshot() as frame: frame.pos[frame.active]`
+
+        :return: context manager handing out the RegistryFrame
+        """
+        return self.exchange.snapshot()
+
+    @property
+    def latest_frame(self):
+        return self.exchange.latest_frame
+
+    # ! Writer
+    def decode(self, frame, device=0, update=True, now=None):
+        """
+        Update the slots of every hand of a parsed Leap Motion frame in one pass
+
+        :param frame: parsed json frame from the Leap Motion websocket
+        :param device: the device the frame comes from, like the index of its connection
+        :param update: if False, every hand of the device is lost (paused)
+        :param now: perf_counter of the frame, for the expiry
+        :return: whether the frame is a regular tracking frame (instead of some meta message)
+        """
+        if "timestamp" not in frame:
+            return False
+        now = time.perf_counter() if now is None else now
+        out = self.exchange.claim()
+        out.copy_from(self.exchange.latest_frame)
+        updated = self.updated
+        updated[:] = False
+
+        hands_json = frame["hands"] if update else ()
+        fingers = {hand_json["id"]: [None] * self.finger_count for hand_json in hands_json}
+        if fingers:
+            # bucket the pointables into their hand, from thumb to pinky, in one pass
+            for pointable in frame["pointables"]:
+                slots = fingers.get(pointable["handId"])
+                if slots is not None:
+                    slots[pointable["type"]] = pointable
+
+        # find (or allocate) the slot of every hand, and gather the key points of the valid ones through the fixed key table
+        rows = []
+        targets = []
+        normals = []
+        seen = []
+        last_seen = self.last_seen
+        arm_keys = self.arm_keys
+        finger_keys = self.finger_keys
+        for hand_json in hands_json:
+            key = (device, hand_json["id"])
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self.allocate(out, key, hand_json["type"], now)
+                if slot is None:
+                    continue
+            last_seen[slot] = now  # not evicted for another hand of this frame
+            seen.append(slot)
+            slots = fingers[hand_json["id"]]
+            if hand_json["confidence"] < self.confidence or None in slots:
+                continue
+            rows += [hand_json[key] for key in arm_keys]
+            rows += [finger[key] for finger in slots for key in finger_keys]
+            targets.append(slot)
+            normals.append(hand_json["palmNormal"])
+
+        # the hands of this device missing from the frame are lost
+        lost = out.active & (out.device == device)
+        lost[seen] = False
+        if lost.any():
+            out.pos[lost] = 0
+            out.active[lost] = False
+
+        if targets:
+            # the single gather and scatter of all valid hands
+            values = np.fromiter(chain.from_iterable(rows), np.float32, len(rows) * 3).reshape(self.shape)
+            values *= self.scale
+            out.pos[targets] = values
+            out.palm_normal[targets] = normals
+            out.timestamp[targets] = frame["timestamp"]
+            out.active[targets] = True
+            updated[targets] = True
+
+        if now >= self.next_expiry:
+            self.expire(out, now)
+        out.time = now
+        self.exchange.publish()
+        return True
+
+    def allocate(self, out, key, type, now):
+        # give a slot to a new hand, with the claimed frame
+        if not self.free:
+            lost = np.flatnonzero(out.occupied & ~out.active & (self.last_seen < now))
+            if not len(lost):
+                self.rejected += 1
+                return None
+            self.release(out, lost[np.argmin(self.last_seen[lost])])
+            self.evicted += 1
+        slot = min(self.free)  # keep the hands in the first slots
+        self.free.remove(slot)
+        self.slots[key] = slot
+        out.device[slot], out.hand_id[slot] = key
+        out.type[slot] = type_codes.get(type, -1)
+        out.occupied[slot] = True
+        out.active[slot] = False  # until it has a position
+        out.generation[slot] += 1
+        out.pos[slot] = 0
+        out.palm_normal[slot] = 0
+        self.last_seen[slot] = now
+        out.since[slot] = now
+        self.allocated += 1
+        return slot
+
+    def release(self, out, slot):
+        # free a slot, with the claimed frame
+        del self.slots[(int(out.device[slot]), int(out.hand_id[slot]))]
+        out.occupied[slot] = False
+        out.active[slot] = False
+        out.type[slot] = -1
+        out.pos[slot] = 0
+        self.free.append(slot)
+
+    def expire(self, out, now):
+        # release the slots not seen for too long, checked a few times per expiry period
+        for slot in np.flatnonzero(out.occupied & (self.last_seen < now - self.expiry)):
+            self.release(out, slot)
+            self.expired += 1
+        self.next_expiry = now + self.expiry / 4
+
+    def clear(self):
+        # release every slot, like when the connection to the Leap Motion service dropped
+        out = self.exchange.claim()
+        out.copy_from(self.exchange.latest_frame)
+        for slot in np.flatnonzero(out.occupied):
+            self.release(out, slot)
+        self.updated[:] = False
+        out.time = time.perf_counter()
+        self.exchange.publish()
+
+    def select(self, type, frame=None):
+        """
+        The slot of the operator hand of a type: the tracked hand of that type that showed up first, so that it doesn't
+        switch to another operator while it's tracked
+
+        :param type: "left" or "right"
+        :param frame: RegistryFrame to select from, like a snapshot, None for the latest frame (the writer)
+        :return: slot, None if no hand of that type is tracked
+        """
+        frame = self.exchange.latest_frame if frame is None else frame
+        candidates = np.flatnonzero(frame.active & (frame.type == type_codes[type]))
+        if not len(candidates):
+            return None
+        return candidates[np.argmin(frame.since[candidates])]
+
+    @property
+    def stats(self):
+        frame = self.exchange.latest_frame
+        return (f"{np.count_nonzero(frame.active)} tracked, {np.count_nonzero(frame.occupied)}/{self.capacity} slots, "
+                f"{self.allocated} allocated, {self.expired} expired, {self.evicted} evicted, {self.rejected} rejected")
+
+
+class BatchFilter:
+    # Smooths the key points and the palm normals of the occupied slots of a RegistryFrame with one call of a filters.Filter,
+    # so that the cost grows with the number of hands, not with the capacity
+    # The slots are given lowest first (HandRegistry.allocate), so the occupied ones are the first ones, but for the holes
+    # left by released hands: the slots up to the last occupied one are filtered, as views, copying the rows costs more
+    # than filtering them
+    # A slot given to a new hand, lost, or tracked again after being lost, is restarted: its value is passed through,
+    # like GestureParser.reset_filters
+    def __init__(self, keypoint_filter, capacity):
+        """
+        :param keypoint_filter: filters.Filter, used for this batch only
+        :param capacity: number of slots of the registry
+        """
+        self.filter = keypoint_filter
+        self.stacked = np.zeros((capacity, Hand.key_pt_count + 1, 3), np.float32)  # key points and the palm normal
+        self.generation = np.full(capacity, -1, np.int64)  # of every slot, the last time
+        self.active = np.zeros(capacity, bool)  # of every slot, the last time
+        self.pos = np.zeros((capacity, Hand.key_pt_count, 3), np.float32)
+        self.palm_normal = np.zeros((capacity, 3), np.float32)
+
+    def __call__(self, frame):
+        """
+        :param frame: RegistryFrame, usually a snapshot, it's not modified
+        :return: (pos, palm_normal) of the slots up to the last occupied one, filtered, indexed by slot,
+        owned by the filter and overwritten by the next call
+        """
+        occupied = np.flatnonzero(frame.occupied)
+        rows = slice(0, occupied[-1] + 1 if len(occupied) else 0)
+        stacked = self.stacked
+        stacked[rows, :-1] = frame.pos[rows]
+        stacked[rows, -1] = frame.palm_normal[rows]
+        # the slots left out are restarted once given to a hand (a new generation)
+        restart = ((frame.generation != self.generation) | ~frame.active | ~self.active) & frame.occupied
+        self.generation[:] = frame.generation
+        self.active[:] = frame.active
+        if restart.any():
+            self.filter.restart(stacked, restart)
+        filtered = self.filter(stacked, frame.time, rows)
+
+        pos = self.pos[rows]
+        palm_normal = self.palm_normal[rows]
+        pos[:] = filtered[:, :-1]
+        normal = filtered[:, -1]
+        length = np.sqrt(np.einsum("ij,ij->i", normal, normal))
+        length[length == 0] = 1  # averaged unit vectors are shorter
+        np.divide(normal, length[:, None], out=palm_normal, casting="unsafe")
+        return pos, palm_normal
@@ -0,0 +1,203 @@
+# Adaptive frame skipping of the sampler, based on how fast the parser and the renderer actually take the frames
+# Decoding a frame (JSON parsing and filling the hands) is wasted when no consumer reads the hands before the next frame overwrites them,
+# so the sampler only decodes as many frames as the fastest consumer needs:
+#
+# - every consumer calls consumed() when it reads the hands, its consumption rate is measured (moving average of the intervals)
+# - a consumer can have a target rate, like 60 for the renderer, it's never given more than that
+# - a consumer that isn't adaptive gets its target rate (every frame without one) whatever it consumes, like the parser waiting
+#   for the MCU: it reads the hands when the MCU is ready, not when a frame arrives, so fewer frames means parsing older ones
+# - the sampler decodes at the rate of the fastest active consumer, with some headroom so that a consumer driven by new frames
+#   (the pipelined parser) can always speed up, consumers that haven't consumed anything lately are ignored
+# - when no consumer is active, or before their rates are known, every frame is decoded
+#
+# offer() decides for every received frame:
+#
+# - decode it now
+# - decimate: not due yet, the consumers don't need another frame so soon
+# - drop: the sampler is behind, it spent longer decoding the last frame than it has been waiting since (the original skipping rule)
+#
+# A frame not decoded is kept as the pending one, replacing (coalescing) the older pending frame, and the sampler decodes it
+# when it's due if nothing newer arrived by then, so the latest frame is always parsed, even if the stream stops right after it
+
+import math
+import time
+
+
+class Consumer:
+    # One reader of the hands, like the parser or the renderer
+    def __init__(self, name, target_rate=None, adaptive=True, smoothing=0.1):
+        """
+        :param name: shown in the statistics
+        :param target_rate: max frames per second it needs, None for as many as it consumes
+        :param adaptive: whether it's given frames at the rate it consumes them, or always at the target rate
+        :param smoothing: weight of the latest interval in the moving average
+        """
+        self.name = name
+        self.target_rate = target_rate
+        self.adaptive = adaptive
+        self.smoothing = smoothing
+        self.last = 0  # perf_counter of the last consumption
+        self.interval = 0  # moving average of the time between two consumptions, 0 before it's known
+        self.seen = 0  # number of frames decoded when it last consumed
+
+        # statistics
+        self.consumed = 0  # number of consumptions
+        self.depth = 0  # frames decoded since the previous consumption, the last time, more than 1 means it's behind
+        self.missed = 0  # frames decoded and overwritten before it could read them
+
+    @property
+    def rate(self):
+        # measured consumption rate, 0 before it's known
+        return 1 / self.interval if self.interval else 0
+
+    def __str__(self):
+        target = f"target {self.target_rate:.0f}/s" if self.target_rate else "no target"
+        if not self.adaptive:
+            target += ", fixed"
+        return f"{self.name} {self.rate:.1f}/s ({target}), depth {self.depth}, {self.missed} missed"
+
+
+class FrameScheduler:
+    def __init__(self, headroom=1.25, idle_timeout=0.5, smoothing=0.1):
+        """
+        :param headroom: decode this much faster than the fastest consumer, so that it can speed up
+        :param idle_timeout: seconds without consumption after which a consumer is ignored
+        :param smoothing: weight of the latest value in the moving averages
+        """
+        self.headroom = headroom
+        self.idle_timeout = idle_timeout
+        self.smoothing = smoothing
+        self.consumers = []
+        self.pending = None  # the latest frame not decoded yet
+        self.pending_time = 0  # perf_counter it was received at
+        self.next_due = 0  # perf_counter the next frame should be decoded at
+        self.arrival = 0  # perf_counter of the last received frame
+        self.arrival_interval = 0  # moving average of the time between two received frames
+        self.decode_end = 0  # perf_counter the last decode ended at
+        self.decode_time = 0  # duration of the last decode
+
+        # statistics
+        self.received = 0  # number of frames offered
+        self.decoded_frames = 0  # number of frames decoded
+        self.decimated = 0  # frames held because no consumer needed them yet
+        self.dropped = 0  # frames held because the sampler was behind
+        self.coalesced = 0  # pending frames replaced by a newer one, never decoded
+        self.late = 0  # pending frames decoded because nothing newer arrived in time
+        self.backlog = 0  # frames in a row that were already waiting when they were received
+        self.rate = 0  # frames per second the consumers need, 0 for all of them
+
+    def add_consumer(self, name, target_rate=None, adaptive=True):
+        """
+        Register a reader of the hands, it should call consumed() every time it reads them, see Consumer
+
+        :return: Consumer
+        """
+        consumer = Consumer(name, target_rate, adaptive, self.smoothing)
+        self.consumers.append(consumer)
+        return consumer
+
+    def consumed(self, consumer, now=None):
+        # called by a consumer, from its own thread, after reading the hands
+        now = time.perf_counter() if now is None else now
+        if consumer.last and now - consumer.last < self.idle_timeout:
+            consumer.interval += (now - consumer.last - consumer.interval) * consumer.smoothing if consumer.interval else now - consumer.last
+        consumer.last = now
+        decoded = self.decoded_frames
+        consumer.depth = decoded - consumer.seen
+        consumer.missed += max(consumer.depth - 1, 0)
+        consumer.seen = decoded
+        consumer.consumed += 1
+
+    def required_rate(self, now):
+        # frames per second the active consumers need, 0 for all of them
+        rate = 0
+        for consumer in self.consumers:
+            if not consumer.last or now - consumer.last > self.idle_timeout:
+                continue  # not started, paused or closed
+            needed = consumer.rate * self.headroom if consumer.rate and consumer.adaptive else math.inf
+            if consumer.target_rate:
+                needed = min(needed, consumer.target_rate)
+            rate = max(rate, needed)
+        return 0 if math.isinf(rate) else rate
+
+    def offer(self, frame, now, waited=None):
+        """
+        Called by the sampler for every received frame
+
+        :param frame: the received message
+        :param now: perf_counter it was received at
+        :param waited: seconds the sampler waited for it, to tell whether frames are backing up
+        :return: the frame to decode now, None if it's kept as the pending one
+        """
+        self.received += 1
+        if self.arrival:
+            interval = now - self.arrival
+            self.arrival_interval += (interval - self.arrival_interval) * self.smoothing if self.arrival_interval else interval
+        self.arrival = now
+        if waited is not None:
+            self.backlog = self.backlog + 1 if waited < 1e-4 else 0
+
+        if self.pending is not None:
+            self.coalesced += 1  # this one is newer
+        if now - self.decode_end < self.decode_time:
+            # the sampler is behind, wait for the next frame, or decode this one once it's caught up
+            self.dropped += 1
+            self.hold(frame, now)
+            return None
+        # a bit early is fine, the next frame would be late
+        if now < self.next_due - self.arrival_interval / 2:
+            self.decimated += 1
+            self.hold(frame, now)
+            return None
+        self.pending = None
+        return frame
+
+    def hold(self, frame, now):
+        self.pending = frame
+        self.pending_time = now
+
+    def timeout(self, now):
+        """
+        :return: seconds the sampler should wait for a newer frame before decoding the pending one, None without a pending frame
+        """
+        if self.pending is None:
+            return None
+        due = max(self.next_due, self.decode_end + self.decode_time)
+        # give the next frame a chance to come in on time, with half an interval of slack
+        return max(due + self.arrival_interval / 2 - now, 0)
+
+    def take_pending(self):
+        # the pending frame, to be decoded now because nothing newer arrived in time
+        frame, self.pending = self.pending, None
+        if frame is not None:
+            self.late += 1
+        return frame
+
+    def decoded(self, start, end):
+        """
+        Called by the sampler after decoding a frame
+
+        :param start: perf_counter the decode started at
+        :param end: perf_counter it ended at
+        """
+        self.decoded_frames += 1
+        self.decode_time = end - start
+        self.decode_end = end
+        self.rate = self.required_rate(end)
+        self.next_due = start + 1 / self.rate if self.rate else 0
+
+    def reset(self):
+        # forget the pending frame, like when the connection dropped, it's stale
+        self.pending = None
+
+    @property
+    def skipped(self):
+        # frames received and never decoded
+        return self.received - self.decoded_frames - (self.pending is not None)
+
+    @property
+    def stats(self):
+        rate = f"{self.rate:.1f}/s" if self.rate else "all"
+        consumers = ", ".join(str(consumer) for consumer in self.consumers)
+        return (f"decoding {rate}, {self.decimated} decimated, {self.dropped} dropped, {self.late} late, "
+                f"{self.skipped / max(self.received, 1):.1%} skipped, backlog {self.backlog}; {consumers}")
@@ -0,0 +1,128 @@
+# Synthetic Leap Motion v7 frames, for benchmarking and testing without a controller
+# The frames follow the layout of the real websocket messages (units in millimeters),
+# including the bulky fields the driver never reads (bases, velocities, etc.), so that decoding costs are realistic
+# The hands wave slowly around a fixed base position and the fingers curl in and out
+
+import json
+import math
+
+import numpy as np
+
+
+# Finger base offsets relative to the palm (x, z), from thumb to pinky, in millimeters
+FINGER_OFFSETS = [(-45, 20), (-25, -30), (0, -35), (20, -30), (40, -20)]
+# Bone lengths from the carp (metacarpal start) to the tip, in millimeters
+BONE_LENGTHS = [40, 30, 25, 20]
+
+
+def _vec(v):
+    return [round(float(x), 4) for x in v]
+
+
+def make_hand(hand_id, hand_type, t):
+    """
+    Generate a single hand and its five pointables at time t
+
+    :param hand_id: Leap Motion hand id
+    :param hand_type: "left" or "right"
+    :param t: time in seconds, controls the motion
+    :return: tuple of (hand json, list of pointable json)
+    """
+    side = -1 if hand_type == "left" else 1
+    palm = np.array([side * 80 + 30 * math.sin(t), 200 + 40 * math.sin(0.7 * t), 20 * math.cos(t)])
+    wrist = palm + [0, -5, 60]
+    elbow = wrist + [0, -60, 220]
+    curl = 0.5 + 0.5 * math.sin(1.3 * t)  # 0: open palm, 1: fist
+
+    hand = {
+        "armBasis": [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+        "armWidth": 60.0,
+        "confidence": 1.0,
+        "direction": [0, 0, -1],
+        "elbow": _vec(elbow),
+        "grabAngle": curl * math.pi,
+        "grabStrength": curl,
+        "id": hand_id,
+        "palmNormal": [0, -1, 0],
+        "palmPosition": _vec(palm),
+        "palmVelocity": [0, 0, 0],
+        "palmWidth": 85.0,
+        "pinchDistance": 50.0,
+        "pinchStrength": 0.0,
+        "r": [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+        "s": 1.0,
+        "sphereCenter": _vec(palm + [0, 40, 0]),
+        "sphereRadius": 80.0,
+        "stabilizedPalmPosition": _vec(palm),
+        "t": _vec(palm),
+        "timeVisible": t,
+        "type": hand_type,
+        "wrist": _vec(wrist),
+    }
+
+    pointables = []
+    for finger, (x, z) in enumerate(FINGER_OFFSETS):
+        joint = palm + [side * x, 0, z + 40]
+        joints = [joint]
+        for length in BONE_LENGTHS:
+            # bend downwards as the hand curls
+            angle = curl * math.pi / 3 * (len(joints) - 1)
+            joint = joint + [0, -length * math.sin(angle), -length * math.cos(angle)]
+            joints.append(joint)
+        pointables.append({
+            "bases": [[[1, 0, 0], [0, 1, 0], [0, 0, 1]] for _ in BONE_LENGTHS],
+            "btipPosition": _vec(joints[4]),
+            "carpPosition": _vec(joints[0]),
+            "dipPosition": _vec(joints[3]),
+            "direction": [0, 0, -1],
+            "extended": curl < 0.5,
+            "handId": hand_id,
+            "id": hand_id * 10 + finger,
+            "length": float(sum(BONE_LENGTHS[1:])),
+            "mcpPosition": _vec(joints[1]),
+            "pipPosition": _vec(joints[2]),
+            "stabilizedTipPosition": _vec(joints[4]),
+            "timeVisible": t,
+            "tipPosition": _vec(joints[4]),
+            "tipVelocity": [0, 0, 0],
+            "tool": False,
+            "touchDistance": 1.0,
+            "touchZone": "none",
+            "type": finger,
+            "width": 18.0,
+        })
+    return hand, pointables
+
+
+def make_frame(frame_id, t, hand_count=2):
+    """
+    Generate a full Leap Motion v7 frame
+
+    :param frame_id: Leap Motion frame id
+    :param t: time in seconds, used for the motion and the timestamp
+    :param hand_count: number of hands in the frame, alternating left and right
+    :return: the frame as a python dict, json.dumps it to get the websocket message
+    """
+    hands = []
+    pointables = []
+    for i in range(hand_count):
+        hand, fingers = make_hand(i + 1, "left" if i % 2 == 0 else "right", t + i)
+        hands.append(hand)
+        pointables.extend(fingers)
+    return {
+        "currentFrameRate": 110.0,
+        "devices": [],
+        "hands": hands,
+        "id": frame_id,
+        "interactionBox": {"center": [0, 200, 0], "size": [235, 235, 147]},
+        "pointables": pointables,
+        "r": [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+        "s": 1.0,
+        "t": [0, 0, 0],
+        "timestamp": int(t * 1e6),
+    }
+
+
+def make_messages(count=1000, fps=110, hand_count=2):
+    # a list of serialized frames, like the ones received by the websocket sampler
+    return [json.dumps(make_frame(i, i / fps, hand_count)) for i in range(count)]
@@ -0,0 +1,33 @@
+# Regression tests of the framed protocol decoder, run with `python -m pytest test_protocol.py`
+
+import protocol
+from protocol import ACK, COMMAND, PacketDecoder, encode
+
+
+def test_false_sync_does_not_hold_back_packets():
+    # a stray sync byte with a plausible length, the valid ACK behind it is decoded right away
+    decoder = PacketDecoder()
+    packets = decoder.feed(bytes([protocol.SYNC, 60]) + encode(ACK, 3))
+    assert [(p.type, p.seq) for p in packets] == [(ACK, 3)]
+    assert not decoder.buffer
+    assert decoder.skipped == 2
+
+
+def test_incomplete_packet_is_kept():
+    # byte by byte, nothing is skipped while a valid packet is on the way
+    decoder = PacketDecoder()
+    packet = encode(COMMAND, 7, bytes(range(8)))
+    packets = []
+    for byte in packet * 3:
+        packets += decoder.feed(bytes([byte]))
+    assert [(p.type, p.seq, p.payload) for p in packets] == [(COMMAND, 7, bytes(range(8)))] * 3
+    assert decoder.skipped == 0
+
+
+def test_corrupted_packet_is_skipped():
+    decoder = PacketDecoder()
+    corrupted = bytearray(encode(COMMAND, 1, b"abc"))
+    corrupted[-1] ^= 0xFF
+    packets = decoder.feed(bytes(corrupted) + encode(ACK, 2))
+    assert [(p.type, p.seq) for p in packets] == [(ACK, 2)]
+    assert decoder.crc_errors == 1